@@ -0,0 +1,294 @@
+'''
+Module contains Admission class. Admission handles joining of new
+clients in batches, so a join storm doesn't make a seed host encode
+roster and search a place in the tree for every client separately.
+
+Clients that ask for roster within a window share one snapshot of it,
+and every page of the snapshot is encoded once per wire format. Client
+learns members that joined after the snapshot from response to
+connect, so the snapshot may be a bit old.
+
+Requests for place that come in one pass of the reactor loop of the
+seed, or within a window if it is given, are sent by one batch. A batch
+goes up to the lowest ancestor of the seed whose bounds cover it (see
+Admission.covers) and then down the tree, and every node splits it
+between its free children and subtrees, so one relay carries all
+clients of a subtree. A node counts clients that it has sent to
+a subtree until they join, so clients of concurrent batches don't get
+the same place. Clients that don't fit a subtree are sent back to
+the seed and are placed again by a later batch.
+
+Vars:
+    INF (float) Upper bound of ids, bounds of the root are -1 and INF
+    SNAPSHOT_WINDOW (float) Default time in seconds that clients share
+                            one snapshot of roster
+    PLACE_WINDOW (float) Default time in seconds that requests for place
+                         are collected to a batch, 0 collects requests
+                         of one pass of reactor loop
+    TEMPLATES (int) Number of encoded pages of roster that are kept
+    RESERVE_TTL (float) Time in seconds that a place is kept for a client
+                        that it is given to
+    RETRY_DELAY (float) Delay in seconds before a client that didn't fit
+                        is placed again, it is doubled on every attempt
+    MAX_ATTEMPTS (int) Max number of times that a client is placed, then
+                       the client retries joining by itself
+'''
+
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+from handlers import TYPES
+from handshake import TIMEOUT
+
+
+LOGGER = logging.getLogger(__name__)
+INF = 1e11
+SNAPSHOT_WINDOW = 0.1
+PLACE_WINDOW = 0
+TEMPLATES = 32
+RESERVE_TTL = TIMEOUT
+RETRY_DELAY = 0.05
+MAX_ATTEMPTS = 5
+
+
+class Admission:
+    '''
+    Admission of clients to the chat
+
+    Fields:
+        snapshot_window (float) Time that clients share one snapshot
+        place_window (float) Time that requests for place are collected
+        _shared (tuple) Epoch of shared snapshot and time when it was
+                        taken, or None
+        _templates (OrderedDict) Matching between fields of page of
+                                 roster and its PacketTemplate, the least
+                                 recently used first
+        _pending (list) Clients that wait for the next batch: lists of
+                        id, host and number of attempts
+        _scheduled (bool) Sending of the next batch is scheduled
+        _placing (dict) Matching between a side and a dict of hosts of
+                        clients that were sent to it and time until
+                        which their places are reserved
+    '''
+
+    def __init__(self, peer, snapshot_window=SNAPSHOT_WINDOW,
+                 place_window=PLACE_WINDOW):
+        self._peer = peer
+        self.snapshot_window = snapshot_window
+        self.place_window = place_window
+        self._shared = None
+        self._templates = OrderedDict()
+        self._pending = []
+        self._scheduled = False
+        self._placing = {'left': {}, 'right': {}}
+        self._lock = threading.Lock()
+        metrics = peer.metrics
+        self._shared_pages = metrics.counter('roster_pages_shared_total')
+        self._batches = metrics.histogram('place_batch_size',
+                                          buckets=(1, 2, 4, 8, 16, 32, 64))
+        self._retried = metrics.counter('place_retries_total')
+
+    def shared_epoch(self):
+        ''' Get epoch of snapshot of roster that new clients share '''
+
+        now = time.monotonic()
+        with self._lock:
+            if self._shared is None or \
+                    now - self._shared[1] > self.snapshot_window:
+                self._shared = (self._peer._roster.epoch, now)
+            return self._shared[0]
+
+    def pack_chat_info(self, wire_format, packet):
+        '''
+        Encode response to get_chat_info. Page of roster is encoded once
+        for all clients that read it.
+
+        Return:
+            (bytes) Packet that is ready to be sent
+        '''
+
+        if 'connected' not in packet:
+            return wire_format.pack(packet)
+        key = (wire_format.name, packet['from_id'], tuple(packet['from_host']),
+               packet['roster_uid'], packet['epoch'], packet['snapshot_epoch'],
+               packet['offset'], len(packet['connected']), packet['total'],
+               packet.get('format'))
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+        if template is None:
+            template = wire_format.packet_template(packet)
+            with self._lock:
+                self._templates[key] = template
+                while len(self._templates) > TEMPLATES:
+                    self._templates.popitem(last=False)
+        else:
+            self._shared_pages.inc()
+        return template.pack(packet['to_id'], packet['to_host'])
+
+    def place(self, client_id, client_host):
+        ''' Find place for a client that has asked the node as a seed '''
+
+        self._queue([[client_id, client_host, 0]])
+
+    def retry(self, clients):
+        ''' Place again clients that didn't fit a subtree '''
+
+        clients = [client[:2] + [client[2] + 1] for client in clients]
+        dropped = [client for client in clients if client[2] >= MAX_ATTEMPTS]
+        for client in dropped:
+            LOGGER.warning('No place for %s after %d attempts', client[1],
+                           client[2])
+        clients = [client for client in clients if client[2] < MAX_ATTEMPTS]
+        if not clients:
+            return
+        self._retried.inc(len(clients))
+        # Places are freed when clients join, the later the more of them
+        delay = RETRY_DELAY * 2 ** (max(client[2] for client in clients) - 1)
+        timer = threading.Timer(delay, self._queue, (clients,))
+        timer.daemon = True
+        timer.start()
+
+    def _queue(self, clients):
+        '''
+        Add clients to the next batch. Batch is sent on the next pass of
+        the reactor loop, so clients that ask in one pass are placed
+        together, or after a window if it is given.
+        '''
+
+        with self._lock:
+            self._pending.extend(clients)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        call_soon = self._peer._reactor.call_soon
+        if not self.place_window:
+            return call_soon(self._flush)
+        timer = threading.Timer(self.place_window, call_soon, (self._flush,))
+        timer.daemon = True
+        timer.start()
+
+    def _flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+            self._scheduled = False
+        if not batch:
+            return
+        try:
+            self._send_batch(batch)
+        except Exception:
+            LOGGER.exception('Failed to place %d clients', len(batch))
+
+    def _send_batch(self, batch):
+        peer = self._peer
+        self._batches.observe(len(batch))
+        packet = peer._create_packet(TYPES['relay'], peer._id, peer._id,
+                                     peer._host, peer._host)
+        packet['downtype'] = TYPES['find_insert_place']
+        packet['seed_id'] = peer._id
+        packet['seed_host'] = peer._host
+        packet['clients'] = batch
+        peer._handlers._place_client(packet)
+
+    def covers(self, count):
+        '''
+        Check if bounds of the node cover a batch of clients: subtree of
+        the node takes the batch and stays no denser than the chat. Share
+        of members of a subtree of a balanced tree is equal to share of
+        ids between its bounds, so a batch that is split here keeps
+        the tree balanced, and it doesn't have to go up to the root.
+        The root covers any batch.
+
+        Args:
+            count (int) Number of clients of the batch
+        Return:
+            (bool) True if the batch can be split by the node
+        '''
+
+        peer = self._peer
+        if peer._parent is None:
+            return True
+        roster = peer._roster
+        now = time.monotonic()
+        with self._lock:
+            placing = self._in_flight('left', now) + \
+                self._in_flight('right', now)
+        size = roster.count_ids(peer.low_bound, peer.up_bound) + placing + \
+            count
+        share = (peer.up_bound - peer.low_bound) / (INF + 1)
+        return size <= share * (len(roster) + count)
+
+    def split(self, clients):
+        '''
+        Split clients between free children and subtrees of the node.
+        A client is given to the lighter side: a free child is the
+        lightest one and takes one client, a subtree takes clients until
+        all free places of it are taken. Clients that were sent to
+        a side before and haven't joined yet reserve places of it.
+
+        Return:
+            (tuple) Matching between a side and its clients, and clients
+                    that don't fit
+        '''
+
+        # Handlers of concurrent batches must not reserve one child
+        with self._lock:
+            return self._split(clients)
+
+    def _split(self, clients):
+        peer = self._peer
+        roster = peer._roster
+        now = time.monotonic()
+        weights = {}
+        free = {}
+        for side, child, low_bound, up_bound in (
+                ('left', peer._left, peer.low_bound, peer._id),
+                ('right', peer._right, peer._id, peer.up_bound)):
+            placing = self._in_flight(side, now)
+            if child is None:
+                count = 0
+            else:
+                # Ids of a subtree are between its bounds, so its size
+                # is counted by roster
+                count = roster.count_ids(low_bound, up_bound)
+            # Tree of n nodes has n + 1 free places
+            if count + 1 > placing:
+                weights[side] = count + placing
+                free[side] = count + 1 - placing
+
+        groups = {}
+        rest = []
+        for client in clients:
+            if not weights:
+                rest.append(client)
+                continue
+            # Left side is chosen if sides are equal
+            side = min(weights, key=lambda side: (weights[side],
+                                                  side != 'left'))
+            groups.setdefault(side, []).append(client)
+            weights[side] += 1
+            free[side] -= 1
+            if not free[side]:
+                del weights[side]
+        for side, group in groups.items():
+            for client in group:
+                self._placing[side][tuple(client[1])] = now + RESERVE_TTL
+        return groups, rest
+
+    def _in_flight(self, side, now):
+        '''
+        Count clients that were sent to a side and haven't joined yet.
+        A client is forgotten when it is added to roster or its
+        reservation is expired
+        '''
+
+        placing = self._placing[side]
+        connected = self._peer.connected
+        for host in [host for host, expiry in placing.items()
+                     if expiry < now or host in connected]:
+            del placing[host]
+        return len(placing)
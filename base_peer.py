@@ -5,28 +5,77 @@ of every peer-to-peer network.
 Vars:
     INTERFACES (list) List of Unix network interfaces
     BUFFER_SIZE (int) Size of receiving socket buffer
+    MAX_FRAME_SIZE (int) Default max size of one received message
 '''
 
 import os
 import socket
-import select
 import logging
-import time
 import threading
-import netifaces as nf
-import json
-import traceback
-import queue
 
-from queue import Queue
+from collections.abc import Mapping
 
-from collections import namedtuple
+from dispatch import Dispatcher, Sender
+from framing import FrameTooLarge
+from metrics import Metrics, MetricsServer
+from outbound import (OutboundBuffer, HIGH_WATER, LOW_WATER, MAX_BUFFER,
+                      BATCH_SIZE, set_nodelay)
+from pool import ConnectionPool, MAX_IDLE, CONNECT_TIMEOUT
+from reactors import REACTORS
+from wire_format import WIRE_FORMATS, PREFERRED_FORMATS, DEFAULT_FORMAT
 
 
 INTERFACES = ['eth', 'wlan', 'en', 'wl']
-BUFFER_SIZE = 1024
+BUFFER_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 16 * 1024 * 1024
 LOGGER = logging.getLogger(__name__)
-END_OF_MESSAGE = b'\r\n'
+
+
+class ConnectionIndex(dict):
+    '''
+    Matching between a host and socket of connection with it. Hosts of
+    every socket are indexed too, so a closed socket is forgotten without
+    scan of all connections. Matching is changed only by item assignment,
+    del and pop.
+
+    Fields:
+        _hosts (dict) Matching between a socket and set of its hosts
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def __setitem__(self, host, sock):
+        with self._lock:
+            self._unindex(host, super().get(host))
+            super().__setitem__(host, sock)
+            self._hosts.setdefault(sock, set()).add(host)
+
+    def __delitem__(self, host):
+        self.pop(host)
+
+    def pop(self, host, *default):
+        with self._lock:
+            if host not in self:
+                return super().pop(host, *default)
+            sock = super().pop(host)
+            self._unindex(host, sock)
+            return sock
+
+    def _unindex(self, host, sock):
+        hosts = self._hosts.get(sock)
+        if hosts is not None:
+            hosts.discard(host)
+            if not hosts:
+                del self._hosts[sock]
+
+    def hosts(self, sock):
+        ''' Get hosts whose connection is a socket '''
+
+        with self._lock:
+            return list(self._hosts.get(sock, ()))
 
 
 class BasePeer:
@@ -36,21 +85,93 @@ class BasePeer:
     Fields:
         port (int) Port for receiving connections
         _recv_sock (socket) Socket for receiving messages
-        _opened_connection (dict) Matching between a host and
-                                  socket with connection to a host
+        _opened_connection (ConnectionIndex) Matching between a host and
+                                             socket with connection to
+                                             a host
         _host (tuple) Tuple of IP and port of current machine
+        _backend (str) Name of reactor that serves sockets: select,
+                       selectors or asyncio
+        _message_data (dict) Matching between a socket that is served by
+                             reactor and its frame decoder
+        _pending_data (dict) Frame decoders of sockets that are read
+                             before they are served by reactor
+        _max_frame_size (int) Max size of one received message
+        _formats (list) Names of supported wire formats, the best first
+        _wire_formats (dict) Matching between a socket and wire format
+                             that was agreed for it. JSON is used
+                             for sockets that are not in it
+        _pool (ConnectionPool) Idle connections for greeting and
+                               temporary messages
+        _high_water (int) Size of outbound buffer of a connection after
+                          which senders are told to slow down
+        _low_water (int) Size of outbound buffer below which a connection
+                         accepts messages again
+        _max_buffer (int) Hard limit of outbound buffer of a connection
+        _batch_window (float) Max delay of outgoing message in seconds
+                              while small messages to a connection are
+                              batched. Batching is disabled if it is 0
+        _batch_size (int) Size of batch that is sent without delay
+        _dispatcher (Dispatcher) Pool of threads for slow handlers. Every
+                                 handler is run by reactor if pool is empty
+        _sender (Sender) Pool of threads for sends via pooled connections
+        _reuse_port (bool) Receiving socket is bound with SO_REUSEPORT,
+                           so several processes can listen on the port
+        metrics (Metrics) Metrics of the peer
+        _metrics_server (MetricsServer) Server that exports metrics or
+                                        None if port of it is not given
         connected (set) Set of hosts that are connected to the chat
     '''
 
-    def __init__(self, port):
+    def __init__(self, port, backend='select', max_frame_size=MAX_FRAME_SIZE,
+                 formats=None, max_idle_connections=MAX_IDLE,
+                 high_water=HIGH_WATER, low_water=LOW_WATER,
+                 max_buffer=MAX_BUFFER, batch_window=0,
+                 batch_size=BATCH_SIZE, reuse_port=False,
+                 handler_threads=0, ip=None, metrics_port=None):
         self._port = port
+        self._reuse_port = reuse_port
         self._recv_sock = self._create_recv_socket()
-        self._opened_connection = {}
+        self._opened_connection = ConnectionIndex()
+        self._message_data = {}
+        self._pending_data = {}
+        self._max_frame_size = max_frame_size
+
+        self._formats = formats or PREFERRED_FORMATS
+        self._wire_formats = {}
+
+        # Wire format and unread data of pooled connection are kept
+        # until the pool closes it
+        self._pool = ConnectionPool(max_idle_connections,
+                                    on_close=self._forget_sock)
+
+        self._high_water = high_water
+        self._low_water = low_water
+        self._max_buffer = max_buffer
+        self._batch_window = batch_window
+        self._batch_size = batch_size
+
+        self._dispatcher = Dispatcher(handler_threads)
+        self._sender = Sender()
+
+        self.metrics = Metrics()
+        self._bytes_in = self.metrics.counter('bytes_in_total')
+        self._bytes_out = self.metrics.counter('bytes_out_total')
+        self.metrics.gauge_callback('outbound_bytes', self._outbound_sizes,
+                                    'host')
+        self._metrics_server = None
+        if metrics_port is not None:
+            self._metrics_server = MetricsServer(self.metrics,
+                                                 metrics_port).start()
+
+        self._backend = backend
+        self._reactor = REACTORS[backend](self)
 
         self._init_threading_data()
 
-        self._host = (self._fetch_IP_address(), port)
-        print(self._host)
+        # Address of interface is looked up if it is not given, e.g.
+        # peers of a simulation are run on loopback
+        self._host = (ip or self._fetch_IP_address(), port)
+        LOGGER.info('Peer is bound to %s', self._host)
 
     def _init_threading_data(self):
         self._inner_workers = {}
@@ -75,24 +196,85 @@ class BasePeer:
 
         recv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         recv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self._reuse_port:
+            recv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         recv.bind(('', self._port))
-        recv.listen(5)
+        # Members of gossip and joining nodes connect in bursts
+        recv.listen(socket.SOMAXCONN)
         recv.setblocking(0)
         return recv
 
     def _send_temp_message(self, host, msg):
         ''' Used when happens greeting '''
-        # print('TEST MESSAGE')
         if host not in self._opened_connection:
             self._open_connection(host, 10)
         sock = self._opened_connection[host]
-        print('[+] Sending {} to {}'.format(repr(msg), str(host)))
-        sock.sendall(json.dumps(msg).encode() + END_OF_MESSAGE)
+        LOGGER.debug('Sending %r to %s', msg, host)
+        self._sendall(sock, msg)
         return sock
 
+    def _sendall(self, sock, msg):
+        ''' Send message via socket that is not served by reactor '''
+
+        data = self._pack(sock, msg)
+        sock.sendall(data)
+        self._bytes_out.inc(len(data))
+
+    async def _sendall_async(self, sock, msg):
+        ''' Coroutine version of _sendall for asyncio backend '''
+
+        data = self._pack(sock, msg)
+        await self._reactor.loop.sock_sendall(sock, data)
+        self._bytes_out.inc(len(data))
+
     def _close_connection(self, host):
-        self._opened_connection[host].close()
-        del self._opened_connection[host]
+        sock = self._opened_connection.pop(host)
+        self._pool.discard(sock)
+
+    def _release_connection(self, host):
+        ''' Return connection with a host to the pool for reuse '''
+
+        self._pool.put(host, self._opened_connection.pop(host))
+
+    def _forget_sock(self, sock):
+        ''' Remove data of socket that is not served by reactor '''
+
+        self._pending_data.pop(sock, None)
+        self._wire_formats.pop(sock, None)
+
+    def _get_wire_format(self, sock):
+        return self._wire_formats.get(sock, WIRE_FORMATS[DEFAULT_FORMAT])
+
+    def _set_wire_format(self, sock, name):
+        '''
+        Switch socket to agreed wire format. Data that is received
+        but not decoded yet is decoded with new format.
+        '''
+
+        wire_format = WIRE_FORMATS[name]
+        if self._get_wire_format(sock) is wire_format:
+            return
+        self._wire_formats[sock] = wire_format
+        for decoders in (self._pending_data, self._message_data):
+            if sock in decoders:
+                decoders[sock] = decoders[sock].with_framing(
+                    wire_format.decoder_cls)
+
+    def _pack(self, sock, packet):
+        ''' Encode packet with wire format of socket '''
+
+        return self._get_wire_format(sock).pack(packet)
+
+    def _unpack(self, sock, frame):
+        ''' Decode packet with wire format of socket '''
+
+        return self._get_wire_format(sock).unpack(frame)
+
+    def _check_wire_format(self, sock, resp):
+        ''' Switch socket to wire format if response contains it '''
+
+        if isinstance(resp, Mapping) and resp.get('format') in WIRE_FORMATS:
+            self._set_wire_format(sock, resp['format'])
 
     def _open_connection(self, host, timeout=2):
         '''
@@ -105,116 +287,259 @@ class BasePeer:
         '''
 
         try:
-            send_sock = self._create_send_socket(timeout)
-            send_sock.connect(host)
-            self._opened_connection[host] = send_sock
+            self._opened_connection[host] = self._pool.connect(host, timeout)
             return True
         except socket.error as e:
             return False
 
+    def _create_decoder(self, sock):
+        return self._get_wire_format(sock).create_decoder(
+            self._max_frame_size, BUFFER_SIZE)
+
+    def _get_decoder(self, sock):
+        ''' Get frame decoder of socket that is not served by reactor '''
+
+        decoder = self._pending_data.get(sock)
+        if decoder is None:
+            decoder = self._pending_data[sock] = self._create_decoder(sock)
+        return decoder
+
     def _get_response(self, sock):
-        resp = ''
-        end_msg = END_OF_MESSAGE.decode()
-        while True:
-            data = sock.recv(BUFFER_SIZE).decode()
-            resp += data
-            if end_msg in data:
-                break
-        data = json.loads(resp)
-        print('[+] Received: %s from %s\n' % (data, str(data['from_host'])))
+        decoder = self._get_decoder(sock)
+        resp = decoder.next_frame()
+        while resp is None:
+            nbytes = decoder.recv_from(sock)
+            if not nbytes:
+                raise ConnectionError('Connection is closed by remote host')
+            self._bytes_in.inc(nbytes)
+            resp = decoder.next_frame()
+        data = self._unpack(sock, resp)
+        self._check_wire_format(sock, data)
+        LOGGER.debug('Received %r from %s', data, data['from_host'])
         return data
 
+    async def _open_connection_async(self, host):
+        ''' Coroutine version of _open_connection for asyncio backend '''
+
+        try:
+            self._opened_connection[host] = \
+                await self._pool_connect_async(host)
+            return True
+        except socket.error as e:
+            return False
+
+    async def _pool_connect_async(self, host):
+        ''' Coroutine version of ConnectionPool.connect '''
+
+        send_sock = self._pool.get(host)
+        if send_sock is not None:
+            send_sock.setblocking(0)
+            return send_sock
+        send_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        send_sock.setblocking(0)
+        try:
+            await self._reactor.loop.sock_connect(send_sock, host)
+        except socket.error:
+            send_sock.close()
+            raise
+        return send_sock
+
+    async def _send_temp_message_async(self, host, msg):
+        ''' Coroutine version of _send_temp_message for asyncio backend '''
+
+        if host not in self._opened_connection:
+            await self._open_connection_async(host)
+        sock = self._opened_connection[host]
+        LOGGER.debug('Sending %r to %s', msg, host)
+        await self._sendall_async(sock, msg)
+        return sock
+
+    async def _get_response_async(self, sock):
+        ''' Coroutine version of _get_response for asyncio backend '''
+
+        decoder = self._get_decoder(sock)
+        resp = decoder.next_frame()
+        while resp is None:
+            nbytes = 0
+            try:
+                nbytes = await self._reactor.loop.sock_recv_into(
+                    sock, decoder.get_buffer())
+            finally:
+                decoder.buffer_updated(nbytes)
+            if not nbytes:
+                raise ConnectionError('Connection is closed by remote host')
+            self._bytes_in.inc(nbytes)
+            resp = decoder.next_frame()
+        data = self._unpack(sock, resp)
+        self._check_wire_format(sock, data)
+        LOGGER.debug('Received %s', data)
+        return data
+
+    def _create_outbound_buffer(self):
+        return OutboundBuffer(self._high_water, self._low_water,
+                              self._max_buffer, self._batch_window,
+                              self._batch_size)
+
+    def _outbound_sizes(self):
+        '''
+        Get sizes of outbound buffers of connections that are served
+        by reactor. A connection is named by its host, or by descriptor
+        if it is not a connection with a node.
+
+        Return:
+            (dict) Matching between a host and size of buffer in bytes
+        '''
+
+        sizes = {}
+        for sock, size in self._reactor.outbound_sizes():
+            hosts = self._opened_connection.hosts(sock)
+            sizes['%s:%d' % hosts[0] if hosts else
+                  'fd %d' % sock.fileno()] = size
+        return sizes
+
     def _add_message2send(self, sock, msg):
-        if sock not in self._outputs:
-            self._outputs.append(sock)
-        self._message_queues[sock].put(msg)
+        '''
+        Return:
+            (bool) False if connection is paused, so a sender should slow
+                   down, None if message is dropped
+        '''
+        if msg is None:
+            return True
+        return self._reactor.send(sock, msg)
+
+    def _send_reply(self, host, msg):
+        '''
+        Send message to a host via opened connection with it. If there is
+        no one then pooled connection is used. It is sent by sender, since
+        connecting blocks the thread.
+        '''
+
+        sock = self._opened_connection.get(host)
+        if sock in self._message_data:
+            LOGGER.debug('Sending %r to %s', msg, host)
+            self._reactor.send(sock, self._pack(sock, msg))
+        elif sock is not None:
+            self._send_temp_message(host, msg)
+        else:
+            self._sender.submit(host, self._send_pooled, host, msg)
+
+    def _send_pooled(self, host, msg, timeout=CONNECT_TIMEOUT):
+        ''' Send message to a host via pooled connection '''
+
+        sock = self._pool.connect(host, timeout)
+        LOGGER.debug('Sending %r to %s', msg, host)
+        try:
+            self._sendall(sock, msg)
+        except socket.error:
+            self._pool.discard(sock)
+            raise
+        self._pool.put(host, sock)
 
     def _accept_conn(self, sock):
         sock.setblocking(0)
-        self._inputs.append(sock)
-        self._message_data[sock] = b''
-        self._message_queues[sock] = Queue()
+        set_nodelay(sock)
+        # Data that was read during greeting stays in the decoder
+        decoder = self._pending_data.pop(sock, None)
+        self._message_data[sock] = decoder or self._create_decoder(sock)
+        self._reactor.register(sock)
+        if decoder is not None and len(decoder):
+            self._reactor.call_soon(self._process_frames, sock)
+
+    def _adopt_conn(self, sock, wire_format, data):
+        '''
+        Serve connection that was accepted by another process
 
-    def _handle_recv(self):
-        ''' Non-blocking handling of received data '''
-
-        inputs = [self._recv_sock]
-        outputs = []
-        message_data = {}
-        message_queues = {}
-
-        self._inputs = inputs
-        self._outputs = outputs
-        self._message_data = message_data
-        self._message_queues = message_queues
-
-        while self._is_handle_recv:
-            print('\n[*] Waiting for the next event')
-            readable, writable, exceptional = select.select(inputs, outputs,
-                                                            inputs, 2)
-            self._process_readable_sock(inputs, outputs,
-                                        message_data, readable)
-            self._process_writable_sock(inputs, outputs,
-                                        message_data, writable)
-            # TODO PROCESS ERRORS WITH SOCKETS
-
-    def _process_readable_sock(self, inputs, outputs, message_data, readable):
-        ''' Process sockets that ready for reading '''
-
-        for sock in readable:
-            if sock is self._recv_sock:
-                conn, addr = sock.accept()
-                print('[*] New connection from %s' % str(addr))
-                self._accept_conn(conn)
-            else:
-                data = sock.recv(BUFFER_SIZE)
-                if data:
-                    print('[+] Received {} from {}'
-                          .format(repr(data.decode()), str(sock.getpeername())))
-                    message_data[sock] += data
-                    if END_OF_MESSAGE in data:
-                        if sock not in outputs:
-                            outputs.append(sock)
-                        req = message_data[sock].decode()
-                        message_data[sock] = b''
-
-                        packet = self._update_opened_connection(req, sock)
-                        self._message_queues[sock].put(self._process_request(packet, True))
-                else:
-                    self._close_sock(sock)
+        Args:
+            wire_format (str) Name of wire format that was agreed for it
+            data (bytes) Data that was received but not processed yet
+        '''
 
-    def _close_sock(self, sock):
-        print('[+] Closing {} after reading no data'
-              .format(str(sock.getpeername())))
-        if sock in self._outputs:
-            self._outputs.remove(sock)
+        self._set_wire_format(sock, wire_format)
+        self._get_decoder(sock).feed(data)
+        self._accept_conn(sock)
 
-        self._inputs.remove(sock)
-        sock.close()
+    def _handle_recv(self):
+        ''' Run reactor that handles received data '''
 
-        del self._message_data[sock]
-        del self._message_queues[sock]
+        self._reactor.run()
 
-    def _process_writable_sock(self, inputs, outputs, message_data, writable):
-        ''' Process sockets that ready for writing '''
+    def _read_sock(self, sock):
+        ''' Read data from socket that is ready for reading '''
 
-        for sock in writable:
-            try:
-                next_msg = self._message_queues[sock].get_nowait()
-            except queue.Empty:
-                print('[*] Output queue for {} is empty'
-                      .format(str(sock.getpeername())))
-                outputs.remove(sock)
-            else:
-                if next_msg == b'""' + END_OF_MESSAGE:
+        try:
+            nbytes = self._message_data[sock].recv_from(sock)
+        except BlockingIOError:
+            return
+        if nbytes:
+            self._bytes_in.inc(nbytes)
+            self._process_frames(sock)
+        else:
+            self._close_sock(sock)
+
+    def _process_frames(self, sock):
+        ''' Process every complete message that was received from socket '''
+
+        # Frames are processed after the request that is being handled
+        if self._dispatcher.is_busy(sock):
+            return
+        try:
+            # Decoder is fetched every time since wire format of
+            # the connection can be changed by a request
+            while sock in self._message_data:
+                req = self._message_data[sock].next_frame()
+                if req is None:
+                    break
+                LOGGER.debug('Received %r', req)
+                packet = self._update_opened_connection(req, sock)
+                if self._is_duplicate(packet):
                     continue
-                print('[+] Sending {} to {}'
-                      .format(repr(next_msg.decode()),
-                              str(sock.getpeername())))
-                sock.sendall(next_msg)
+                if self._dispatcher and self._is_offloaded(packet):
+                    self._dispatcher.submit(sock, self._handle_offloaded,
+                                            sock, packet)
+                    break
+                self._add_message2send(sock, self._process_request(packet,
+                                                                   True, sock))
+        except FrameTooLarge as e:
+            LOGGER.warning('Closing connection: %s', e)
+            self._close_sock(sock)
+
+    def _is_duplicate(self, packet):
+        ''' Check if packet was received before, so it is dropped '''
+
+        return False
+
+    def _is_offloaded(self, packet):
+        ''' Check if request should be handled on the pool of threads '''
+
+        return False
+
+    def _handle_offloaded(self, sock, packet):
+        ''' Handle request on the pool of threads '''
+
+        try:
+            self._add_message2send(sock, self._process_request(packet,
+                                                               True, sock))
+        finally:
+            self._reactor.call_soon(self._resume_frames, sock)
+
+    def _resume_frames(self, sock):
+        self._dispatcher.release(sock)
+        if sock in self._message_data:
+            self._process_frames(sock)
+
+    def _close_sock(self, sock):
+        if sock not in self._message_data:
+            return
+        LOGGER.debug('Closing %s', sock)
+        del self._message_data[sock]
+        self._dispatcher.release(sock)
+        self._forget_sock(sock)
+        for host in self._opened_connection.hosts(sock):
+            del self._opened_connection[host]
+        self._reactor.unregister(sock)
 
     def _update_opened_connection(self, req, sock):
-        packet = json.loads(req)
+        packet = self._unpack(sock, req)
         _type = packet['type']
         from_host = tuple(packet['from_host'])
         is_host_in = from_host not in self._opened_connection
@@ -223,6 +548,9 @@ class BasePeer:
         return packet
 
     def _fetch_IP_address(self):
+        # netifaces is not needed if address of peer is given
+        import netifaces as nf
+
         os_name = os.name
         for glob_if in nf.interfaces():
             try:
@@ -0,0 +1,98 @@
+'''
+Benchmark of roster. It reports memory that is taken per member of
+the chat, so nodes can be sized for a number of members, and compares
+it with "legacy" roster: dicts of members, a separate matching between
+ids and hosts and snapshots that are copies of dicts. Also it measures
+time of building of a snapshot and of encoding of a chat_info page.
+
+Usage:
+    python benchmarks/bench_roster.py [--members N] [--page N]
+'''
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from roster import Roster, Member
+from wire_format import WIRE_FORMATS
+
+
+def make_roster(members):
+    roster = Roster()
+    for i in range(members):
+        host = ('10.%d.%d.%d' % (i // 65536, i // 256 % 256, i % 256), 8000)
+        roster.add(Member(10000000000 + i, host, 'user%d' % i))
+    return roster
+
+
+def legacy_memory(roster):
+    ''' Size of the same members in the legacy layout '''
+
+    seen = set()
+    total = 0
+
+    def count(obj):
+        nonlocal total
+        if id(obj) not in seen:
+            seen.add(id(obj))
+            total += sys.getsizeof(obj)
+
+    members = {}
+    id2host = {}
+    for member in roster.members.values():
+        members[member.host] = {'id': member.id, 'host': member.host,
+                                'username': member.username}
+        id2host[member.id] = member.host
+    snapshot = [dict(data) for data in members.values()]
+    count(members)
+    count(id2host)
+    count(snapshot)
+    for data in list(members.values()) + snapshot:
+        count(data)
+        for obj in (data['id'], data['host'], data['username']) + data['host']:
+            count(obj)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--members', type=int, default=100000,
+                        help='Number of members in roster')
+    parser.add_argument('--page', type=int, default=1000,
+                        help='Number of members in chat_info page')
+    args = parser.parse_args()
+
+    roster = make_roster(args.members)
+    _, members = roster.snapshot()
+    memory = roster.memory()
+    legacy = legacy_memory(roster)
+    print('{:<8} {:>10} {:>14} {:>18}'
+          .format('roster', 'members', 'total, MB', 'per member, bytes'))
+    print('{:<8} {:>10} {:>14.1f} {:>18.0f}'
+          .format('legacy', args.members, legacy / 2 ** 20,
+                  legacy / args.members))
+    print('{:<8} {:>10} {:>14.1f} {:>18.0f}'
+          .format('slots', memory['members'], memory['bytes'] / 2 ** 20,
+                  memory['bytes_per_member']))
+
+    def snapshot():
+        roster._snapshots.clear()
+        roster.snapshot()
+
+    print('\nsnapshot of {} members: {:.2f} ms'.format(
+        args.members, timeit.timeit(snapshot, number=10) / 10 * 1e3))
+    packet = {'type': 'chat_info', 'from_id': 1, 'to_id': -1,
+              'from_host': ('127.0.0.1', 8000), 'to_host': ('127.0.0.1', 8001),
+              'connected': members[:args.page]}
+    for wire_format in WIRE_FORMATS.values():
+        encode_time = timeit.timeit(lambda: wire_format.pack(packet),
+                                    number=100) / 100
+        print('chat_info page of {} members, {}: {:.2f} ms'
+              .format(args.page, wire_format.name, encode_time * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+'''
+Benchmark of wire formats. For every available format it measures
+time of encoding and decoding of typical packets and their size
+on the wire. "legacy" is the encoding that was used before wire
+formats: json.dumps with default separators and END_OF_MESSAGE.
+Also it compares encoding of new_user broadcast for three neighbors
+with a template against encoding of the whole packet per neighbor,
+and measures a relay hop of a message: decoding, rewriting of
+a sender and a receiver and encoding again.
+
+Usage:
+    python benchmarks/bench_wire_format.py [--members N] [--number N]
+'''
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from framing import FrameDecoder, END_OF_MESSAGE
+from roster import Member
+from wire_format import WIRE_FORMATS, WireFormat
+
+
+class LegacyCodec:
+    def encode(self, packet):
+        return json.dumps(packet, default=Member.to_dict).encode()
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+LEGACY_FORMAT = WireFormat('legacy', LegacyCodec(), FrameDecoder,
+                           lambda payload: payload + END_OF_MESSAGE)
+
+
+def make_packets(members):
+    ''' Form packets that are the most frequent on relay-heavy nodes '''
+
+    host = ['192.168.100.100', 8000]
+    user = {'id': 52395812374, 'host': host, 'username': 'user'}
+    new_user = {'type': 'new_user', 'from_id': 52395812374,
+                'to_id': 81238561232, 'from_host': host, 'to_host': host,
+                'broadcast': {'from_node_side': 'parent', 'user_info': user}}
+    message = {'type': 'relay', 'from_id': 52395812374, 'to_id': 81238561232,
+               'from_host': host, 'to_host': host, 'downtype': 'message',
+               'text': 'Lorem ipsum dolor sit amet ' * 40}
+    relay = {'type': 'relay', 'from_id': 52395812374, 'to_id': 81238561232,
+             'from_host': host, 'to_host': host, 'downtype': 'find_insert_place',
+             'client_id': 23958123746, 'client_host': host}
+    chat_info = {'type': 'chat_info', 'from_id': 52395812374, 'to_id': -1,
+                 'from_host': host, 'to_host': host,
+                 'connected': [Member(10000000000 + i,
+                                      ('10.0.%d.%d' % (i // 256, i % 256),
+                                       8000),
+                                      'user%d' % i)
+                               for i in range(members)]}
+    return {'new_user': new_user, 'relay': relay, 'chat_info': chat_info,
+            'message': message}
+
+
+def bench_format(wire_format, packet, number):
+    data = wire_format.pack(packet)
+    decoder = wire_format.create_decoder(len(data) + 16, len(data) + 16)
+
+    def decode():
+        decoder.feed(data)
+        return wire_format.unpack(decoder.next_frame())
+
+    encode_time = timeit.timeit(lambda: wire_format.pack(packet),
+                                number=number) / number
+    decode_time = timeit.timeit(decode, number=number) / number
+    return len(data), encode_time, decode_time
+
+
+def bench_broadcast(wire_format, packet, number):
+    neighbors = [(81238561232 + i, ['192.168.100.%d' % i, 8000], 'parent')
+                 for i in range(3)]
+
+    def per_neighbor():
+        for to_id, to_host, side in neighbors:
+            packet['to_id'] = to_id
+            packet['to_host'] = to_host
+            packet['broadcast']['from_node_side'] = side
+            wire_format.pack(packet)
+
+    def template():
+        template = wire_format.broadcast_template(packet)
+        for neighbor in neighbors:
+            template.pack(*neighbor)
+
+    return (timeit.timeit(per_neighbor, number=number) / number,
+            timeit.timeit(template, number=number) / number)
+
+
+def bench_relay(wire_format, packet, number):
+    ''' Time of a relay hop that reads only header of packet '''
+
+    data = wire_format.codec.encode(packet)
+
+    def relay():
+        received = wire_format.unpack(data)
+        received['from_id'], received['to_id'] = \
+            received['to_id'], received['from_id']
+        wire_format.pack(received)
+
+    return timeit.timeit(relay, number=number) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--members', type=int, default=1000,
+                        help='Number of members in chat_info packet')
+    parser.add_argument('--number', type=int, default=2000,
+                        help='Number of runs of every measurement')
+    args = parser.parse_args()
+
+    packets = make_packets(args.members)
+    print('{:<10} {:<8} {:>10} {:>12} {:>12}'
+          .format('packet', 'format', 'bytes', 'encode, us', 'decode, us'))
+    for name, packet in packets.items():
+        number = args.number if name != 'chat_info' else args.number // 100 or 1
+        base = None
+        for wire_format in [LEGACY_FORMAT] + list(WIRE_FORMATS.values()):
+            size, enc, dec = bench_format(wire_format, packet, number)
+            base = base or (size, enc, dec)
+            print('{:<10} {:<8} {:>10} {:>12.2f} {:>12.2f}   '
+                  '({:.0%} bytes, {:.0%} cpu of legacy)'
+                  .format(name, wire_format.name, size, enc * 1e6, dec * 1e6,
+                          size / base[0], (enc + dec) / (base[1] + base[2])))
+
+    print('\n{:<10} {:<8} {:>16} {:>16}'
+          .format('broadcast', 'format', 'per neighbor, us', 'template, us'))
+    for wire_format in WIRE_FORMATS.values():
+        full, template = bench_broadcast(wire_format, packets['new_user'],
+                                         args.number)
+        print('{:<10} {:<8} {:>16.2f} {:>16.2f}'
+              .format('new_user', wire_format.name, full * 1e6,
+                      template * 1e6))
+
+    print('\n{:<10} {:<8} {:>16}'.format('relay hop', 'format', 'time, us'))
+    for wire_format in [LEGACY_FORMAT] + list(WIRE_FORMATS.values()):
+        hop = bench_relay(wire_format, packets['message'], args.number)
+        print('{:<10} {:<8} {:>16.2f}'
+              .format('message', wire_format.name, hop * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,459 @@
+'''
+Simulator of the chat. It runs a number of BinaryTreePeer nodes
+on loopback in one process, joins them to one chat and measures:
+
+    - latency of joining of every node
+    - convergence of new_user broadcast: time from start of joining
+      until every node of the chat knows the new member
+    - hops and latency of messages between random nodes
+    - CPU time of reactor threads and memory per node
+    - bytes on the wire by type of packet
+    - metrics of the seed node
+    - nodes that add the most delay to traced packets, if tracing is on
+
+Report is written as JSON, so runs can be compared to catch
+regressions of handling of received data, handlers and framing.
+
+The select backend can't serve file descriptors above FD_SETSIZE (1024),
+so runs of hundreds of nodes, or of tens of nodes with gossip, need
+selectors or asyncio backend.
+
+Nodes listen on consecutive ports from --port. By default they are
+below the ephemeral range of Linux (32768-60999), so outgoing
+connections of nodes don't take ports that nodes listen on.
+
+Usage:
+    python benchmarks/simulator.py [--peers N] [--backend NAME]
+                                   [--format NAME] [--messages N]
+                                   [--concurrency N] [--gossip TYPES]
+                                   [--report PATH]
+'''
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+import traceback
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import PLACE_WINDOW
+from bst_peer import BinaryTreePeer
+from gossip import FANOUT, GOSSIP_INTERVAL
+from handlers import TYPES
+from wire_format import WIRE_FORMATS, PREFERRED_FORMATS
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+LOOPBACK = '127.0.0.1'
+SETTLE_TIMEOUT = 10
+DEFAULT_PORT = 20000
+MAX_PORT = 65535
+
+
+class SimPeer(BinaryTreePeer):
+    '''
+    Peer that reports its events to simulation
+
+    Fields:
+        bytes_in (Counter) Received bytes by type of packet. Relayed
+                           packets are counted by their downtype
+        _sim (Simulation) Simulation that the peer belongs to
+    '''
+
+    def __init__(self, sim, port, **kwargs):
+        self._sim = sim
+        self.bytes_in = Counter()
+        super().__init__(port, ip=LOOPBACK, **kwargs)
+
+    def _unpack(self, sock, frame):
+        packet = super()._unpack(sock, frame)
+        wire_format = self._get_wire_format(sock)
+        _type = packet['type']
+        if _type == TYPES['relay']:
+            _type += '/' + packet['downtype']
+        # Counters are updated by greeting threads too, a lost update
+        # is not worth a lock here
+        self.bytes_in[_type] += len(frame) + len(wire_format.frame(b''))
+        return packet
+
+    def _add_host(self, host, data):
+        super()._add_host(host, data)
+        self._sim.member_added(self, host)
+
+    def _store_message(self, packet):
+        super()._store_message(packet)
+        self._sim.message_passed(packet)
+
+    def reactor_thread(self):
+        return self._inner_workers.get('_handle_recv')
+
+
+class Simulation:
+    '''
+    Chat of SimPeer nodes
+
+    Fields:
+        peers (list) Joined nodes, the seed first
+        _joins (dict) Matching between host of joining node and start
+                      of its joining with ports of nodes that don't
+                      know it yet
+        _convergence (list) Times of convergence of new_user broadcasts
+        _hops (int) Number of nodes that relayed the measured message
+        _delivered (Event) Set when the measured message is delivered
+    '''
+
+    def __init__(self, args):
+        self._args = args
+        self.peers = []
+        self._lock = threading.Lock()
+        self._joins = {}
+        self._converged = threading.Condition(self._lock)
+        self._convergence = []
+        self._hops = 0
+        self._delivered = threading.Event()
+        self._delivered_at = None
+
+    def _create_peer(self, port, server_host=None):
+        args = self._args
+        return SimPeer(self, port, server_host=server_host,
+                       backend=args.backend, formats=[args.format],
+                       heartbeat_interval=args.heartbeat,
+                       trace_rate=args.trace_rate,
+                       gossip_types=args.gossip, gossip_fanout=args.fanout,
+                       gossip_interval=args.gossip_interval,
+                       place_window=args.place_window)
+
+    def member_added(self, peer, host):
+        with self._lock:
+            join = self._joins.get(host)
+            if join is None:
+                return
+            join[1].discard(peer._port)
+            if not join[1]:
+                self._convergence.append(time.perf_counter() - join[0])
+                del self._joins[host]
+                self._converged.notify_all()
+
+    def message_passed(self, packet):
+        if packet['type'] == TYPES['message']:
+            self._delivered_at = time.perf_counter()
+            self._delivered.set()
+        else:
+            self._hops += 1
+
+    def join(self, port):
+        '''
+        Join a node to the chat
+
+        Return:
+            (float) Latency of joining or None if joining is failed
+        '''
+
+        entry = self.peers[0] if self._args.entry == 'seed' \
+            else random.choice(self.peers)
+        peer = self._create_peer(port, entry._host)
+        with self._lock:
+            # Nodes that join at the same time may not learn about
+            # each other from broadcasts, they are not waited for
+            known = {node._port for node in self.peers}
+            known.add(port)
+            start = time.perf_counter()
+            self._joins[peer._host] = (start, known)
+        try:
+            peer.start()
+        except Exception:
+            with self._lock:
+                self._joins.pop(peer._host, None)
+            return None
+        latency = time.perf_counter() - start
+        with self._lock:
+            self.peers.append(peer)
+        return latency
+
+    def run_joins(self):
+        args = self._args
+        seed = self._create_peer(args.port)
+        seed.start()
+        self.peers.append(seed)
+
+        ports = range(args.port + 1, args.port + args.peers)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            latencies = list(executor.map(self.join, ports))
+        duration = time.perf_counter() - start
+
+        with self._lock:
+            self._converged.wait_for(lambda: not self._joins, SETTLE_TIMEOUT)
+            pending = len(self._joins)
+            self._joins.clear()
+        joined = [latency for latency in latencies if latency is not None]
+        return {
+            'joined': len(joined),
+            'failed': len(latencies) - len(joined),
+            'duration_s': duration,
+            'joins_per_s': len(joined) / duration if duration else None,
+            'latency_ms': _percentiles(joined, 1e3),
+        }, {
+            'converged': len(self._convergence),
+            'pending': pending,
+            'convergence_ms': _percentiles(self._convergence, 1e3),
+        }
+
+    def send(self, src, dst, seq):
+        '''
+        Send message and wait until it is delivered
+
+        Return:
+            (tuple) Latency and number of hops or None if message is lost
+        '''
+
+        packet = src._create_packet(TYPES['relay'], src._id, dst._id,
+                                    src._host, dst._host)
+        packet['downtype'] = TYPES['message']
+        packet['seq'] = seq
+        packet['text'] = 'x' * self._args.message_size
+        self._hops = 0
+        self._delivered.clear()
+        start = time.perf_counter()
+        # Message is sent from reactor thread, as a handler would do it
+        src._reactor.call_soon(src.send_message, dst._host, packet)
+        if not self._delivered.wait(SETTLE_TIMEOUT):
+            return None
+        return self._delivered_at - start, self._hops + 1
+
+    def run_messages(self):
+        rand = random.Random(self._args.seed)
+        latencies = []
+        per_hop = []
+        hops = Counter()
+        lost = 0
+        for seq in range(self._args.messages):
+            src, dst = rand.sample(self.peers, 2)
+            result = self.send(src, dst, seq)
+            if result is None:
+                lost += 1
+                continue
+            latency, count = result
+            latencies.append(latency)
+            per_hop.append(latency / count)
+            hops[count] += 1
+        total = sum(hops.values())
+        return {
+            'messages': self._args.messages,
+            'lost': lost,
+            'hops': {
+                'mean': sum(k * v for k, v in hops.items()) / total
+                        if total else None,
+                'max': max(hops) if hops else None,
+                'histogram': {str(k): hops[k] for k in sorted(hops)},
+            },
+            'latency_ms': _percentiles(latencies, 1e3),
+            'per_hop_ms': _percentiles(per_hop, 1e3),
+        }
+
+    def wire_bytes(self):
+        total = Counter()
+        for peer in self.peers:
+            total.update(peer.bytes_in)
+        return total
+
+    def slowest_nodes(self, count=5):
+        '''
+        Find nodes that add the most delay to traced packets: delay of
+        a hop is counted to the node that received the packet
+
+        Return:
+            (list) Ids of nodes with mean delay in microseconds and number
+                   of hops, the slowest first
+        '''
+
+        delays = {}
+        for peer in self.peers:
+            for trace in peer.traces():
+                for hop in trace['path'][1:]:
+                    delays.setdefault(hop['node'], []).append(hop['delay'])
+        nodes = [{'node': node, 'mean_delay_us': sum(values) / len(values),
+                  'hops': len(values)}
+                 for node, values in delays.items()]
+        nodes.sort(key=lambda node: node['mean_delay_us'], reverse=True)
+        return nodes[:count]
+
+    def cpu(self):
+        reactors = [_thread_cpu(peer.reactor_thread()) for peer in self.peers]
+        reactors = [cpu for cpu in reactors if cpu is not None]
+        return {
+            'process_s': time.process_time(),
+            'reactor_s': _percentiles(reactors),
+            'seed_reactor_s': reactors[0] if reactors else None,
+        }
+
+
+def _percentiles(values, scale=1):
+    if not values:
+        return {}
+    values = sorted(value * scale for value in values)
+
+    def at(q):
+        return values[min(int(q * len(values)), len(values) - 1)]
+
+    return {'mean': sum(values) / len(values), 'p50': at(0.5),
+            'p90': at(0.9), 'p99': at(0.99), 'max': values[-1]}
+
+
+def _thread_cpu(thread):
+    '''
+    Get CPU time of a thread of current process from /proc
+
+    Return:
+        (float) User and system time in seconds or None if it is unknown
+    '''
+
+    if thread is None or getattr(thread, 'native_id', None) is None:
+        return None
+    try:
+        with open('/proc/self/task/%d/stat' % thread.native_id) as stat:
+            fields = stat.read().rpartition(')')[2].split()
+    except OSError:
+        return None
+    # utime and stime are 14th and 15th fields, counted from the state
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def _max_rss():
+    ''' Peak resident memory of the process in KB '''
+
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _raise_open_files_limit():
+    ''' Every node takes several sockets '''
+
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--peers', type=int, default=100,
+                        help='Number of nodes in the chat')
+    parser.add_argument('--backend', default='selectors',
+                        choices=['select', 'selectors', 'asyncio'],
+                        help='Reactor of nodes')
+    parser.add_argument('--format', default=PREFERRED_FORMATS[0],
+                        choices=list(WIRE_FORMATS),
+                        help='Wire format of nodes')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='Port of the seed, other nodes take next ones')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Number of nodes that join at the same time')
+    parser.add_argument('--entry', default='seed', choices=['seed', 'random'],
+                        help='Node that joining nodes connect to')
+    parser.add_argument('--messages', type=int, default=200,
+                        help='Number of messages between random nodes')
+    parser.add_argument('--message-size', type=int, default=100,
+                        help='Size of text of message in bytes')
+    parser.add_argument('--heartbeat', type=float, default=0,
+                        help='Interval of heartbeats, 0 disables them')
+    parser.add_argument('--trace-rate', type=float, default=0,
+                        help='Share of packets that nodes trace')
+    parser.add_argument('--gossip', nargs='*', default=[],
+                        choices=[TYPES['new_user'], TYPES['disconnect']],
+                        help='Types of broadcasts that are spread by gossip')
+    parser.add_argument('--fanout', type=int, default=FANOUT,
+                        help='Number of members that gossip is pushed to')
+    parser.add_argument('--gossip-interval', type=float,
+                        default=GOSSIP_INTERVAL,
+                        help='Interval of digests of gossip in seconds')
+    parser.add_argument('--place-window', type=float, default=PLACE_WINDOW,
+                        help='Time that the seed collects requests for '
+                             'place to a batch')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of random choice of nodes')
+    parser.add_argument('--report', default='simulation.json',
+                        help='Path of JSON report')
+    args = parser.parse_args()
+    if not 0 < args.port <= args.port + args.peers - 1 <= MAX_PORT:
+        parser.error('ports of nodes must be in range 1-%d' % MAX_PORT)
+    # Reactor threads of nodes are not daemons and nodes can't be
+    # stopped, so process is stopped at once
+    try:
+        simulate(args)
+    except BaseException:
+        traceback.print_exc()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(1)
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def simulate(args):
+    random.seed(args.seed)
+    _raise_open_files_limit()
+    sim = Simulation(args)
+    rss = _max_rss()
+
+    join, broadcast = sim.run_joins()
+    join_bytes = sim.wire_bytes()
+    rss_joined = _max_rss()
+    relay = sim.run_messages()
+    total_bytes = sim.wire_bytes()
+
+    seed_roster = sim.peers[0]._roster.memory()
+    report = {
+        'config': dict(vars(args), python=platform.python_version(),
+                       platform=sys.platform),
+        'join': join,
+        'broadcast': broadcast,
+        'relay': relay,
+        'cpu': sim.cpu(),
+        'memory': {
+            'rss_per_node_kb': (rss_joined - rss) / len(sim.peers)
+                               if rss is not None else None,
+            'roster_bytes_per_node': seed_roster['bytes'],
+        },
+        'wire': {
+            'join': dict(join_bytes),
+            'messages': dict(total_bytes - join_bytes),
+            'total_bytes': sum(total_bytes.values()),
+        },
+        'seed_metrics': sim.peers[0].metrics.snapshot(),
+        'slowest_nodes': sim.slowest_nodes(),
+    }
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    print('nodes {}, joined {} in {:.2f} s, p99 {:.1f} ms'
+          .format(len(sim.peers), join['joined'], join['duration_s'],
+                  join['latency_ms'].get('p99', 0)))
+    print('new_user convergence p99 {:.1f} ms, pending {}'
+          .format(broadcast['convergence_ms'].get('p99', 0),
+                  broadcast['pending']))
+    print('messages {}, lost {}, mean hops {}, latency p99 {:.2f} ms'
+          .format(relay['messages'], relay['lost'], relay['hops']['mean'],
+                  relay['latency_ms'].get('p99', 0)))
+    print('report is written to %s' % args.report)
+
+
+if __name__ == '__main__':
+    main()
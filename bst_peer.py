@@ -6,29 +6,108 @@ structured peer-to-peer network
 
 import socket
 import logging
-import json
-import traceback
-
-from base_peer import BasePeer, END_OF_MESSAGE
+import threading
+import time
+
+from admission import Admission, SNAPSHOT_WINDOW, PLACE_WINDOW, INF
+from base_peer import BasePeer
+from db_helper import DBHelper
+from failure import FailureDetector, HEARTBEAT_INTERVAL
+from gossip import Gossip, FANOUT, GOSSIP_INTERVAL
 from handlers import Handlers, TYPES
+from handshake import Handshake, TIMEOUT, RETRIES, CONNECTING
+from outbox import Outbox, QUEUE_TTL
+from packet import Packet
+from repair import Repair
+from roster import Roster, Member, HostIndex
+from routing import RoutingTable, MAX_SHORTCUTS
+from seen_cache import SeenCache, SEEN_SIZE, SEEN_TTL
+from tracing import Tracer, TRACE_BUFFER
 
-from random import randint
+from collections.abc import Mapping
+from concurrent.futures import Future
+from random import randint, getrandbits
 
 
 LOGGER = logging.getLogger(__name__)
 DOWN = int(1e10)
 UP = int(9e10)
-INF = 1e11
 SUCCESS_CONN = 'OK'
+ROSTER_PAGE_SIZE = 1000
+
+
+def _link(name):
+    ''' Attribute of node that invalidates routing table on change '''
+
+    attr = '_link_' + name
+
+    def fget(self):
+        return getattr(self, attr)
+
+    def fset(self, value):
+        setattr(self, attr, value)
+        self._routing.invalidate()
+        self._replicate()
+
+    return property(fget, fset)
 
 
 class BinaryTreePeer(BasePeer):
-    def __init__(self, port, server_host=None):
-        super().__init__(port)
+    _left = _link('left')
+    _right = _link('right')
+    _parent = _link('parent')
+    up_bound = _link('up_bound')
+    low_bound = _link('low_bound')
+
+    def __init__(self, port, server_host=None,
+                 roster_page_size=ROSTER_PAGE_SIZE, join_timeout=TIMEOUT,
+                 join_retries=RETRIES, max_shortcuts=MAX_SHORTCUTS, workers=0,
+                 history_path=None, outbox_path=None, outbox_ttl=QUEUE_TTL,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, trace_rate=0,
+                 trace_buffer=TRACE_BUFFER, seen_size=SEEN_SIZE,
+                 seen_ttl=SEEN_TTL, gossip_types=(), gossip_fanout=FANOUT,
+                 gossip_interval=GOSSIP_INTERVAL,
+                 snapshot_window=SNAPSHOT_WINDOW, place_window=PLACE_WINDOW,
+                 **kwargs):
+        self._routing = RoutingTable(max_shortcuts)
+        self._opening_shortcuts = set()
+        # Worker processes share the port, they are started after joining
+        self._workers_count = workers
+        self._workers = None
+        kwargs['reuse_port'] = kwargs.get('reuse_port', False) or workers > 0
+        super().__init__(port, **kwargs)
 
         self._server_host = server_host
+        self._roster_page_size = roster_page_size
+        self._join_timeout = join_timeout
+        self._join_retries = join_retries
+        self._handshake = None
+        self._repair = None
+        # Packets that the node sends are traced only if rate is given
+        self._tracer = Tracer(self, trace_rate, trace_buffer)
+        if self._metrics_server is not None:
+            self._metrics_server.add_json('/traces.json', self.traces)
+        # Ids of broadcast and relayed packets, duplicates are dropped
+        self._seen = SeenCache(seen_size, seen_ttl)
+        self._duplicates = self.metrics.counter('duplicates_dropped_total')
+        # Broadcasts of given types are spread by gossip, not by the tree
+        self._gossip = Gossip(self, gossip_types, gossip_fanout,
+                              gossip_interval)
+        # Joining clients are placed by batches and share roster
+        self._admission = Admission(self, snapshot_window, place_window)
         self._create_handlers()
 
+        # Failures of links are detected only by closed connections
+        # if interval of heartbeats is not given
+        self._detector = FailureDetector(heartbeat_interval) \
+            if heartbeat_interval else None
+
+        # Messages are stored only if directory of history is given
+        self._db = DBHelper(history_path) if history_path else None
+        # Undeliverable messages are dropped if there is no outbox
+        self._outbox = Outbox(outbox_path, self._send_queued,
+                              ttl=outbox_ttl) if outbox_path else None
+
         # Attributes of node
         self._left = None
         self._right = None
@@ -45,92 +124,246 @@ class BinaryTreePeer(BasePeer):
         self._init_data()
 
     def _init_data(self):
-        self.connected = {}
-        self.id2host = {}
+        self._roster = Roster()
+        self.connected = self._roster.members
+        self.id2host = HostIndex(self._roster)
+
+        # Matching between a host and uid and epoch of its roster
+        # that we have fetched
+        self._roster_sync = {}
 
         # Client attributes
         self._id = None
+        self._incarnation = None
+        self._id_assigned = threading.Event()
         self.username = None
 
     def _add_host(self, host, data):
-        self.connected[host] = data
+        self._roster.add(Member(data['id'], host, data.get('username', '')))
+        self._replicate()
+        if self._outbox is not None:
+            self._outbox.wake()
+
+    def _remove_host(self, host):
+        member = self.connected.get(host)
+        if member is not None and self.id2host.get(member.id) == host:
+            del self.id2host[member.id]
+        self._roster.remove(host)
+        self._replicate()
+
+    def _replicate(self):
+        ''' Send changes of state of the node to worker processes '''
+
+        if self._workers is not None:
+            self._workers.publish()
+
+    def _start_workers(self, joined):
+        ''' Start worker processes when peer is joined to the chat '''
+
+        if not self._workers_count or joined.exception() is not None:
+            return
+        # Imported here since workers module depends on this one
+        from workers import WorkerGroup
+        self._workers = WorkerGroup(
+            self, self._workers_count, backend=self._backend,
+            max_frame_size=self._max_frame_size, formats=self._formats,
+            roster_page_size=self._roster_page_size,
+            high_water=self._high_water, low_water=self._low_water,
+            max_buffer=self._max_buffer, batch_window=self._batch_window,
+            batch_size=self._batch_size, ip=self._host[0])
+        self._workers.start()
+
+    def _conversation(self, from_id, to_id):
+        ''' Key of conversation between two nodes in history '''
+
+        return '%d-%d' % tuple(sorted((from_id, to_id)))
+
+    def _store_message(self, packet):
+        ''' Write message that was received or relayed to history '''
+
+        if self._db is not None:
+            self._db.append(self._conversation(packet['from_id'],
+                                               packet['to_id']), dict(packet))
+
+    def fetch_history(self, host, peer_id, since_id=None, since_time=None,
+                      limit=None):
+        '''
+        Fetch messages of conversation with a node from history of
+        a host, e.g. of a neighbor after rejoining to the chat
+
+        Args:
+            host (tuple) IP and port of a host that stores history
+            peer_id (int) Id of a node of conversation
+            since_id (int) Id of the last record that is known
+            since_time (float) Time since which messages are fetched
+            limit (int) Max number of messages
+        Return:
+            (list) Records with id, time and message, the oldest first
+        '''
+
+        packet = self._create_packet(TYPES['get_history'], self._id, -1,
+                                     self._host, host)
+        packet['peer_id'] = peer_id
+        packet['since_id'] = since_id
+        packet['since_time'] = since_time
+        packet['limit'] = limit
+        return self.__fetch_and_process_greet(packet, host)
+
+    def traces(self):
+        '''
+        Get traces of packets that ended at the node
+
+        Return:
+            (list) Traces, the oldest first (see Tracer.traces)
+        '''
+
+        return self._tracer.traces()
 
     def _get_self_data(self):
-        return {'id': self._id, 'host': self._host, 'username': ''}
+        return {'id': self._id, 'host': self._host, 'username': '',
+                'incarnation': self._incarnation}
 
-    def start(self):
-        ''' Start peer's works and processing data '''
+    def start(self, wait=True):
+        '''
+        Start peer's works and processing data
+
+        Args:
+            wait (bool) Wait until peer is joined to the chat
+        Return:
+            (Future) Future that is resolved when peer is joined
+        '''
 
+        # Broadcasts about previous start of the node are told apart
+        self._incarnation = getrandbits(63)
         self._add_work(self._handle_recv)
+        if self._detector is not None:
+            thread = threading.Thread(target=self._monitor_links, daemon=True)
+            thread.start()
+        if self._gossip.types:
+            self._gossip.start()
 
         # If we want to connect to existed chat
         if self._server_host is not None:
-            self._greeting()
-            self.connect(self._parent)
-            self._inform_about_connected()
+            self._handshake = Handshake(self, self._server_host,
+                                        self._join_timeout, self._join_retries)
+            joined = self._handshake.start()
         else:
-            self._id = self.generate_id([])
+            self._assign_id(self.generate_id([]))
             self._is_root = True
             # TODO ADD USERNAME
             self._add_host(self._host, self._get_self_data())
+            joined = Future()
+            joined.set_result(True)
+        joined.add_done_callback(self._start_workers)
+        if wait:
+            joined.result()
+        return joined
+
+    def _assign_id(self, _id):
+        self._id = _id
+        self._id_assigned.set()
+        self._replicate()
 
     def _form_broadcast_field(self, side):
         return {'side': side}
 
-    def _greeting(self):
+    def connect(self, server_id):
         '''
-        Make get_chat_info and find_insert_place requests to a server_host:
+        Connect to the chat. If insertion place is taken then another one
+        is found via server host, with timeouts and retries of handshake.
 
-        1) Get chat information. Namely, list of connected hosts, their ids
-        and so on.
-        2) Fetch information about host that can process out connection to
-        the chat
+        Args:
+            server_id (int) Id of a host that will handle our request
+                            for connection
+        Return:
+            (bool) True, else HandshakeError is raised
         '''
 
-        greet_sock = self._create_send_socket()
-        greet_sock.connect(self._server_host)
+        self._parent = server_id
+        self._handshake = Handshake(self, self._server_host,
+                                    self._join_timeout, self._join_retries)
+        return self._handshake.start(CONNECTING).result()
 
-        self._get_chat_info(self._server_host, greet_sock)
-        self._wait_node_data()
-        self._find_insert_place(self._server_host, greet_sock)
-
-        greet_sock.close()
-
-    def connect(self, server_id):
+    def _try_connect(self, server_host, timeout=10, on_reactor=False):
         '''
-        Connect to the chat.
+        Make connect request to a host
 
         Args:
-            server_host (tuple) IP and port of a host that will
-                                handle our request for connection
+            on_reactor (bool) Accept connection and apply response on
+                              the reactor thread, for a node that is
+                              already in the chat, e.g. on repair
+        Return:
+            (bool) True if connection is established else False if
+                   insertion place is taken
         '''
 
-        server_host = self.id2host[server_id]
-
+        if server_host not in self._opened_connection and \
+                not self._open_connection(server_host, timeout):
+            raise ConnectionError('Can\'t connect to %s' % str(server_host))
         packet = self._create_packet(TYPES['connect'], -1, -1, self._host,
                                      server_host, connect=True)
-        while True:
-            print('[*] Connecting to %s\n' % str(server_host))
+        LOGGER.debug('Connecting to %s', server_host)
+        try:
             sock = self._send_temp_message(server_host, packet)
             resp = self.__process_resp_sock(sock)
-            if resp['response'] != SUCCESS_CONN:
-                print('[-] Unsuccessful connecting. Trying to find another '
-                      'insertion place in chat\n')
-                self._close_connection(server_host)
-                self._find_insert_place(self._server_host)
-            else:
-                print('[+] Connection with %s is established'
-                      % str(server_host))
-                self._accept_conn(sock)
-                self._handlers['chat_info'].handle(resp)
-                break
+        except OSError:
+            self._close_connection(server_host)
+            raise
+        if on_reactor:
+            return self._call_on_reactor(self.__process_connect_resp,
+                                         server_host, sock, resp)
+        return self.__process_connect_resp(server_host, sock, resp)
+
+    async def _try_connect_async(self, server_host):
+        ''' Coroutine version of _try_connect '''
+
+        if server_host not in self._opened_connection and \
+                not await self._open_connection_async(server_host):
+            raise ConnectionError('Can\'t connect to %s' % str(server_host))
+        packet = self._create_packet(TYPES['connect'], -1, -1, self._host,
+                                     server_host, connect=True)
+        LOGGER.debug('Connecting to %s', server_host)
+        try:
+            sock = await self._send_temp_message_async(server_host, packet)
+            resp = await self.__process_resp_sock_async(sock)
+        except BaseException:
+            # Also on cancellation by timeout of handshake step
+            self._close_connection(server_host)
+            raise
+        return self.__process_connect_resp(server_host, sock, resp)
+
+    def __process_connect_resp(self, server_host, sock, resp):
+        if resp['response'] != SUCCESS_CONN:
+            self._release_connection(server_host)
+            return False
+        LOGGER.info('Connection with %s is established', server_host)
+        self._accept_conn(sock)
+        self._handlers['chat_info'].handle(resp)
+        return True
 
     def disconnect(self):
         '''
         Disconnect from the chat. Send to all users that we
-        are disconnecting.
+        are disconnecting. Connections with links are closed after
+        the message is sent, and children of the node reattach their
+        subtrees.
         '''
-        pass
+        packet = self._create_packet(TYPES['disconnect'], self._id, -1,
+                                     self._host, -1, broadcast=True)
+        packet['broadcast']['user_info'] = self._get_self_data()
+        self.send_broadcast_message(packet, close=True)
+        self._left = None
+        self._right = None
+        self._parent = None
+        self._is_root = False
+
+    def _inform_about_disconnected(self, user_id, host):
+        ''' Inform other clients of chat that a node is failed '''
+        packet = self._create_packet(TYPES['disconnect'], self._id, -1,
+                                     self._host, -1, broadcast=True)
+        packet['broadcast']['user_info'] = {'id': user_id, 'host': host,
+                                            'username': ''}
+        self.send_broadcast_message(packet)
 
     def _inform_about_connected(self):
         ''' Inform other clients of chat that user was connected '''
@@ -139,30 +372,98 @@ class BinaryTreePeer(BasePeer):
         packet['broadcast']['user_info'] = self._get_self_data()
         self.send_broadcast_message(packet)
 
-    def __fetch_and_process_greet(self, packet, server_host, print_msg,
-                                  sock=None):
+    def __fetch_and_process_greet(self, packet, server_host, sock=None):
+        resp = self.__fetch_greet(packet, server_host, sock)
+        return self._handle_resp_by_type(resp)
+
+    def __fetch_greet(self, packet, server_host, sock=None):
         if sock is None:
-            sock = self._create_send_socket()
-            sock.connect(server_host)
-        print(print_msg)
-        sock.sendall(json.dumps(packet).encode() + END_OF_MESSAGE)
-        return self.__process_resp_sock(sock)
+            sock = self._pool.connect(server_host)
+            try:
+                resp = self.__fetch_greet(packet, server_host, sock)
+            except socket.error:
+                self._pool.discard(sock)
+                raise
+            self._pool.put(server_host, sock)
+            return resp
+        LOGGER.debug('Sending %s request %r to %s', packet['type'], packet,
+                     server_host)
+        self._sendall(sock, packet)
+        return self._get_response(sock)
 
     def __process_resp_sock(self, sock):
         resp = self._get_response(sock)
         return self._handle_resp_by_type(resp)
 
+    async def __fetch_and_process_greet_async(self, packet, server_host,
+                                              sock=None):
+        resp = await self.__fetch_greet_async(packet, server_host, sock)
+        return self._handle_resp_by_type(resp)
+
+    async def __fetch_greet_async(self, packet, server_host, sock=None):
+        if sock is None:
+            sock = await self._pool_connect_async(server_host)
+            try:
+                resp = await self.__fetch_greet_async(packet, server_host,
+                                                      sock)
+            except BaseException:
+                self._pool.discard(sock)
+                raise
+            self._pool.put(server_host, sock)
+            return resp
+        LOGGER.debug('Sending %s request to %s', packet['type'], server_host)
+        await self._sendall_async(sock, packet)
+        return await self._get_response_async(sock)
+
+    async def __process_resp_sock_async(self, sock):
+        resp = await self._get_response_async(sock)
+        return self._handle_resp_by_type(resp)
+
     def _get_chat_info(self, server_host, sock=None):
         '''
         Get chat information. Namely, list of connected hosts, their ids
-        and so on.
+        and so on. If roster of the host was fetched before then only its
+        changes are fetched, else members are fetched by pages.
         '''
+        packet = self._create_chat_info_request(server_host)
+        while packet is not None:
+            resp = self.__fetch_greet(packet, server_host, sock)
+            self._handle_resp_by_type(resp)
+            packet = self._next_chat_info_request(resp, server_host)
+
+    def _create_chat_info_request(self, server_host):
         packet = self._create_packet(TYPES['get_chat_info'], -1, -1,
                                      self._host, server_host)
-        print_msg = ('[*] Sending get_chat_information request {} to {}\n'
-                     .format(packet, str(server_host)))
-        return self.__fetch_and_process_greet(packet, server_host, print_msg,
-                                              sock)
+        packet['limit'] = self._roster_page_size
+        if server_host in self._roster_sync:
+            packet['roster'] = self._roster_sync[server_host]
+        return packet
+
+    def _next_chat_info_request(self, resp, server_host):
+        '''
+        Form request for the next page of members or for changes that were
+        made while pages were fetched
+
+        Return:
+            (dict) Request or None if roster is fetched
+        '''
+
+        # Host doesn't support delta sync or sent changes
+        if 'roster_uid' not in resp or 'changes' in resp:
+            return None
+
+        offset = resp['offset'] + len(resp['connected'])
+        packet = self._create_chat_info_request(server_host)
+        if offset < resp['total']:
+            del packet['formats']
+            packet.pop('roster', None)
+            packet['offset'] = offset
+            packet['snapshot_epoch'] = resp['snapshot_epoch']
+            return packet
+        if resp['epoch'] != resp['snapshot_epoch']:
+            del packet['formats']
+            return packet
+        return None
 
 
     def _find_insert_place(self, server_host, sock=None):
@@ -171,12 +472,30 @@ class BinaryTreePeer(BasePeer):
         the chat
         '''
         packet = self._create_packet(TYPES['find_insert_place'], self._id,
-                                   self.connected[server_host]['id'],
+                                   self.connected[server_host].id,
                                    self._host, server_host)
-        print_msg = ('[*] Sending find_insert_place request {} to {}\n'
-                     .format(packet, str(server_host)))
-        return self.__fetch_and_process_greet(packet, server_host,
-                                              print_msg, sock)
+        return self.__fetch_and_process_greet(packet, server_host, sock)
+
+    async def _get_chat_info_async(self, server_host, sock=None):
+        ''' Coroutine version of _get_chat_info '''
+
+        packet = self._create_chat_info_request(server_host)
+        while packet is not None:
+            resp = await self.__fetch_greet_async(packet, server_host, sock)
+            self._handle_resp_by_type(resp)
+            packet = self._next_chat_info_request(resp, server_host)
+
+    async def _find_insert_place_async(self, server_host, sock=None):
+        ''' Coroutine version of _find_insert_place '''
+
+        packet = self._create_packet(TYPES['find_insert_place'], self._id,
+                                     self.connected[server_host].id,
+                                     self._host, server_host)
+        return await self.__fetch_and_process_greet_async(packet, server_host,
+                                                          sock)
+
+    def _is_offloaded(self, packet):
+        return self._handlers[packet['type']].offload
 
     def _handle_resp_by_type(self, resp):
         return self._handlers[resp['type']].handle(resp)
@@ -213,10 +532,16 @@ class BinaryTreePeer(BasePeer):
         }
         if broadcast:
             packet['broadcast'] = {}
+        if _type in (TYPES['get_chat_info'], TYPES['connect']):
+            packet['formats'] = self._formats
         if connect:
+            if to_host in self._roster_sync:
+                packet['roster'] = self._roster_sync[to_host]
+            else:
+                # Roster was fetched from another host, e.g. from the seed
+                packet['roster_digest'] = self._roster.digest()
             packet['place_info'] = self._place_info
-            packet['user_info'] = {'id': self._id, 'host': self._host,
-                                   'username': ''}
+            packet['user_info'] = self._get_self_data()
         return packet
 
     def send_message(self, host, msg):
@@ -228,74 +553,381 @@ class BinaryTreePeer(BasePeer):
             msg (dict) Message that is sended
 
         Return:
-            (bool) True if transfer was successful else False
+            (bool) True if transfer was successful or message is queued
+                   to outbox else False. It is False too if connection
+                   towards a host is over its high watermark, then sender
+                   should slow down
         '''
 
+        self._originate(msg)
+        outbox = self._outbox
+        if outbox is not None and host in outbox:
+            # Message must not overtake messages that wait in outbox
+            outbox.put(host, msg)
+            outbox.wake()
+            return True
         try:
-            host_id = self.connected[host]['id']
+            accepted = self._send_routed(host, msg)
+        except (KeyError, socket.error) as e:
+            if outbox is None:
+                LOGGER.warning('Dropping message to %s: no route (%r)',
+                               host, e)
+                return False
+            LOGGER.debug('Queueing message to %s: no route (%r)', host, e)
+            outbox.put(host, msg)
+            return True
+        if accepted is None and outbox is not None:
+            # Outbound buffer is full, message is sent when it drains
+            outbox.put(host, msg)
+            outbox.wake()
+            return True
+        return bool(accepted)
 
-            left = self.id2host.get(self._left, None)
-            right = self.id2host.get(self._right, None)
-            parent = self.id2host.get(self._parent, None)
+    def _originate(self, msg):
+        '''
+        Give id to a packet that the node sends and start its trace.
+        Received packets keep id and trace that they have. Id of
+        the packet is seen by the node, so it is dropped if it comes
+        back.
+        '''
 
-            if self.low_bound < host_id < self.up_bound:
-                side = left if self._id > host_id else right
-                sock = self._opened_connection[side]
-            else:
-                sock = self._opened_connection[parent]
-            self._add_message2send(sock, json.dumps(msg).encode() + END_OF_MESSAGE)
-            return True
-        except KeyError as e:
-            # TODO PROCESS THIS CASE CORRECTLY
-            traceback.print_exc()
-            return False
-        except socket.error as e:
-            # TODO PROCESS THIS CASE CORRECTLY
-            traceback.print_exc()
+        if type(msg) is Packet:
+            return
+        if 'msg_id' not in msg:
+            msg['msg_id'] = getrandbits(63)
+            self._seen.check(msg['msg_id'])
+        self._tracer.start(msg)
+
+    def _update_opened_connection(self, req, sock):
+        packet = super()._update_opened_connection(req, sock)
+        # Connections that only gossip uses are closed when idle
+        if self._gossip.is_gossip(packet):
+            self._gossip.touch(sock, tuple(packet['from_host']))
+        return packet
+
+    def _is_duplicate(self, packet):
+        msg_id = packet.get('msg_id')
+        if msg_id is None or not self._seen.check(msg_id):
             return False
+        LOGGER.debug('Dropping duplicate %s packet %s', packet['type'],
+                     msg_id)
+        self._duplicates.inc()
+        return True
+
+    def _send_routed(self, host, msg):
+        '''
+        Send message via route towards a host
+
+        Return:
+            (bool) False if connection is over its high watermark, None
+                   if message is dropped
+        '''
+
+        host_id = self.connected[host].id
+        sock = self._route(host_id)
+        return self._add_message2send(sock, self._pack(sock, msg))
+
+    def _send_queued(self, host, msg):
+        '''
+        Send message of outbox. It is sent on the reactor thread, so
+        outbox knows if outbound buffer took it (see _send_routed).
+        '''
+
+        return self._call_on_reactor(self._send_routed, host, msg)
+
+    def _call_on_reactor(self, func, *args):
+        '''
+        Call function on the reactor thread and wait for its result, so
+        a thread other than reactor changes state of the node the same
+        way as handlers do. It must not be called on the reactor thread.
+        '''
+
+        done = Future()
+
+        def call():
+            try:
+                done.set_result(func(*args))
+            except Exception as e:
+                done.set_exception(e)
+
+        self._reactor.call_soon(call)
+        return done.result()
+
+    def _route(self, host_id):
+        '''
+        Get socket towards a node. Routes are built once after links of
+        the node are changed.
+        '''
 
-    def send_broadcast_message(self, msg, closed=[]):
-        ''' Broadcast transfering of message '''
+        routing = self._routing
+        if not routing.is_valid and not self._build_routes():
+            # Connection with a link is not opened yet, so routes are
+            # built again next time
+            sock = routing.next_hop(host_id)
+            routing.invalidate()
+        else:
+            sock = routing.next_hop(host_id)
+        if sock is None:
+            raise KeyError(host_id)
+        if host_id not in (self._left, self._right, self._parent) and \
+                routing.learn(host_id):
+            self._open_shortcut(host_id)
+        return sock
+
+    def _build_routes(self):
+        '''
+        Return:
+            (bool) True if connections with all links are opened
+        '''
+
+        links = (self._left, self._right, self._parent)
+        socks = [self._opened_connection.get(self.id2host.get(host_id))
+                 for host_id in links]
+        self._routing.update(self.low_bound, self._id, self.up_bound, *socks)
+        is_complete = all(sock is not None for host_id, sock
+                          in zip(links, socks) if host_id is not None)
+        if is_complete and self._outbox is not None:
+            self._outbox.wake()
+        return is_complete
+
+    def _open_shortcut(self, host_id):
+        ''' Open direct connection with a distant node in background '''
+
+        if host_id in self._opening_shortcuts:
+            return
+        self._opening_shortcuts.add(host_id)
+        thread = threading.Thread(target=self.__connect_shortcut,
+                                  args=(host_id, self.id2host[host_id]),
+                                  daemon=True)
+        thread.start()
+
+    def __connect_shortcut(self, host_id, host):
+        try:
+            sock = self._pool.connect(host)
+        except socket.error:
+            LOGGER.debug('Failed to open shortcut with %s', host)
+            self._reactor.call_soon(self._opening_shortcuts.discard, host_id)
+            return
+        self._reactor.call_soon(self.__add_shortcut, host_id, sock)
+
+    def __add_shortcut(self, host_id, sock):
+        ''' Serve connection that is opened by helper thread '''
+
+        self._opening_shortcuts.discard(host_id)
+        self._accept_conn(sock)
+        LOGGER.debug('Opened shortcut with %s', host_id)
+        for evicted in self._routing.add_shortcut(host_id, sock):
+            self._close_sock(evicted)
+
+    def _process_frames(self, sock):
+        # Every frame from a link is a heartbeat of it
+        if self._detector is not None:
+            self._detector.heartbeat(sock)
+        super()._process_frames(sock)
+
+    def _close_sock(self, sock):
+        lost = [link_id for link_sock, link_id in self._link_socks().items()
+                if link_sock is sock] if sock in self._message_data else []
+        super()._close_sock(sock)
+        self._routing.remove_sock(sock)
+        self._routing.invalidate()
+        for link_id in lost:
+            self._lose_link(link_id)
+
+    def _link_socks(self):
+        ''' Get matching between opened connections with links and ids '''
+
+        links = {}
+        for link_id in (self._left, self._right, self._parent):
+            sock = self._opened_connection.get(self.id2host.get(link_id))
+            if link_id is not None and sock is not None:
+                links[sock] = link_id
+        return links
+
+    def _monitor_links(self):
+        ''' Check links of the node on the reactor thread every interval '''
+
+        while self._is_handle_recv:
+            time.sleep(self._detector.interval)
+            self._reactor.call_soon(self._check_links)
+
+    def _check_links(self):
+        '''
+        Ping links of the node and close connections with ones that
+        are suspected by failure detector
+        '''
+
+        detector = self._detector
+        links = self._link_socks()
+        for sock in detector.keys():
+            if sock not in links:
+                detector.remove(sock)
+        for sock, link_id in links.items():
+            detector.add(sock)
+            packet = self._create_packet(TYPES['ping'], self._id, link_id,
+                                         self._host, self.id2host[link_id])
+            self._add_message2send(sock, self._pack(sock, packet))
+        for sock in detector.suspects():
+            LOGGER.warning('Link %s is suspected to be failed',
+                           links.get(sock))
+            detector.remove(sock)
+            self._close_sock(sock)
+
+    def _lose_link(self, link_id, notify=True):
+        '''
+        Forget a failed link. The node of it is removed from the chat, and
+        if it is the parent then the subtree of the node is reattached.
+
+        Args:
+            link_id (int) Id of the failed node
+            notify (bool) Broadcast that the node is disconnected
+        '''
+
+        LOGGER.warning('Link with %s is lost', link_id)
+        host = self.id2host.get(link_id)
+        is_parent = self._parent == link_id
+        if self._left == link_id:
+            self._left = None
+        if self._right == link_id:
+            self._right = None
+        if is_parent:
+            self._parent = None
+        if host is not None:
+            self._remove_host(host)
+            if notify:
+                self._inform_about_disconnected(link_id, host)
+        if is_parent and not self._is_root:
+            self._repair_subtree(link_id)
+
+    def _repair_subtree(self, lost_id):
+        if self._repair is not None and not self._repair.repaired.done():
+            return
+        self._repair = Repair(self, lost_id, self._join_timeout)
+        self._repair.start()
+
+    def _adopt_place(self, place_info):
+        ''' Take place in the tree that was found for the subtree '''
+
+        parent = tuple(place_info['conn_host'])
+        self.id2host[place_info['conn_id']] = parent
+        self._parent = place_info['conn_id']
+        self._side = place_info['side']
+        self._neighbor = place_info['neighbor']
+        self._set_bounds(place_info['low_bound'], place_info['up_bound'])
+        self._inform_about_connected()
+
+    def _become_root(self):
+        self._is_root = True
+        self._side = None
+        self._neighbor = None
+        self._set_bounds(-1, INF)
+
+    def _set_bounds(self, low_bound, up_bound):
+        '''
+        Change bounds of the node. Bounds of children depend on them, so
+        they are sent to children.
+        '''
+
+        self.low_bound = low_bound
+        self.up_bound = up_bound
+        children = ((self._left, low_bound, self._id),
+                    (self._right, self._id, up_bound))
+        for child, child_low, child_up in children:
+            host = self.id2host.get(child)
+            if child is None or host is None:
+                continue
+            packet = self._create_packet(TYPES['bounds'], self._id, child,
+                                         self._host, host)
+            packet['low_bound'] = child_low
+            packet['up_bound'] = child_up
+            self.send_message(host, packet)
+
+    def send_broadcast_message(self, msg, closed=[], close=False):
+        '''
+        Broadcast transfering of message. Common part of message is
+        encoded once per wire format, and encoded bytes are put straight
+        to queues of neighbors, since they don't need routing. If close
+        is True then connections with neighbors are closed after
+        the message is sent. Types of messages that are given to gossip
+        are pushed to random members instead, except for closing
+        broadcasts.
+
+        Return:
+            (bool) False if a connection with some neighbor is over its
+                   high watermark or is not opened
+        '''
+        self._originate(msg)
+        if not close and msg['type'] in self._gossip:
+            return self._gossip.spread(msg)
         neighbors = [self._left, self._right, self._parent]
         locations = ['parent', 'parent', self._side]
+        templates = {}
+        accepted = True
 
         for host_id, side in zip(neighbors, locations):
             if host_id in closed or host_id is None:
                 continue
             host = self.id2host[host_id]
-            msg['to_id'] = host_id
-            msg['to_host'] = host
-            msg['broadcast']['from_node_side'] = side
-            print('[*] Sending broadcast message to %s\n' % host_id)
-            self.send_message(host, msg)
-
-    def _process_request(self, request, loaded=False):
+            sock = self._opened_connection.get(host)
+            if sock is None:
+                # TODO PROCESS THIS CASE CORRECTLY
+                LOGGER.warning('No connection with neighbor %s', host_id)
+                accepted = False
+                continue
+            wire_format = self._get_wire_format(sock)
+            template = templates.get(wire_format)
+            if template is None:
+                template = templates[wire_format] = \
+                    wire_format.broadcast_template(msg)
+            LOGGER.debug('Sending broadcast message to %s', host_id)
+            data = template.pack(host_id, host, side)
+            if close:
+                self._reactor.send(sock, data, close=True)
+            elif not self._add_message2send(sock, data):
+                accepted = False
+        return accepted
+
+    def _process_request(self, request, loaded=False, sock=None):
         '''
         Process request from another client. First of all we
         should decrypt message via encryptor.
 
         Args:
-            request (string) Request from some client in the chat
-            loaded (bool) If request is json loaded
+            request (bytes) Request from some client in the chat
+            loaded (bool) If request is decoded
+            sock (socket) Socket that request was received from. Response
+                          is encoded with its wire format
         Return:
-            (bytes) Response to request
+            (bytes) Response to request or None if there is nothing
+                    to answer
         '''
         packet = request
 
         if not loaded:
-            packet = json.loads(request)
+            packet = self._unpack(sock, request)
 
         # All payload are placed in Handlers class
         resp_packet = self._handle_resp_by_type(packet)
-        if resp_packet in [None, True, False]:
-            resp_packet = ''
+        if not isinstance(resp_packet, Mapping):
+            return None
+
+        if resp_packet['type'] == TYPES['chat_info']:
+            resp = self._admission.pack_chat_info(
+                self._get_wire_format(sock), resp_packet)
+        else:
+            resp = self._pack(sock, resp_packet)
+        # Response is encoded with old format, next packets with agreed one
+        self._check_wire_format(sock, resp_packet)
+        return resp
 
-        return  json.dumps(resp_packet).encode() + END_OF_MESSAGE
+    def _wait_node_data(self, timeout=None):
+        '''
+        Wait for assignment of id
 
-    def _wait_node_data(self):
-        ''' Wait for assignment of id '''
-        while self._id is None:
-            pass
+        Return:
+            (bool) True if id is assigned else False on timeout
+        '''
+        return self._id_assigned.wait(timeout)
 
     def generate_id(self, ids):
         while True:
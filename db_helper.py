@@ -1,9 +1,420 @@
 '''
 Module for providing communication functionality with
-inner database
+inner database. Database is an append-only log of messages on local
+disk: log is split to segment files, and a full segment is never
+changed again. Every record has a checksum, so a record that was
+written partly before a crash is cut off on opening.
+
+Records are written through a buffer and fsync is done for a batch of
+them: when there are sync_batch unsynced records or sync_interval has
+passed since the first one. So after a crash only the last batch
+can be lost.
+
+Every conversation has a compact index in memory: arrays of ids, times
+and positions of its records. It is built by one scan of segments on
+opening, and history is read via mmap of segments, so the whole log
+is never loaded into memory.
+
+Vars:
+    RECORD_HEADER (Struct) Header of a record: size of message, checksum,
+                           size of conversation, id and time
+    SEGMENT_SIZE (int) Default size after which a new segment is started
+    SYNC_BATCH (int) Default number of records that are synced at once
+    SYNC_INTERVAL (float) Default max delay of fsync in seconds
+    SEGMENT_SUFFIX (str) Suffix of names of segment files
 '''
 
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from array import array
+
+
+LOGGER = logging.getLogger(__name__)
+RECORD_HEADER = struct.Struct('!IIHQd')
+SEGMENT_SIZE = 64 * 1024 * 1024
+SYNC_BATCH = 256
+SYNC_INTERVAL = 0.05
+SEGMENT_SUFFIX = '.log'
+
 
 class DBHelper:
+    '''
+    Storage of messages of the chat
+
+    Fields:
+        path (str) Directory with segments of the log
+        segment_size (int) Size after which a new segment is started
+        sync_batch (int) Number of unsynced records after which fsync
+                         is done without waiting for sync_interval
+        sync_interval (float) Max time that a record stays unsynced
+        _segments (list) Segments of the log, the oldest first. Deleted
+                         segments are None, so numbers of segments in
+                         indexes stay valid
+        _first (int) Number of the oldest segment that is not deleted
+        _indexes (dict) Matching between a conversation and its index
+        _next_id (int) Id of the next record
+        _last_time (float) Time of the last record. Times of records
+                           never decrease, so they can be bisected
+        _unsynced (int) Number of records that are not synced yet
+        _dirty (Event) Set when there are unsynced records
+    '''
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE,
+                 sync_batch=SYNC_BATCH, sync_interval=SYNC_INTERVAL):
+        self.path = path
+        self.segment_size = segment_size
+        self.sync_batch = sync_batch
+        self.sync_interval = sync_interval
+
+        self._segments = []
+        self._first = 0
+        self._indexes = {}
+        self._next_id = 0
+        self._last_time = 0
+        self._unsynced = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._dirty = threading.Event()
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+        self._syncer = threading.Thread(target=self._sync_loop, daemon=True)
+        self._syncer.start()
+
+    def __len__(self):
+        return self._next_id - self._segments[self._first].base
+
+    @property
+    def next_id(self):
+        return self._next_id
+
+    def append(self, conversation, message):
+        '''
+        Write message to the log
+
+        Args:
+            conversation (str) Key of conversation that message belongs to
+            message (dict) Message of the chat
+        Return:
+            (int) Id of record
+        '''
+
+        conv = conversation.encode()
+        body = json.dumps(message).encode()
+        with self._lock:
+            segment = self._segments[-1]
+            if segment.size >= self.segment_size:
+                segment = self._rotate()
+            record_id = self._next_id
+            timestamp = max(time.time(), self._last_time)
+            offset = segment.write(RECORD_HEADER.pack(
+                len(body), zlib.crc32(body, zlib.crc32(conv)), len(conv),
+                record_id, timestamp), conv, body)
+            self._index(conversation).add(record_id, timestamp,
+                                          len(self._segments) - 1, offset)
+            self._next_id += 1
+            self._last_time = timestamp
+
+            self._unsynced += 1
+            if self._unsynced >= self.sync_batch:
+                self._sync()
+            else:
+                self._dirty.set()
+        return record_id
+
+    def history(self, conversation, since_id=None, since_time=None,
+                limit=None):
+        '''
+        Read messages of conversation. Bounds are excluded.
+
+        Args:
+            since_id (int) Id of the last record that is known to reader
+            since_time (float) Time since which messages are read
+            limit (int) Max number of messages
+        Return:
+            (list) Tuples of id, time and message, the oldest first
+        '''
+
+        with self._lock:
+            index = self._indexes.get(conversation)
+            if index is None:
+                return []
+            start = index.find(since_id, since_time)
+            end = len(index) if limit is None else \
+                min(start + limit, len(index))
+            # Mmap sees only data that was flushed from the buffer
+            self._segments[-1].flush()
+            return [self._read(index.segments[idx], index.offsets[idx])
+                    for idx in range(start, end)]
+
+    def conversations(self):
+        with self._lock:
+            return list(self._indexes)
+
+    def sync(self):
+        ''' Write every buffered record to disk '''
+
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._sync()
+            self._closed = True
+            for segment in self._segments[self._first:]:
+                segment.close()
+        self._dirty.set()
+
+    def drop_before(self, record_id):
+        '''
+        Delete old segments whose records all have ids below record_id.
+        The last segment is never deleted.
+        '''
+
+        with self._lock:
+            segments = self._segments
+            first = self._first
+            while first + 1 < len(segments) and \
+                    segments[first + 1].base <= record_id:
+                segments[first].delete()
+                segments[first] = None
+                first += 1
+            if first == self._first:
+                return
+            self._first = first
+            base = segments[first].base
+            for conversation, index in list(self._indexes.items()):
+                index.drop_before(base)
+                if not len(index):
+                    del self._indexes[conversation]
+
+    def _sync(self):
+        if self._unsynced:
+            self._segments[-1].sync()
+            self._unsynced = 0
+        self._dirty.clear()
+
+    def _sync_loop(self):
+        ''' Do fsync of records that wait for a batch too long '''
+
+        while True:
+            self._dirty.wait()
+            time.sleep(self.sync_interval)
+            with self._lock:
+                if self._closed:
+                    return
+                self._sync()
+
+    def _index(self, conversation):
+        index = self._indexes.get(conversation)
+        if index is None:
+            index = self._indexes[conversation] = _Index()
+        return index
+
+    def _rotate(self):
+        ''' Start a new segment, the current one is synced and read-only '''
+
+        self._sync()
+        self._segments[-1].seal()
+        segment = _Segment(self._segment_path(self._next_id), self._next_id)
+        segment.open()
+        self._segments.append(segment)
+        return segment
+
+    def _segment_path(self, base):
+        return os.path.join(self.path, '%020d%s' % (base, SEGMENT_SUFFIX))
+
+    def _load(self):
+        ''' Open segments and build indexes of conversations '''
+
+        bases = sorted(int(name[:-len(SEGMENT_SUFFIX)])
+                       for name in os.listdir(self.path)
+                       if name.endswith(SEGMENT_SUFFIX))
+        for base in bases:
+            segment = _Segment(self._segment_path(base), base)
+            self._segments.append(segment)
+            end = self._scan(segment, len(self._segments) - 1)
+            if end < segment.size:
+                LOGGER.warning('Cutting off broken records of %s at %d',
+                               segment.path, end)
+                segment.truncate(end)
+        if not self._segments:
+            self._segments.append(_Segment(self._segment_path(0), 0))
+        self._segments[-1].open()
+        for segment in self._segments[:-1]:
+            segment.seal()
+
+    def _scan(self, segment, number):
+        '''
+        Index every valid record of segment
+
+        Return:
+            (int) Offset of the end of valid records
+        '''
+
+        data = segment.map(segment.size)
+        offset = 0
+        while offset + RECORD_HEADER.size <= segment.size:
+            size, crc, conv_size, record_id, timestamp = \
+                RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + conv_size + size
+            if end > segment.size or \
+                    zlib.crc32(data[start:end]) != crc:
+                break
+            conversation = bytes(data[start:start + conv_size]).decode()
+            self._index(conversation).add(record_id, timestamp, number,
+                                          offset)
+            self._next_id = record_id + 1
+            self._last_time = max(self._last_time, timestamp)
+            offset = end
+        return offset
+
+    def _read(self, number, offset):
+        segment = self._segments[number]
+        data = segment.map(offset + RECORD_HEADER.size)
+        size, _, conv_size, record_id, timestamp = \
+            RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size + conv_size
+        data = segment.map(start + size)
+        message = json.loads(bytes(data[start:start + size]))
+        return record_id, timestamp, message
+
+
+class _Index:
+    '''
+    Records of one conversation. Arrays are used instead of lists of
+    tuples, so an entry takes 28 bytes.
+
+    Fields:
+        ids (array) Ids of records in ascending order
+        times (array) Times of records in ascending order
+        segments (array) Numbers of segments of records
+        offsets (array) Offsets of records in segments
+    '''
+
     def __init__(self):
-        pass
+        self.ids = array('Q')
+        self.times = array('d')
+        self.segments = array('I')
+        self.offsets = array('Q')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, record_id, timestamp, segment, offset):
+        self.ids.append(record_id)
+        self.times.append(timestamp)
+        self.segments.append(segment)
+        self.offsets.append(offset)
+
+    def drop_before(self, record_id):
+        count = bisect.bisect_left(self.ids, record_id)
+        for values in (self.ids, self.times, self.segments, self.offsets):
+            del values[:count]
+
+    def find(self, since_id=None, since_time=None):
+        ''' Get position of the first record after bounds '''
+
+        start = 0
+        if since_id is not None:
+            start = bisect.bisect_right(self.ids, since_id)
+        if since_time is not None:
+            start = max(start, bisect.bisect_right(self.times, since_time))
+        return start
+
+
+class _Segment:
+    '''
+    One file of the log
+
+    Fields:
+        path (str) Path of the file
+        base (int) Id of the first record of segment
+        size (int) Size of written records, buffered ones too
+        _file (file) File that records are appended to. It is None if
+                     segment is sealed
+        _map (mmap) Mapping of the file for reading
+    '''
+
+    def __init__(self, path, base):
+        self.path = path
+        self.base = base
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        self._file = None
+        self._map = None
+
+    def open(self):
+        ''' Open segment for appending '''
+
+        self._file = open(self.path, 'ab')
+
+    def seal(self):
+        ''' Segment is full, it is only read from now '''
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write(self, *parts):
+        '''
+        Return:
+            (int) Offset of written data
+        '''
+
+        offset = self.size
+        for part in parts:
+            self._file.write(part)
+            self.size += len(part)
+        return offset
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def truncate(self, size):
+        self.close()
+        with open(self.path, 'r+b') as log:
+            log.truncate(size)
+        self.size = size
+
+    def map(self, size):
+        '''
+        Get mapping of file that covers size bytes. The last segment
+        grows, so it is mapped again when data beyond mapping is read.
+        '''
+
+        if self._map is None or len(self._map) < size:
+            if self._map is not None:
+                self._map.close()
+            self._map = None
+            if not self.size:
+                return b''
+            with open(self.path, 'rb') as log:
+                self._map = mmap.mmap(log.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+        return self._map
+
+    def close(self):
+        self.seal()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def delete(self):
+        self.close()
+        os.remove(self.path)
@@ -0,0 +1,127 @@
+'''
+Module contains Dispatcher class. Dispatcher runs slow handlers of
+requests on a pool of threads, so the reactor thread keeps serving
+sockets while, e.g., a handler waits for a blocking connection.
+
+Requests of one connection are handled in order they were received:
+while a request of a connection is handled by the pool, next frames of
+the connection are left in its decoder, and they are processed by
+the reactor thread after the handler is finished. Requests of different
+connections are handled in parallel.
+
+Sender runs blocking sends, e.g. via pooled connections that are
+opened on demand, on a pool of threads the same way: sends to one host
+are run in order, sends to different hosts in parallel.
+
+Vars:
+    HANDLER_THREADS (int) Default number of threads of the pool
+    SENDER_THREADS (int) Default number of threads of sender
+'''
+
+import logging
+import threading
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+LOGGER = logging.getLogger(__name__)
+HANDLER_THREADS = 4
+SENDER_THREADS = 4
+
+
+class Dispatcher:
+    '''
+    Pool of threads for handlers that are marked as offloadable
+
+    Fields:
+        max_workers (int) Number of threads. Every handler is run on
+                          the reactor thread if it is 0
+        _busy (set) Connections whose request is being handled by the pool.
+                    It is changed only on the reactor thread
+        _executor (ThreadPoolExecutor) Pool that is created on first use
+    '''
+
+    def __init__(self, max_workers=HANDLER_THREADS):
+        self.max_workers = max_workers
+        self._busy = set()
+        self._executor = None
+
+    def __bool__(self):
+        return self.max_workers > 0
+
+    def is_busy(self, sock):
+        return sock in self._busy
+
+    def submit(self, sock, func, *args):
+        '''
+        Run handler of a request of connection on the pool. Connection
+        is busy until release is called for it.
+        '''
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self.max_workers, thread_name_prefix='handler')
+        self._busy.add(sock)
+        self._executor.submit(self._run, func, *args)
+
+    def release(self, sock):
+        ''' Let next requests of connection be processed '''
+
+        self._busy.discard(sock)
+
+    def _run(self, func, *args):
+        try:
+            func(*args)
+        except Exception:
+            LOGGER.exception('Handler failed')
+
+
+class Sender:
+    '''
+    Pool of threads for sends that can block, so the reactor thread
+    doesn't wait for connecting to a host. A slow or dead host holds
+    one thread at most, sends to other hosts go on.
+
+    Fields:
+        max_workers (int) Number of threads
+        _queues (dict) Matching between a host and deque of its sends.
+                       Host is in it while a thread runs its sends
+        _executor (ThreadPoolExecutor) Pool that is created on first use
+    '''
+
+    def __init__(self, max_workers=SENDER_THREADS, name='sender'):
+        self.max_workers = max_workers
+        self._name = name
+        self._queues = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, host, func, *args):
+        ''' Run send to a host after previous sends to it '''
+
+        with self._lock:
+            queue = self._queues.get(host)
+            if queue is not None:
+                queue.append((func, args))
+                return
+            self._queues[host] = deque([(func, args)])
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix=self._name)
+        self._executor.submit(self._drain, host)
+
+    def _drain(self, host):
+        while True:
+            with self._lock:
+                queue = self._queues[host]
+                if not queue:
+                    del self._queues[host]
+                    return
+                func, args = queue.popleft()
+            try:
+                func(*args)
+            except OSError as e:
+                LOGGER.warning('Failed to send to %s: %r', host, e)
+            except Exception:
+                LOGGER.exception('Send to %s failed', host)
@@ -0,0 +1,134 @@
+'''
+Module contains FailureDetector class. It is a phi accrual failure
+detector of links of a node: every frame that is received from a link
+is a heartbeat, so links with traffic need no extra packets, and idle
+links are kept alive by pings.
+
+Suspicion of a link is a phi value: -log10 of probability that the next
+heartbeat comes later than now, given normal distribution of past
+intervals between heartbeats. A link is failed when phi exceeds
+threshold, so detection time adapts to jitter of the link instead of
+being a fixed timeout.
+
+Vars:
+    HEARTBEAT_INTERVAL (float) Default interval of pings in seconds
+    PHI_THRESHOLD (float) Default phi after which a link is failed
+    MIN_STD (float) Min standard deviation of intervals in seconds,
+                    it prevents false suspicion of very regular links
+    ACCEPTABLE_PAUSE (float) Delay in seconds that is added to mean
+                             interval, e.g. for garbage collection
+    HISTORY_SIZE (int) Number of last intervals that are kept
+'''
+
+import math
+import threading
+import time
+
+from collections import deque
+
+
+HEARTBEAT_INTERVAL = 0.5
+PHI_THRESHOLD = 8
+MIN_STD = 0.1
+ACCEPTABLE_PAUSE = 0.5
+HISTORY_SIZE = 100
+
+
+class FailureDetector:
+    '''
+    Phi accrual failure detector
+
+    Fields:
+        interval (float) Expected interval between heartbeats. Intervals
+                         that are shorter, e.g. between frames of busy
+                         link, are counted as this one, so phi of a busy
+                         link doesn't grow too fast when it becomes idle
+        threshold (float) Phi after which a link is failed
+        _arrivals (dict) Matching between a monitored key and its history
+    '''
+
+    def __init__(self, interval=HEARTBEAT_INTERVAL, threshold=PHI_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self._arrivals = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._arrivals
+
+    def add(self, key):
+        ''' Start monitoring of key, as if heartbeat came now '''
+
+        with self._lock:
+            if key not in self._arrivals:
+                self._arrivals[key] = _History(self.interval)
+
+    def remove(self, key):
+        with self._lock:
+            self._arrivals.pop(key, None)
+
+    def keys(self):
+        with self._lock:
+            return list(self._arrivals)
+
+    def heartbeat(self, key):
+        history = self._arrivals.get(key)
+        if history is not None:
+            history.add(time.monotonic(), self.interval)
+
+    def phi(self, key, now=None):
+        history = self._arrivals.get(key)
+        if history is None:
+            return 0
+        return history.phi(now or time.monotonic())
+
+    def suspects(self):
+        ''' Get keys whose phi exceeds threshold '''
+
+        now = time.monotonic()
+        with self._lock:
+            return [key for key, history in self._arrivals.items()
+                    if history.phi(now) > self.threshold]
+
+
+class _History:
+    '''
+    Intervals between heartbeats of one key
+
+    Fields:
+        last (float) Time of the last heartbeat
+        _intervals (deque) Last intervals
+        _sum (float) Sum of intervals
+        _squares (float) Sum of squares of intervals
+    '''
+
+    def __init__(self, interval):
+        self.last = time.monotonic()
+        # Expected interval is the first sample, so phi is defined
+        self._intervals = deque([interval])
+        self._sum = interval
+        self._squares = interval ** 2
+
+    def add(self, now, min_interval):
+        interval = max(now - self.last, min_interval)
+        self.last = now
+        self._intervals.append(interval)
+        self._sum += interval
+        self._squares += interval ** 2
+        if len(self._intervals) > HISTORY_SIZE:
+            old = self._intervals.popleft()
+            self._sum -= old
+            self._squares -= old ** 2
+
+    def phi(self, now):
+        count = len(self._intervals)
+        mean = self._sum / count
+        std = math.sqrt(max(self._squares / count - mean ** 2, 0))
+        std = max(std, MIN_STD)
+        # Logistic approximation of cumulative normal distribution
+        y = (now - self.last - mean - ACCEPTABLE_PAUSE) / std
+        exponent = y * (1.5976 + 0.070566 * y * y)
+        if exponent > 30:
+            # log10(1 + e^x) without overflow
+            return exponent / math.log(10)
+        return math.log10(1 + math.exp(exponent))
@@ -0,0 +1,198 @@
+'''
+Module contains framing of messages on the wire. By default every
+message is ended by END_OF_MESSAGE delimiter. Binary wire formats
+use length-prefixed framing: every message is preceded by its length.
+
+Vars:
+    END_OF_MESSAGE (bytes) Delimiter of messages
+    LENGTH_PREFIX (Struct) Header of length-prefixed message
+    MAX_FRAME_SIZE (int) Default max size of one frame in bytes
+    RECV_SIZE (int) Default free space of buffer for one read
+'''
+
+import struct
+
+
+END_OF_MESSAGE = b'\r\n'
+LENGTH_PREFIX = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+RECV_SIZE = 64 * 1024
+
+
+class FrameTooLarge(ValueError):
+    ''' Raised when a frame exceeds max frame size '''
+
+
+class FrameDecoder:
+    '''
+    Incremental decoder of frames of one connection. Data is received
+    straight to a bytearray via recv_into, and the delimiter is searched
+    only in bytes that were not scanned yet, so decoding is linear in
+    size of received data.
+
+    Fields:
+        max_frame_size (int) Max size of one frame in bytes
+        _buf (bytearray) Buffer with received data
+        _start (int) Offset of the first byte of unfinished frame
+        _end (int) Offset of the end of received data
+        _scanned (int) Offset from which the delimiter is searched
+        _view (memoryview) Free part of buffer that was given for reading
+    '''
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, recv_size=RECV_SIZE,
+                 delimiter=END_OF_MESSAGE):
+        self.max_frame_size = max_frame_size
+        self._recv_size = recv_size
+        self._delimiter = delimiter
+
+        self._buf = bytearray(recv_size)
+        self._start = 0
+        self._end = 0
+        self._scanned = 0
+        self._view = None
+
+    def __len__(self):
+        return self._end - self._start
+
+    def pending(self):
+        ''' Get received data that is not decoded yet '''
+
+        return bytes(self._buf[self._start:self._end])
+
+    def get_buffer(self, sizehint=-1):
+        '''
+        Get free part of buffer for reading. After reading
+        buffer_updated must be called.
+
+        Return:
+            (memoryview) Writable view of free part of buffer
+        '''
+
+        self._reserve(max(sizehint, self._recv_size))
+        self._view = memoryview(self._buf)[self._end:]
+        return self._view
+
+    def buffer_updated(self, nbytes):
+        ''' Commit nbytes that were read to a buffer from get_buffer '''
+
+        self._view.release()
+        self._view = None
+        self._end += nbytes
+
+    def recv_from(self, sock):
+        '''
+        Receive data from socket straight to the buffer
+
+        Return:
+            (int) Number of received bytes, 0 if connection is closed
+        '''
+
+        nbytes = 0
+        try:
+            nbytes = sock.recv_into(self.get_buffer())
+        finally:
+            self.buffer_updated(nbytes)
+        return nbytes
+
+    def feed(self, data):
+        ''' Add data that was received not via recv_from '''
+
+        size = len(data)
+        self.get_buffer(size)[:size] = data
+        self.buffer_updated(size)
+
+    def next_frame(self):
+        '''
+        Get next complete frame
+
+        Return:
+            (bytearray) Frame without delimiter or None if there is no
+                        complete frame yet
+        '''
+
+        buf = self._buf
+        idx = buf.find(self._delimiter, self._scanned, self._end)
+        if idx < 0:
+            # Delimiter may be split between two reads
+            self._scanned = max(self._start,
+                                self._end - len(self._delimiter) + 1)
+            if self._end - self._start > self.max_frame_size:
+                raise FrameTooLarge('Frame exceeds %d bytes'
+                                    % self.max_frame_size)
+            return None
+
+        frame = buf[self._start:idx]
+        self._start = self._scanned = idx + len(self._delimiter)
+        if self._start == self._end:
+            self._start = self._end = self._scanned = 0
+        return frame
+
+    def frames(self):
+        ''' Yield every complete frame that is in the buffer '''
+
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def _reserve(self, size):
+        ''' Make sure that buffer has size bytes of free space '''
+
+        if len(self._buf) - self._end >= size:
+            return
+        # Move unfinished frame to the beginning of the buffer
+        pending = self._end - self._start
+        if self._start:
+            self._buf[:pending] = self._buf[self._start:self._end]
+            self._scanned -= self._start
+            self._start = 0
+            self._end = pending
+        free = len(self._buf) - self._end
+        if free < size:
+            self._buf.extend(bytes(max(size - free, len(self._buf))))
+
+    def with_framing(self, decoder_cls):
+        '''
+        Create decoder of another framing that takes over data which
+        is not decoded yet. Used when a connection changes wire format.
+        '''
+
+        decoder = decoder_cls(self.max_frame_size, self._recv_size)
+        decoder._buf = self._buf
+        decoder._start = decoder._scanned = self._start
+        decoder._end = self._end
+        return decoder
+
+
+class LengthPrefixedDecoder(FrameDecoder):
+    '''
+    Incremental decoder of length-prefixed frames. Length of a frame is
+    known from its header, so received data is not scanned at all.
+    '''
+
+    def next_frame(self):
+        start = self._start
+        available = self._end - start
+        if available < LENGTH_PREFIX.size:
+            return None
+        size, = LENGTH_PREFIX.unpack_from(self._buf, start)
+        if size > self.max_frame_size:
+            raise FrameTooLarge('Frame exceeds %d bytes' % self.max_frame_size)
+        if available < LENGTH_PREFIX.size + size:
+            return None
+
+        start += LENGTH_PREFIX.size
+        frame = self._buf[start:start + size]
+        self._start = self._scanned = start + size
+        if self._start == self._end:
+            self._start = self._end = self._scanned = 0
+        return frame
+
+
+def frame_delimited(payload):
+    return payload + END_OF_MESSAGE
+
+
+def frame_length_prefixed(payload):
+    return LENGTH_PREFIX.pack(len(payload)) + payload
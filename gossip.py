@@ -0,0 +1,374 @@
+'''
+Module contains Gossip class. Gossip is an alternative way of broadcast
+for chosen types of packets: instead of flooding along edges of the tree
+a node pushes a packet to a few members of its view, and every member
+that receives it for the first time pushes it further.
+
+View is a small set of random members that is kept while they are in
+the chat, so a node pushes to the same members and reuses connections
+with them instead of opening one to a new member on every push.
+A member that joins replaces a random member of a view with probability
+of view size to size of the chat, so views stay uniform samples of
+the chat and change rarely. Views of all nodes make a random graph, so
+a broadcast reaches members in about log n rounds of pushes.
+Connections that only gossip uses are closed by both sides after they
+are idle for a while, so a node keeps about view size connections of
+gossip in each direction.
+
+Every member receives about fanout copies of a packet, and connections
+of gossip use JSON since wire format is agreed only by greeting, so
+gossip costs several times more CPU and traffic than the tree. A slow
+node delays only its own pushes, not a whole subtree, but when all
+nodes run on one host, e.g. in the simulator, the tree is faster even
+if some nodes are slow.
+
+A member can miss a packet if all pushes towards it are lost, so every
+interval a node sends ids of its newest packets (digest) to the next
+member of its view, and the member pushes back packets that are missing in it via
+the same connection. Digest tells age of its oldest packet (span), and
+only packets that are younger than span are pushed back, so packets
+that are seen but don't fit the digest are not sent again. Packets that
+the member received within the last interval are not pushed back, since
+its pushes of them are still in flight.
+
+Packets are not ordered by gossip, so broadcasts that close connections
+are still sent along the tree. new_user that comes after disconnect of
+the member is ignored (see tombstones of Handlers), so disconnect can
+be spread by gossip too.
+
+Vars:
+    FANOUT (int) Default number of members that a packet is pushed to
+    VIEW_SIZE (int) Default number of members of a view
+    GOSSIP_INTERVAL (float) Default interval of digests in seconds
+    RUMOR_TTL (float) Default time in seconds that a packet is kept to be
+                      pushed back on digest
+    MAX_RUMORS (int) Default max number of kept packets
+    DIGEST_SIZE (int) Max number of ids of packets in a digest
+    PUSH_TIMEOUT (float) Timeout of connecting to a member in seconds,
+                         a member that doesn't answer holds one thread
+                         of sender for this time at most
+    IDLE_TIMEOUT (float) Time in seconds after which a connection that
+                         only gossip uses is closed, it is opened again
+                         on the next push
+'''
+
+import logging
+import random
+import socket
+import threading
+import time
+
+from collections import OrderedDict
+
+from dispatch import Sender
+from handlers import TYPES
+
+
+LOGGER = logging.getLogger(__name__)
+FANOUT = 4
+VIEW_SIZE = 8
+GOSSIP_INTERVAL = 0.5
+RUMOR_TTL = 30
+MAX_RUMORS = 10000
+DIGEST_SIZE = 256
+PUSH_TIMEOUT = 0.5
+IDLE_TIMEOUT = 30
+
+
+class Gossip:
+    '''
+    Gossip of a node. Connections of gossip are used and changed only
+    on the reactor thread.
+
+    Fields:
+        types (frozenset) Types of packets that are spread by gossip
+        fanout (int) Number of members that a packet is pushed to
+        view_size (int) Number of members of the view
+        interval (float) Interval of digests in seconds
+        _peer (BinaryTreePeer) Peer of the node
+        _view (dict) Matching between an id and a member of the view
+        _rumors (OrderedDict) Matching between id of packet and tuple of
+                              time when it was received and the packet,
+                              the oldest first
+        _conns (dict) Matching between a host and connection that gossip
+                      uses with it, opened by either side
+        _active (dict) Matching between a connection of gossip and time
+                       when it was used last
+        _connecting (dict) Matching between a host whose connection is
+                           being opened and packets that wait for it
+        _sender (Sender) Threads that open connections, a member that
+                         doesn't answer holds one of them
+        _started (float) Time when gossip was started, a node doesn't
+                         have packets that were sent before it joined
+    '''
+
+    def __init__(self, peer, types=(), fanout=FANOUT,
+                 interval=GOSSIP_INTERVAL, ttl=RUMOR_TTL,
+                 max_rumors=MAX_RUMORS, view_size=VIEW_SIZE):
+        self._peer = peer
+        self.types = frozenset(types)
+        self.fanout = fanout
+        self.view_size = max(view_size, fanout)
+        self.interval = interval
+        self._ttl = ttl
+        self._max_rumors = max_rumors
+        self._rumors = OrderedDict()
+        self._view = {}
+        self._conns = {}
+        self._active = {}
+        self._connecting = {}
+        self._sender = Sender(fanout, 'gossip')
+        self._started = time.monotonic()
+        self._rounds = 0
+        self._lock = threading.Lock()
+        metrics = peer.metrics
+        self._pushed = metrics.counter('gossip_pushes_total')
+        self._repaired = metrics.counter('gossip_repairs_total')
+        self._failed = metrics.counter('gossip_failures_total')
+
+    def __contains__(self, _type):
+        return _type in self.types
+
+    def start(self):
+        self._started = time.monotonic()
+        thread = threading.Thread(target=self._digest_loop, daemon=True)
+        thread.start()
+
+    def spread(self, packet):
+        '''
+        Push a packet that is sent or received for the first time
+        to random members of the view
+
+        Return:
+            (bool) True, pushes are sent by reactor
+        '''
+
+        rumor = self._remember(packet)
+        members = [member for member in self._refresh_view()
+                   if member.id != packet.get('from_id')]
+        for member in random.sample(members, min(self.fanout, len(members))):
+            self._push(member, rumor)
+        return True
+
+    def _refresh_view(self):
+        '''
+        Replace members of the view that left the chat or joined again
+        with another id by random members of roster
+
+        Return:
+            (list) Members of the view
+        '''
+
+        peer = self._peer
+        roster = peer._roster
+        with self._lock:
+            view = self._view
+            for _id, member in list(view.items()):
+                if roster.by_id.get(_id) is not member:
+                    del view[_id]
+            if len(view) < self.view_size:
+                exclude = set(view)
+                exclude.add(peer._id)
+                for member in roster.sample(self.view_size - len(view),
+                                            exclude):
+                    view[member.id] = member
+            return list(view.values())
+
+    def admit(self, member):
+        '''
+        Put a member that joined the chat to the view instead of
+        a random member of it, see the module docstring
+        '''
+
+        if not self.types or member.id == self._peer._id:
+            return
+        with self._lock:
+            view = self._view
+            if member.id in view:
+                return
+            if len(view) < self.view_size:
+                view[member.id] = member
+            elif random.random() < \
+                    self.view_size / max(len(self._peer._roster), 1):
+                del view[random.choice(list(view))]
+                view[member.id] = member
+
+    @staticmethod
+    def is_gossip(packet):
+        ''' Check if packet was pushed by gossip '''
+
+        if packet['type'] == TYPES['gossip_digest']:
+            return True
+        broadcast = packet.get('broadcast')
+        return isinstance(broadcast, dict) and \
+            broadcast.get('from_node_side') == 'gossip'
+
+    def touch(self, sock, host):
+        '''
+        Remember that gossip was received from a host via connection,
+        so pushes to the host can use it too
+        '''
+
+        self._active[sock] = time.monotonic()
+        if self._conns.get(host) not in self._peer._message_data:
+            self._conns[host] = sock
+
+    def _close_idle(self):
+        '''
+        Close connections that only gossip uses and that are idle for
+        longer than IDLE_TIMEOUT. Connections with links and other nodes
+        that are known to the peer are kept.
+        '''
+
+        peer = self._peer
+        expired = time.monotonic() - IDLE_TIMEOUT
+        for sock, used in list(self._active.items()):
+            if sock in peer._message_data and used >= expired:
+                continue
+            del self._active[sock]
+            if sock in peer._message_data and \
+                    not peer._opened_connection.hosts(sock):
+                LOGGER.debug('Closing idle gossip connection %s', sock)
+                peer._close_sock(sock)
+        for host, sock in list(self._conns.items()):
+            if sock not in peer._message_data:
+                del self._conns[host]
+
+    def _remember(self, packet):
+        rumor = dict(packet)
+        rumor['broadcast'] = dict(rumor['broadcast'], from_node_side='gossip')
+        with self._lock:
+            self._rumors[rumor['msg_id']] = (time.monotonic(), rumor)
+            while len(self._rumors) > self._max_rumors:
+                self._rumors.popitem(last=False)
+        return rumor
+
+    def _prune(self):
+        ''' Forget packets that are older than TTL '''
+
+        expired = time.monotonic() - self._ttl
+        with self._lock:
+            while self._rumors:
+                msg_id, (received, _) = next(iter(self._rumors.items()))
+                if received >= expired:
+                    break
+                del self._rumors[msg_id]
+
+    def _recent(self):
+        '''
+        Get ids of the newest packets for a digest
+
+        Return:
+            (tuple) List of ids and span of the digest in seconds: age of
+                    the oldest packet if not all kept packets fit
+                    the digest, else time since gossip was started but
+                    no more than TTL
+        '''
+
+        now = time.monotonic()
+        with self._lock:
+            items = list(self._rumors.items())[-DIGEST_SIZE:]
+            complete = len(items) == len(self._rumors)
+        ids = [msg_id for msg_id, _ in items]
+        if complete:
+            return ids, min(self._ttl, now - self._started)
+        return ids, now - items[0][1][0]
+
+    def _digest_loop(self):
+        peer = self._peer
+        while peer._is_handle_recv:
+            time.sleep(self.interval)
+            self._prune()
+            peer._reactor.call_soon(self._close_idle)
+            members = self._refresh_view()
+            if not members:
+                continue
+            # Every member of the view gets a digest in view_size rounds
+            self._rounds += 1
+            member = members[self._rounds % len(members)]
+            packet = self._create_packet(TYPES['gossip_digest'], member)
+            packet['ids'], packet['span'] = self._recent()
+            self._push(member, packet)
+
+    def _create_packet(self, _type, member):
+        peer = self._peer
+        return peer._create_packet(_type, peer._id, member.id, peer._host,
+                                   member.host)
+
+    def _push(self, member, rumor):
+        ''' Send a packet to a member. It doesn't block the caller. '''
+
+        peer = self._peer
+        packet = dict(rumor, to_id=member.id, to_host=member.host,
+                      from_id=peer._id, from_host=peer._host)
+        peer._reactor.call_soon(self._send, member.host, packet)
+
+    def _send(self, host, packet):
+        '''
+        Send a packet via connection with a link, or via connection of
+        gossip with a host. If there is no one then the connection is
+        opened by sender. Other opened connections are not used, e.g.
+        connection of greeting is served by reactor only on one side.
+        '''
+
+        peer = self._peer
+        sock = self._conns.get(host)
+        if peer.connected.get(host) is not None and \
+                peer.connected[host].id in (peer._left, peer._right,
+                                            peer._parent):
+            sock = peer._opened_connection.get(host, sock)
+        if sock in peer._message_data:
+            self._active[sock] = time.monotonic()
+            peer._reactor.send(sock, peer._pack(sock, packet))
+            self._pushed.inc()
+        elif host in self._connecting:
+            self._connecting[host].append(packet)
+        else:
+            self._connecting[host] = [packet]
+            self._sender.submit(host, self._connect, host)
+
+    def _connect(self, host):
+        peer = self._peer
+        # Connections that are requested before shutdown are not opened
+        if not peer._is_handle_recv:
+            return
+        try:
+            sock = peer._pool.connect(host, PUSH_TIMEOUT)
+        except socket.error as e:
+            LOGGER.debug('Failed to connect to %s for gossip: %r', host, e)
+            peer._reactor.call_soon(self._connect_failed, host)
+            return
+        peer._reactor.call_soon(self._add_conn, host, sock)
+
+    def _connect_failed(self, host):
+        self._failed.inc(len(self._connecting.pop(host, ())))
+
+    def _add_conn(self, host, sock):
+        ''' Serve connection that is opened by sender '''
+
+        self._peer._accept_conn(sock)
+        self._conns[host] = sock
+        for packet in self._connecting.pop(host, ()):
+            self._send(host, packet)
+
+    def on_digest(self, rpacket):
+        ''' Push packets that are missing in a digest of another member '''
+
+        member = self._peer.connected.get(tuple(rpacket['from_host']))
+        if member is None:
+            return
+        ids = set(rpacket['ids'])
+        now = time.monotonic()
+        newest = now - self.interval
+        oldest = now - rpacket.get('span', 0)
+        rumors = []
+        with self._lock:
+            # Packets are kept in order of receiving
+            for msg_id, (received, rumor) in reversed(self._rumors.items()):
+                if received <= oldest:
+                    break
+                if received < newest and msg_id not in ids:
+                    rumors.append(rumor)
+        self._repaired.inc(len(rumors))
+        for rumor in rumors:
+            self._push(member, rumor)
@@ -5,14 +5,22 @@ is placed all handling functionality. Handle class is additional
 Vars:
     TYPES (dict) If names of package types will be changed then it
                  needs to be changed in this dictionary
+    TOMBSTONE_TTL (float) Time in seconds that a member that left is
+                          remembered, so new_user of it that comes late
+                          doesn't add it back
 '''
 
 
-import copy
 import logging
+import time
+
+from collections import OrderedDict
+
+from wire_format import negotiate
 
 
 LOGGER = logging.getLogger(__name__)
+TOMBSTONE_TTL = 60
 TYPES = {
     'connect': 'connect',
     'disconnect': 'disconnect',
@@ -24,18 +32,61 @@ TYPES = {
     'insert_place': 'insert_place',
     'downtype': 'downtype',
     'connect_resp': 'connect_resp',
-    'new_user': 'new_user'
+    'new_user': 'new_user',
+    'message': 'message',
+    'get_history': 'get_history',
+    'history': 'history',
+    'reattach': 'reattach',
+    'reattach_place': 'reattach_place',
+    'bounds': 'bounds',
+    'gossip_digest': 'gossip_digest'
 }
 
 
 class Handlers:
+    '''
+    Fields:
+        _relayed (dict) Matching between type of relayed packet and
+                        counter of relays. Packets carry no hop count,
+                        so hops of a whole path are counted only for
+                        sampled packets (see trace_hops of Tracer)
+        _incarnations (dict) Matching between a host of a member and
+                             incarnation of it, a random number that
+                             a node chooses on every start
+        _tombstones (OrderedDict) Matching between a host of a member
+                                  that left and tuple of its id,
+                                  incarnation and time until which it is
+                                  kept, the oldest first
+    '''
+
     def __init__(self, peer):
         self._peer = peer
+        self._relayed = {}
+        self._incarnations = {}
+        self._tombstones = OrderedDict()
         self._create_table()
+        self._instrument()
 
     def __getitem__(self, key):
         return self._table[key]
 
+    def _instrument(self):
+        ''' Count packets and time of handling of every type '''
+
+        metrics = self._peer.metrics
+        for _type, handle in self._table.items():
+            handle.packets = metrics.counter('packets_total', type=_type)
+            handle.latency = metrics.histogram('handler_seconds', type=_type)
+
+    def _count_relay(self, _type):
+        ''' Count a relay of a packet by the node, i.e. one hop of it '''
+
+        counter = self._relayed.get(_type)
+        if counter is None:
+            counter = self._relayed[_type] = self._peer.metrics.counter(
+                'relayed_packets_total', type=_type)
+        counter.inc()
+
     def _create_table(self):
         '''
         Create table of handlers. In all below functions second parameter
@@ -52,7 +103,14 @@ class Handlers:
             TYPES['find_insert_place']: Handle(self._find_insert_place),
             TYPES['insert_place']: Handle(self._insert_place),
             TYPES['connect_resp']: Handle(self._connect_resp),
-            TYPES['new_user']: Handle(self._new_user)
+            TYPES['new_user']: Handle(self._new_user),
+            TYPES['message']: Handle(self._message),
+            TYPES['get_history']: Handle(self._get_history, offload=True),
+            TYPES['history']: Handle(self._history),
+            TYPES['reattach']: Handle(self._reattach),
+            TYPES['reattach_place']: Handle(self._reattach_place),
+            TYPES['bounds']: Handle(self._bounds),
+            TYPES['gossip_digest']: Handle(self._gossip_digest)
         }
 
     def _connect(self, rpacket):
@@ -75,23 +133,38 @@ class Handlers:
             self._add_user_to_chat(user_info)
 
             packet['response'] = 'OK'
-            packet['connected'] = self._get_connected()
+            self._set_roster(packet, rpacket)
+            self._set_format(packet, rpacket)
         else:
             packet['response'] = 'ERROR'
         del packet['user_info']
         del packet['place_info']
+        packet.pop('formats', None)
+        packet.pop('roster', None)
+        packet.pop('roster_digest', None)
         return packet
 
+    def _set_format(self, packet, rpacket):
+        ''' Choose wire format if client offered formats in request '''
+
+        wire_format = negotiate(rpacket.get('formats'), self._peer._formats)
+        if wire_format is not None:
+            packet['format'] = wire_format
+
     def _add_user_to_chat(self, user_info):
         user_info['host'] = tuple(user_info['host'])
         user_info['id'] = int(user_info['id'])
         host = user_info['host']
 
-        self._peer.connected[host] = user_info
+        self._peer._add_host(host, user_info)
         self._peer.id2host[user_info['id']] = host
+        self._peer._gossip.admit(self._peer.connected[host])
+        self._tombstones.pop(host, None)
+        if user_info.get('incarnation') is not None:
+            self._incarnations[host] = user_info['incarnation']
 
-        print('[+] Added %s to connected hosts list\n' % str(host))
-        print('[*] Now connected hosts are %s\n' % str(self._peer.connected.keys()))
+        LOGGER.debug('Added %s to connected hosts list', host)
+        LOGGER.debug('Now connected hosts are %s', self._peer.connected.keys())
 
     def _connect_resp(self, rpacket):
         ''' Empty function '''
@@ -105,132 +178,359 @@ class Handlers:
         side = rpacket['broadcast']['from_node_side']
         user_info = rpacket['broadcast']['user_info']
 
-        self._add_user_to_chat(user_info)
+        self._peer._tracer.finish(rpacket)
+        if self.__has_left(user_info):
+            LOGGER.debug('Ignoring new_user of %s that left the chat',
+                         user_info['host'])
+        else:
+            self._add_user_to_chat(user_info)
 
-        self._peer.send_broadcast_message(rpacket, closed=closed[side])
+        # Packet that is received via gossip has no closed neighbor
+        self._peer.send_broadcast_message(rpacket, closed=closed.get(side, []))
 
     def _disconnect(self, rpacket):
-        pass
+        '''
+        User left the chat or its node is failed. If the node is a link
+        of current node then the link is lost.
+        '''
+        peer = self._peer
+        closed = { 'parent': [peer._parent],
+                   'left':   [peer._left],
+                   'right':  [peer._right] }
+        side = rpacket['broadcast']['from_node_side']
+        user_info = rpacket['broadcast']['user_info']
+        user_id = user_info['id']
+        host = tuple(user_info['host'])
+
+        peer._tracer.finish(rpacket)
+        if user_id in (peer._left, peer._right, peer._parent):
+            peer._lose_link(user_id, notify=False)
+        elif host in peer.connected and peer.connected[host].id == user_id:
+            peer._remove_host(host)
+        LOGGER.debug('Removed %s from connected hosts list', host)
+        incarnation = self._incarnations.pop(host, None)
+        self.__bury(host, user_id, user_info.get('incarnation', incarnation))
+
+        peer.send_broadcast_message(rpacket, closed=closed.get(side, []))
+
+    def __bury(self, host, user_id, incarnation):
+        '''
+        Remember a member that left. Broadcasts are not ordered, e.g.
+        by gossip, so new_user of the member can come after disconnect.
+        '''
+        now = time.monotonic()
+        tombstones = self._tombstones
+        while tombstones and next(iter(tombstones.values()))[2] < now:
+            tombstones.popitem(last=False)
+        tombstones.pop(host, None)
+        tombstones[host] = (user_id, incarnation, now + TOMBSTONE_TTL)
+
+    def __has_left(self, user_info):
+        '''
+        Check if new_user is about a member that has left already. If
+        incarnation of the member differs then it has joined again.
+        Members whose incarnation is unknown, e.g. of older peers, are
+        treated as left until their tombstone expires.
+        '''
+        tombstone = self._tombstones.get(tuple(user_info['host']))
+        if tombstone is None:
+            return False
+        user_id, incarnation, expiry = tombstone
+        if expiry < time.monotonic() or user_id != int(user_info['id']):
+            return False
+        joined = user_info.get('incarnation')
+        return incarnation is None or joined is None or joined == incarnation
 
     def _ping(self, rpacket):
+        ''' Heartbeat of a link, it is counted on receiving of frame '''
         pass
 
+    def _message(self, rpacket):
+        ''' Message of the chat is received '''
+
+        self._peer._store_message(rpacket)
+
+    def _get_history(self, rpacket):
+        '''
+        Send stored messages of conversation between a client and "peer_id"
+        node. Messages are sent after "since_id" record or "since_time",
+        at most "limit" of them.
+        '''
+
+        conversation = self._peer._conversation(rpacket['from_id'],
+                                                rpacket['peer_id'])
+        packet = self._reverse_packet(rpacket, 'history')
+        records = []
+        if self._peer._db is not None:
+            records = self._peer._db.history(
+                conversation, rpacket.get('since_id'),
+                rpacket.get('since_time'), rpacket.get('limit'))
+        packet['messages'] = [{'id': record_id, 'time': timestamp,
+                               'message': message}
+                              for record_id, timestamp, message in records]
+        return packet
+
+    def _history(self, rpacket):
+        ''' Return fetched messages instead of a response '''
+
+        return rpacket['messages']
+
     def _get_chat_info(self, rpacket):
         '''
         If packet's type is 'get_chat_info' then new user want to
         fetch information about chat. In this case we should send it to
-        him
+        him. New users share snapshot of roster (see Admission)
         '''
 
         packet = self._peer._create_packet('chat_info', self._peer._id,
                                            -1, rpacket['to_host'],
                                            rpacket['from_host'])
-        packet['connected'] = self._get_connected()
+        self._set_roster(packet, rpacket, shared=True)
+        self._set_format(packet, rpacket)
 
-        print('[+] get_chat_info: Created response packet: %s\n' % packet)
+        LOGGER.debug('get_chat_info: Created response packet: %s', packet)
         return packet
 
-    def _get_connected(self):
-        connected = []
-        for host, data in self._peer.connected.items():
-            _data = copy.copy(data)
-            _data['host'] = host
-            connected.append(_data)
-        return connected
-
-    def _chat_info(self, rpacket):
+    def _set_roster(self, packet, rpacket, shared=False):
         '''
-        Process information that we received via get_chat_info request
+        Put members of the chat to response. If client knows our roster
+        at some epoch then only changes since it are sent. If client knows
+        roster of another host, e.g. of the seed, then members of buckets
+        that differ from its digest are sent. Else members are sent by
+        pages of "limit" size starting from "offset", and all pages are
+        taken from one snapshot of roster. Client that doesn't send
+        "limit" gets all members at once.
+
+        Args:
+            shared (bool) Snapshot is shared with other new clients, so
+                          it can be older than roster. Epoch of response
+                          is epoch of the snapshot then, and the client
+                          fetches the rest of changes on connect
         '''
 
-        ids = set()
-        print('[+] chat_info: Fetched list of connected hosts: {}\n'
-              .format(rpacket['connected']))
-        for host_data in rpacket['connected']:
-            host = tuple(host_data['host'])
-            _id = host_data['id']
-            username = host_data['username']
+        roster = self._peer._roster
+        packet['roster_uid'] = roster.uid
+        packet['epoch'] = roster.epoch
+
+        known = rpacket.get('roster')
+        if known is not None and known.get('uid') == roster.uid:
+            changes = roster.changes_since(known['epoch'])
+            if changes is not None:
+                packet['changes'] = changes
+                return
+
+        digest = rpacket.get('roster_digest')
+        if digest is not None:
+            buckets = roster.diff(digest)
+            if buckets is not None:
+                packet['buckets'] = [[idx, [member.to_dict()
+                                            for member in members]]
+                                     for idx, members in buckets]
+                return
+
+        snapshot_epoch = rpacket.get('snapshot_epoch')
+        if snapshot_epoch is None and shared:
+            snapshot_epoch = self._peer._admission.shared_epoch()
+        epoch, members = roster.snapshot(snapshot_epoch)
+        if shared:
+            packet['epoch'] = epoch
+        offset = rpacket.get('offset', 0)
+        # Snapshot is not kept anymore, so client starts again
+        if snapshot_epoch is not None and epoch != snapshot_epoch:
+            offset = 0
+        limit = rpacket.get('limit')
+        end = len(members) if limit is None else offset + limit
+
+        packet['connected'] = members[offset:end]
+        packet['offset'] = offset
+        packet['total'] = len(members)
+        packet['snapshot_epoch'] = epoch
 
-            self._peer._add_host(host, { 'id': _id, 'username': username })
-            self._peer.id2host[_id] = host
+    def _chat_info(self, rpacket):
+        '''
+        Process information that we received via get_chat_info request.
+        It is either a page of members, changes since roster that was
+        fetched before or buckets of members that differ from our roster.
+        '''
 
-            ids.add(_id)
-        if self._peer._id is None:
-            own_id = self._peer.generate_id(ids)
-            print('[+] Chosen id of current host: %d\n' % own_id)
-            self._peer._id = own_id
-
-    def _find_insert_place(self, rpacket, client_id=None, client_host=None,
-                           relay=False):
-        ''' Find node in the chat's tree for connecting client '''
-        if (client_id and client_host) is None:
-            client_id = rpacket['from_id']
-            client_host = tuple(rpacket['from_host'])
-        client = (client_id, client_host)
-
-        # If node position in subtree of current machine
-        if self._peer.low_bound < client_id < self._peer.up_bound:
-            # if less than current node
-            resp = None
-            if client_id < self._peer._id:
-                resp = self.__process_child('left', rpacket, client, relay)
-            else:
-                resp = self.__process_child('right', rpacket, client, relay)
-            if resp[0]:
-                if not relay:
-                    del self._peer._opened_connection[tuple(resp[1]['to_host'])]
-                return resp if relay else resp[1]
+        if 'changes' in rpacket:
+            LOGGER.debug('chat_info: Fetched changes of connected hosts: %s',
+                         rpacket['changes'])
+            for change in rpacket['changes']:
+                host = tuple(change['host'])
+                if change['op'] == 'remove':
+                    self._peer._remove_host(host)
+                else:
+                    self.__add_member(host, change)
+        elif 'buckets' in rpacket:
+            LOGGER.debug('chat_info: Fetched %d buckets of connected hosts',
+                         len(rpacket['buckets']))
+            self.__replace_buckets(rpacket['buckets'])
         else:
-            # Else in another subtree of parent
-            if not relay:
-                return self._make_relay(rpacket)
-        return (False,) if relay else False
-
-    def __process_child(self, child_side, packet, client, relay=False):
+            LOGGER.debug('chat_info: Fetched list of connected hosts: %s',
+                         rpacket['connected'])
+            for host_data in rpacket['connected']:
+                self.__add_member(tuple(host_data['host']), host_data)
+
+        if not self.__is_roster_fetched(rpacket):
+            return
+        if 'roster_uid' in rpacket:
+            epoch = rpacket['snapshot_epoch'] if 'connected' in rpacket \
+                else rpacket['epoch']
+            self._peer._roster_sync[tuple(rpacket['from_host'])] = {
+                'uid': rpacket['roster_uid'], 'epoch': epoch }
+        if self._peer._id is None:
+            own_id = self._peer.generate_id(set(self._peer.id2host))
+            LOGGER.info('Chosen id of current host: %d', own_id)
+            self._peer._assign_id(own_id)
+
+    def __add_member(self, host, host_data):
+        _id = host_data['id']
+        username = host_data['username']
+
+        self._peer._add_host(host, { 'id': _id, 'username': username })
+        self._peer.id2host[_id] = host
+
+    def __replace_buckets(self, buckets):
+        ''' Members of every given bucket become equal to members of it '''
+
+        peer = self._peer
+        buckets = {idx: {tuple(member['host']): member for member in members}
+                   for idx, members in buckets}
+        for host, member in list(peer.connected.items()):
+            bucket = buckets.get(peer._roster.bucket(member.id))
+            if bucket is not None and host not in bucket:
+                peer._remove_host(host)
+        for bucket in buckets.values():
+            for host, host_data in bucket.items():
+                self.__add_member(host, host_data)
+
+    def __is_roster_fetched(self, rpacket):
+        ''' Check if packet is the last page of roster or changes of it '''
+
+        if 'roster_uid' not in rpacket or 'connected' not in rpacket:
+            return True
+        return rpacket['offset'] + len(rpacket['connected']) >= \
+            rpacket['total']
+
+    def _find_insert_place(self, rpacket):
+        '''
+        Find node in the chat's tree for connecting client. Current host
+        is a seed host: client waits for insert_place on connection with it.
+        Clients that ask at the same time are placed by one batch.
         '''
-        Process childs of current node
+        self._peer._admission.place(rpacket['from_id'],
+                                    tuple(rpacket['from_host']))
 
-        Returns:
-            (tuple) First place is True if this host contains node for
-                    client else False. Second place is info about node place
+    def _place_client(self, rpacket):
         '''
-        client_id = client[0]
-        client_host = client[1]
-
-        if child_side == 'left':
-            node = self._peer._left
-            neighbor = self._peer._right
-            up_bound = self._peer._id
-            low_bound = self._peer.low_bound
-        else:
-            node = self._peer._right
-            neighbor = self._peer._left
-            up_bound = self._peer.up_bound
-            low_bound = self._peer._id
-
-        if node is None:
-            place_info = self._form_place(child_side, neighbor,
-                                          self._peer._host, up_bound, low_bound)
-            packet = self._reverse_packet(packet, TYPES['insert_place'],
-                                          relay=relay)
-            packet['place_info'] = place_info
-            print('[+] Found node location: {} for {}\n'
-                  .format(place_info, str(packet['from_host'])))
-            return (True, packet)
-        else:
-            # Else we should relay it
-            if not relay:
-                return self._make_relay(packet)
-        return (False,)
+        Request for place goes up to the lowest ancestor whose bounds
+        cover it, or to the root of the tree, then down to the lighter
+        subtree until a node has free child on that side. So no subtree
+        is denser than the chat, and height of the tree is logarithmic.
+        Request carries a batch of clients that is split between
+        subtrees on the way down, clients that don't fit are sent back
+        to the seed.
+        '''
+        peer = self._peer
+        place_dir = rpacket.get('place_dir', 'up')
+        if place_dir == 'retry':
+            return peer._admission.retry(rpacket['clients'])
+
+        # Request of a single client is sent by older peers
+        clients = rpacket.get('clients') or \
+            [[rpacket['client_id'], rpacket['client_host'], 0]]
+        if place_dir == 'up' and not peer._admission.covers(len(clients)):
+            return self.__relay_place_request(rpacket, peer._parent, 'up')
+        groups, rest = peer._admission.split(clients)
+        for side, group in groups.items():
+            child = peer._left if side == 'left' else peer._right
+            if child is None:
+                self.__send_place(rpacket, side, group[0])
+            else:
+                packet = self.__fork_place_request(rpacket, group)
+                self.__relay_place_request(packet, child, 'down')
+        if rest:
+            self.__return_place_request(rpacket, rest)
+
+    def __fork_place_request(self, rpacket, clients):
+        ''' Form request for a part of batch of clients '''
+        packet = {key: rpacket[key] for key in
+                  ('type', 'downtype', 'seed_id', 'seed_host', 'trace')
+                  if key in rpacket}
+        if 'trace' in packet:
+            packet['trace'] = list(packet['trace'])
+        packet['clients'] = clients
+        return packet
 
-    def _make_relay(self, packet):
-        if 'downtype' not in packet:
-            packet['downtype'] = packet['type']
-        packet['type'] = 'relay'
-        packet['client_id'] = packet['from_id']
-        packet['client_host'] = packet['from_host']
+    def __return_place_request(self, rpacket, clients):
+        ''' Send clients that don't fit the subtree back to the seed '''
+        peer = self._peer
+        seed_id, seed_host = self.__get_seed(rpacket)
+        LOGGER.debug('No place for %d clients, returning them to %s',
+                     len(clients), seed_host)
+        if seed_host == peer._host:
+            return peer._admission.retry(clients)
+        packet = self.__fork_place_request(rpacket, clients)
+        packet.update(from_id=peer._id, from_host=peer._host,
+                      to_id=seed_id, to_host=seed_host,
+                      place_dir='retry')
+        peer._send_reply(seed_host, packet)
+
+    def __relay_place_request(self, rpacket, host_id, direction):
+        host = self._peer.id2host[host_id]
+        rpacket['place_dir'] = direction
+        rpacket['from_id'], rpacket['from_host'] = self._peer._id, \
+            self._peer._host
+        rpacket['to_id'], rpacket['to_host'] = host_id, host
+
+        LOGGER.debug('Relaying packet %r to %s', rpacket, host)
+        self._count_relay(rpacket['downtype'])
+        self._peer._tracer.hop(rpacket)
+        self._peer.send_message(host, rpacket)
 
-        return self._relay(packet, first_run=True)
+    def __send_place(self, rpacket, side, client):
+        '''
+        Send free place to the seed host. Client gets id from the middle of
+        place bounds, so subtrees of it have equal ranges of ids.
+        '''
+        peer = self._peer
+        if side == 'left':
+            neighbor, low_bound, up_bound = peer._right, peer.low_bound, peer._id
+        else:
+            neighbor, low_bound, up_bound = peer._left, peer._id, peer.up_bound
+        place_info = self._form_place(side, neighbor, peer._host, up_bound,
+                                      low_bound)
+        place_info['id'] = int((low_bound + up_bound) // 2)
+        place_info['conn_id'] = peer._id
+
+        seed_id, seed_host = self.__get_seed(rpacket)
+        packet = peer._create_packet(TYPES['relay'], peer._id, seed_id,
+                                     peer._host, seed_host)
+        packet['downtype'] = TYPES['insert_place']
+        packet['client_id'] = client[0]
+        packet['client_host'] = client[1]
+        packet['place_info'] = place_info
+        LOGGER.debug('Found node location: %s for %s', place_info,
+                     packet['client_host'])
+
+        if seed_host == peer._host:
+            return self._relay(packet)
+        peer._send_reply(seed_host, packet)
+
+    def __get_seed(self, rpacket):
+        '''
+        Get id and host of the seed of request for place. Seed can be
+        missing in roster, e.g. if it left the chat, so its id is taken
+        from the request.
+        '''
+        seed_host = tuple(rpacket['seed_host'])
+        seed_id = rpacket.get('seed_id')
+        if seed_id is None:
+            # Request of older peer
+            member = self._peer.connected.get(seed_host)
+            seed_id = member.id if member is not None else -1
+        return seed_id, seed_host
 
     def _form_place(self, side, neighbor, conn_host, up_bound, low_bound):
         return { 'side': side,
@@ -239,14 +539,10 @@ class Handlers:
                  'up_bound': up_bound,
                  'low_bound': low_bound }
 
-    def _reverse_packet(self, packet, _type, relay=False):
+    def _reverse_packet(self, packet, _type):
         to_id = packet['to_id']
         to_host = packet['to_host']
-        if relay:
-            packet['type'] = 'relay'
-            packet['downtype'] = _type
-        else:
-            packet['type'] = _type
+        packet['type'] = _type
 
         packet['to_id'], packet['to_host'] = packet['from_id'], packet['from_host']
         packet['from_id'], packet['from_host'] = to_id, to_host
@@ -264,58 +560,148 @@ class Handlers:
         self._peer.low_bound = place_info['low_bound']
         self._peer._side = place_info['side']
         self._peer._neighbor = place_info['neighbor']
-        self._peer._parent = self._peer.connected[parent]['id']
+        if 'conn_id' in place_info:
+            # Parent could join after roster was fetched
+            self._peer._parent = place_info['conn_id']
+            self._peer.id2host[self._peer._parent] = parent
+        else:
+            self._peer._parent = self._peer.connected[parent].id
 
-        # return rpacket
+        # Place is found for id that is given by the node
+        _id = place_info.get('id')
+        if _id is not None and _id != self._peer._id:
+            self._peer.id2host.pop(self._peer._id, None)
+            self._peer.id2host[_id] = self._peer._host
+            self._peer._assign_id(_id)
 
+    def _reattach(self, rpacket):
+        '''
+        Find place for a subtree whose parent is failed. Request goes up
+        until bounds of a node contain id of the subtree, then down to
+        the node that has free child on the side of the id.
+        '''
+        peer = self._peer
+        client_id = rpacket['client_id']
+        if client_id == peer._id:
+            return
+        lost_id = rpacket.get('lost_id')
+        if lost_id is not None and \
+                lost_id in (peer._left, peer._right, peer._parent):
+            # Subtree detected failure of the node before current one
+            self.__drop_link(lost_id)
+
+        if peer._parent is None and not peer._is_root:
+            # Current node is the root of another orphaned subtree
+            return self.__reattach_orphan(rpacket)
+        if not peer.low_bound < client_id < peer.up_bound:
+            return self.__relay_reattach(rpacket, peer._parent)
+
+        side = 'left' if client_id < peer._id else 'right'
+        child = peer._left if side == 'left' else peer._right
+        if child is not None and child != client_id:
+            return self.__relay_reattach(rpacket, child)
+        if child == client_id:
+            # Connection with the subtree is broken, place is free again
+            if side == 'left':
+                peer._left = None
+            else:
+                peer._right = None
 
-    def _relay(self, rpacket, first_run=False):
+        if side == 'left':
+            neighbor, low_bound, up_bound = peer._right, peer.low_bound, peer._id
+        else:
+            neighbor, low_bound, up_bound = peer._left, peer._id, peer.up_bound
+        client_host = tuple(rpacket['client_host'])
+        packet = peer._create_packet(TYPES['reattach_place'], peer._id,
+                                     client_id, peer._host, client_host)
+        packet['place_info'] = self._form_place(side, neighbor, peer._host,
+                                                up_bound, low_bound)
+        packet['place_info']['conn_id'] = peer._id
+        LOGGER.debug('Found node location: %s for subtree of %s',
+                     packet['place_info'], client_host)
+        peer._send_reply(client_host, packet)
+
+    def __reattach_orphan(self, rpacket):
         '''
-        Relay message to the right direction
+        Subtree of current node is reattached too, so request is passed
+        to its ancestor. If there is no one then the failed node was
+        the root, and the root of the subtree with less id becomes
+        the root of the chat.
         '''
+        peer = self._peer
+        repair = peer._repair
+        host = repair.ancestor() if repair is not None else None
+        if host is not None:
+            rpacket['to_id'], rpacket['to_host'] = \
+                peer.connected[host].id, host
+            peer._send_reply(host, rpacket)
+        elif peer._id < rpacket['client_id']:
+            peer._become_root()
+            self._reattach(rpacket)
+
+    def __drop_link(self, link_id):
+        ''' Close connection with a failed link, so the link is lost '''
+
+        peer = self._peer
+        sock = peer._opened_connection.get(peer.id2host.get(link_id))
+        peer._lose_link(link_id)
+        if sock is not None:
+            peer._reactor.call_soon(peer._close_sock, sock)
+
+    def __relay_reattach(self, rpacket, host_id):
+        host = self._peer.id2host[host_id]
+        rpacket['from_id'], rpacket['from_host'] = self._peer._id, \
+            self._peer._host
+        rpacket['to_id'], rpacket['to_host'] = host_id, host
+
+        LOGGER.debug('Relaying packet %r to %s', rpacket, host)
+        self._count_relay(rpacket['type'])
+        self._peer._tracer.hop(rpacket)
+        self._peer.send_message(host, rpacket)
 
-        if not first_run and rpacket['downtype'] == 'find_insert_place':
-            check_packet = copy.copy(rpacket)
-            check_packet['type'] = check_packet['downtype']
-            del check_packet['downtype']
+    def _reattach_place(self, rpacket):
+        ''' Place for the subtree of current node is found '''
 
-            resp = self._find_insert_place(rpacket, rpacket['client_id'],
-                                           rpacket['client_host'], relay=True)
-            # If current machine have node position for asking client
-            if resp[0]:
-                return resp[1]
+        repair = self._peer._repair
+        if repair is not None and not repair.repaired.done():
+            repair.set_place(rpacket['place_info'])
+
+    def _bounds(self, rpacket):
+        ''' Parent changed bounds of current node, e.g. after repair '''
+
+        bounds = rpacket['low_bound'], rpacket['up_bound']
+        if bounds != (self._peer.low_bound, self._peer.up_bound):
+            self._peer._set_bounds(*bounds)
+
+    def _gossip_digest(self, rpacket):
+        ''' Ids of recent packets of gossip of another member '''
+        self._peer._gossip.on_digest(rpacket)
+
+    def _relay(self, rpacket):
+        '''
+        Relay message to the right direction
+        '''
+
+        downtype = rpacket['downtype']
+        if downtype == TYPES['find_insert_place']:
+            return self._place_client(rpacket)
 
         # If receiver is found
-        if not first_run and tuple(rpacket['to_host']) == self._peer._host:
-            rpacket['type'] = rpacket['downtype']
+        host = tuple(rpacket['to_host'])
+        if host == self._peer._host:
+            self._peer._tracer.finish(rpacket)
+            rpacket['type'] = downtype
             del rpacket['downtype']
-            if rpacket['type'] == 'insert_place':
+            if downtype == TYPES['insert_place']:
                 return self._insert_place_server_proc(rpacket)
-            else:
-                # TODO Not sure this will work
-                return self._table[rpacket['type']].handle(rpacket)
-
-        from_id = rpacket['from_id']
-        host = None
-        # Receiver in our subtree
-        if self._peer.low_bound < from_id < self._peer.up_bound:
-            if from_id < self._peer._id:
-                host_id = self._peer._left
-            else:
-                host_id = self._peer._right
-        else:
-            host_id = self._peer._parent
-        host = self._peer.id2host[host_id]
-
-        rpacket['from_host'] = self._peer._host
-        rpacket['from_id'] = self._peer._id
-        rpacket['to_host'] = host
-        rpacket['to_id'] = host_id
+            return self._table[downtype].handle(rpacket)
 
-        print('[*] Relaying packet {} to {}\n'
-              .format(rpacket, rpacket['to_host']))
+        if downtype == TYPES['message']:
+            self._peer._store_message(rpacket)
+        LOGGER.debug('Relaying packet %r to %s', rpacket, host)
+        self._count_relay(downtype)
+        self._peer._tracer.hop(rpacket)
         self._peer.send_message(host, rpacket)
-        return (None,)
 
     def _insert_place_server_proc(self, rpacket):
         tmp = [['from_id', 'from_host'], ['to_id', 'to_host'],
@@ -326,15 +712,36 @@ class Handlers:
         for _ in range(2):
             del rpacket[tmp[-1][_]]
         host = tuple(rpacket['to_host'])
-        sock = self._peer._send_temp_message(host, rpacket)
-        self._peer._inputs.remove(sock)
-        sock.close()
-        del self._peer._opened_connection[host]
+        self._peer._send_reply(host, rpacket)
+        # Greeting connection is not a connection with a node of the tree
+        self._peer._opened_connection.pop(host, None)
 
 
 class Handle:
-    def __init__(self, proc_func):
+    '''
+    Fields:
+        offload (bool) Handler can be slow, e.g. it reads history from
+                       disk, so it is run on the pool of threads of
+                       the peer. Handlers that change state of the node
+                       or wire format of connection must not be
+                       offloaded
+        packets (Counter) Number of handled packets or None if handler
+                          is not counted
+        latency (Histogram) Time of handling in seconds
+    '''
+
+    def __init__(self, proc_func, offload=False):
         self._proc_func = proc_func
+        self.offload = offload
+        self.packets = None
+        self.latency = None
 
     def handle(self, packet):
-        return self._proc_func(packet)
+        if self.packets is None:
+            return self._proc_func(packet)
+        self.packets.inc()
+        start = time.perf_counter()
+        try:
+            return self._proc_func(packet)
+        finally:
+            self.latency.observe(time.perf_counter() - start)
@@ -0,0 +1,247 @@
+'''
+Module contains Handshake class. Handshake is a state machine of
+joining of a BinaryTreePeer to the chat:
+
+    GREETING -> ASSIGNING_ID -> FINDING_PLACE -> CONNECTING -> JOINED
+
+Every step has a timeout. A step that fails with a network error or
+a timeout is retried after a delay that grows exponentially, and when
+retries are exhausted handshake goes to FAILED state. Result of
+handshake is a future, so a caller waits on it without spinning, and
+several peers of one process can join their chats concurrently.
+
+Vars:
+    TIMEOUT (float) Default timeout of one step in seconds
+    RETRIES (int) Default number of retries of failed steps
+    BACKOFF (float) Delay before the first retry in seconds
+    MAX_BACKOFF (float) Max delay between retries in seconds
+'''
+
+import asyncio
+import logging
+import time
+
+from concurrent.futures import Future
+
+
+LOGGER = logging.getLogger(__name__)
+TIMEOUT = 10
+RETRIES = 5
+BACKOFF = 0.1
+MAX_BACKOFF = 5
+
+GREETING = 'greeting'
+ASSIGNING_ID = 'assigning_id'
+FINDING_PLACE = 'finding_place'
+CONNECTING = 'connecting'
+JOINED = 'joined'
+FAILED = 'failed'
+
+
+class HandshakeError(Exception):
+    ''' Raised when peer can't join to the chat '''
+
+
+class Handshake:
+    '''
+    Joining of a peer to the chat
+
+    Fields:
+        state (str) Current state of handshake
+        joined (Future) Future that is resolved when peer is joined
+        _server_host (tuple) IP and port of a host of the chat
+        _sock (socket) Socket for greeting requests to server host. It
+                       is taken from connection pool of the peer
+        _attempt (int) Number of failed steps
+        _started (float) Time when handshake was started
+    '''
+
+    def __init__(self, peer, server_host, timeout=TIMEOUT, retries=RETRIES,
+                 backoff=BACKOFF):
+        self._peer = peer
+        self._server_host = server_host
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+
+        self.state = GREETING
+        self.joined = Future()
+        self._sock = None
+        self._attempt = 0
+        self._started = None
+
+    def start(self, state=GREETING):
+        '''
+        Run handshake in background
+
+        Args:
+            state (str) State to start from, e.g. CONNECTING if place
+                        of the peer is known
+        Return:
+            (Future) Future that is resolved when peer is joined
+        '''
+
+        self.state = state
+        self._started = time.monotonic()
+        reactor = self._peer._reactor
+        if self._peer._backend == 'asyncio':
+            reactor.wait_ready()
+            asyncio.run_coroutine_threadsafe(self.run_async(), reactor.loop)
+        else:
+            self._peer._add_work(self.run)
+        return self.joined
+
+    def run(self):
+        steps = {
+            GREETING: self._greet,
+            ASSIGNING_ID: self._assign_id,
+            FINDING_PLACE: self._find_place,
+            CONNECTING: self._connect
+        }
+        try:
+            while self.state in steps:
+                state, start = self.state, time.monotonic()
+                try:
+                    steps[state]()
+                    self._observe_step(state, start)
+                except OSError as e:
+                    delay = self._on_error(e)
+                    if delay is not None:
+                        time.sleep(delay)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._close_sock()
+
+    async def run_async(self):
+        ''' Coroutine version of run for asyncio backend '''
+
+        steps = {
+            GREETING: self._greet_async,
+            ASSIGNING_ID: self._assign_id_async,
+            FINDING_PLACE: self._find_place_async,
+            CONNECTING: self._connect_async
+        }
+        try:
+            while self.state in steps:
+                state, start = self.state, time.monotonic()
+                try:
+                    await asyncio.wait_for(steps[state](), self._timeout)
+                    self._observe_step(state, start)
+                except (OSError, asyncio.TimeoutError) as e:
+                    delay = self._on_error(e)
+                    if delay is not None:
+                        await asyncio.sleep(delay)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._close_sock()
+
+    def _observe_step(self, state, start):
+        self._peer.metrics.histogram('join_step_seconds', step=state) \
+            .observe(time.monotonic() - start)
+
+    def _on_error(self, error):
+        '''
+        Prepare retry of a failed step
+
+        Return:
+            (float) Delay before retry or None if handshake is failed
+        '''
+
+        self._close_sock()
+        self._attempt += 1
+        self._peer.metrics.counter('join_retries_total', step=self.state).inc()
+        if self._attempt > self._retries:
+            self._fail(error)
+            return None
+        delay = min(self._backoff * 2 ** (self._attempt - 1), MAX_BACKOFF)
+        LOGGER.warning('Step %s failed: %s. Retrying in %.2f s',
+                       self.state, error, delay)
+        return delay
+
+    def _fail(self, error):
+        LOGGER.error('Failed to join to %s: %s', self._server_host, error)
+        self._peer.metrics.counter('join_failures_total').inc()
+        self.state = FAILED
+        self.joined.set_exception(HandshakeError(
+            'Failed to join to {}: {}'.format(self._server_host, error)))
+
+    def _release_sock(self):
+        ''' Return greeting socket to the pool, e.g. for connect request '''
+
+        if self._sock is not None:
+            self._peer._pool.put(self._server_host, self._sock)
+            self._sock = None
+
+    def _close_sock(self):
+        if self._sock is not None:
+            self._peer._pool.discard(self._sock)
+            self._sock = None
+
+    def _get_sock(self):
+        if self._sock is None:
+            self._sock = self._peer._pool.connect(self._server_host,
+                                                  self._timeout)
+        return self._sock
+
+    async def _get_sock_async(self):
+        if self._sock is None:
+            self._sock = await self._peer._pool_connect_async(
+                self._server_host)
+        return self._sock
+
+    def _greet(self):
+        self._peer._get_chat_info(self._server_host, self._get_sock())
+        self.state = ASSIGNING_ID
+
+    async def _greet_async(self):
+        sock = await self._get_sock_async()
+        await self._peer._get_chat_info_async(self._server_host, sock)
+        self.state = ASSIGNING_ID
+
+    def _assign_id(self):
+        if not self._peer._wait_node_data(self._timeout):
+            raise TimeoutError('Id of peer is not assigned')
+        self.state = FINDING_PLACE
+
+    async def _assign_id_async(self):
+        # Id is assigned by chat_info handler on the loop thread
+        if self._peer._id is None:
+            raise TimeoutError('Id of peer is not assigned')
+        self.state = FINDING_PLACE
+
+    def _find_place(self):
+        self._peer._find_insert_place(self._server_host, self._get_sock())
+        self._release_sock()
+        self.state = CONNECTING
+
+    async def _find_place_async(self):
+        sock = await self._get_sock_async()
+        await self._peer._find_insert_place_async(self._server_host, sock)
+        self._release_sock()
+        self.state = CONNECTING
+
+    def _connect(self):
+        parent_host = self._peer.id2host[self._peer._parent]
+        if not self._peer._try_connect(parent_host, self._timeout):
+            self._reject()
+        self._join()
+
+    async def _connect_async(self):
+        parent_host = self._peer.id2host[self._peer._parent]
+        if not await self._peer._try_connect_async(parent_host):
+            self._reject()
+        self._join()
+
+    def _reject(self):
+        # Place was taken by another peer, so a new one is searched
+        self.state = FINDING_PLACE
+        raise ConnectionRefusedError('Insertion place is taken')
+
+    def _join(self):
+        self._peer._inform_about_connected()
+        self._peer.metrics.histogram('join_seconds').observe(
+            time.monotonic() - self._started)
+        self.state = JOINED
+        self.joined.set_result(True)
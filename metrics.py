@@ -0,0 +1,271 @@
+'''
+Module contains Metrics registry of a peer and MetricsServer that
+exports it. Metric is created once and is kept by the code that
+updates it, so hot paths only change a number: there are no lookups
+and no locks. An update that races with another thread can be lost,
+which is an accepted error of statistics.
+
+Registry is read via snapshot, a dict that is ready for JSON, or via
+text in Prometheus exposition format that MetricsServer serves
+on a local port.
+
+Vars:
+    BUCKETS (tuple) Default upper bounds of histogram buckets in seconds
+'''
+
+import bisect
+import json
+import logging
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+LOGGER = logging.getLogger(__name__)
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+
+class Counter:
+    ''' Value that only grows, e.g. number of packets '''
+
+    __slots__ = ('value',)
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def read(self):
+        return self.value
+
+
+class Gauge:
+    ''' Value that goes up and down, e.g. size of a queue '''
+
+    __slots__ = ('value',)
+    kind = 'gauge'
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def read(self):
+        return self.value
+
+
+class Histogram:
+    '''
+    Distribution of values, e.g. of latencies
+
+    Fields:
+        bounds (tuple) Upper bounds of buckets, the last bucket is
+                       unbounded
+        counts (list) Number of values in every bucket
+        sum (float) Sum of values
+        count (int) Number of values
+    '''
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+    kind = 'histogram'
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def read(self):
+        ''' Cumulative counts of buckets, as in Prometheus '''
+
+        buckets = {}
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            buckets[str(bound)] = total
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+class Metrics:
+    '''
+    Registry of metrics
+
+    Fields:
+        _metrics (dict) Matching between name of metric and a dict of its
+                        label sets and metrics
+        _callbacks (dict) Matching between name of gauge that is read on
+                          export and function and label of it. Function
+                          returns a dict of label values and values
+    '''
+
+    def __init__(self):
+        self._metrics = {}
+        self._callbacks = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name, **labels):
+        return self._get(Gauge, name, labels)
+
+    def histogram(self, name, buckets=BUCKETS, **labels):
+        return self._get(Histogram, name, labels, buckets)
+
+    def gauge_callback(self, name, func, label):
+        '''
+        Add gauges whose values are computed on export, e.g. sizes
+        of outbound buffers of all connections
+
+        Args:
+            func (callable) Function that returns a dict of values of
+                            the label and values of gauges
+            label (str) Name of label
+        '''
+
+        self._callbacks[name] = (func, label)
+
+    def _get(self, cls, name, labels, *args):
+        key = tuple(sorted(labels.items()))
+        family = self._metrics.get(name)
+        metric = family.get(key) if family is not None else None
+        if metric is not None:
+            return metric
+        with self._lock:
+            family = self._metrics.setdefault(name, {})
+            if key not in family:
+                family[key] = cls(*args)
+            metric = family[key]
+        if not isinstance(metric, cls):
+            raise TypeError('Metric %s is a %s' % (name, metric.kind))
+        return metric
+
+    def _collect(self):
+        ''' Yield name, kind, labels and value of every metric '''
+
+        with self._lock:
+            families = [(name, list(family.items()))
+                        for name, family in self._metrics.items()]
+        for name, family in sorted(families):
+            for key, metric in family:
+                yield name, metric.kind, dict(key), metric.read()
+        for name, (func, label) in sorted(self._callbacks.items()):
+            try:
+                values = func()
+            except Exception as e:
+                LOGGER.warning('Failed to read metric %s: %r', name, e)
+                continue
+            for label_value, value in values.items():
+                yield name, Gauge.kind, {label: str(label_value)}, value
+
+    def snapshot(self):
+        '''
+        Get values of all metrics
+
+        Return:
+            (dict) Matching between name of metric and list of dicts with
+                   labels and value of it. Value of histogram is a dict
+                   with count, sum and cumulative counts of buckets
+        '''
+
+        snapshot = {}
+        for name, kind, labels, value in self._collect():
+            snapshot.setdefault(name, []).append({'labels': labels,
+                                                  'value': value})
+        return snapshot
+
+    def render(self):
+        ''' Get values of all metrics in Prometheus text format '''
+
+        lines = []
+        typed = set()
+        for name, kind, labels, value in self._collect():
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s %s' % (name, kind))
+            if kind != Histogram.kind:
+                lines.append('%s%s %s' % (name, _format_labels(labels),
+                                          value))
+                continue
+            for bound, count in value['buckets'].items():
+                lines.append('%s_bucket%s %d' % (
+                    name, _format_labels(dict(labels, le=bound)), count))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels),
+                                          value['sum']))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels),
+                                            value['count']))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+                             for key, value in sorted(labels.items()))
+
+
+class MetricsServer:
+    '''
+    HTTP server that exports metrics of a peer. "/metrics.json" returns
+    snapshot, other JSON paths are added via add_json, and any other
+    path returns text format.
+
+    Fields:
+        address (tuple) IP and port that the server is bound to
+        _json (dict) Matching between a path and function that returns
+                     data of it
+    '''
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        self._json = {'/metrics.json': metrics.snapshot}
+        routes = self._json
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path in routes:
+                    body = json.dumps(routes[self.path]()).encode()
+                    content_type = 'application/json'
+                else:
+                    body = metrics.render().encode()
+                    content_type = 'text/plain; version=0.0.4'
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                LOGGER.debug('Metrics request: ' + format, *args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.address = self._server.server_address
+
+    def add_json(self, path, func):
+        ''' Serve data that func returns on path as JSON '''
+
+        self._json[path] = func
+
+    def start(self):
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,157 @@
+'''
+Module contains OutboundBuffer class. It is a bounded buffer of frames
+that should be sent to one connection.
+
+Size of buffer is limited by watermarks: when it exceeds high watermark
+the connection is paused, so senders are told to slow down, and it is
+resumed when buffer drains below low watermark. Frames that don't fit
+to the hard limit are dropped, so memory stays bounded even if senders
+ignore backpressure.
+
+Optionally small frames are batched: a buffer becomes due for sending
+only when batch window elapses since the first frame of a batch or
+batch size is reached, so many tiny packets to one neighbor go out
+by one syscall. Nagle's algorithm is disabled on connections
+(TCP_NODELAY), batching is done by peer instead.
+
+Vars:
+    HIGH_WATER (int) Default high watermark in bytes
+    LOW_WATER (int) Default low watermark in bytes
+    MAX_BUFFER (int) Default hard limit of buffer in bytes
+    IOV_MAX (int) Max number of frames that are sent by one call
+    BATCH_SIZE (int) Default size of batch after which it is sent
+                     without waiting for the end of batch window
+'''
+
+import logging
+import socket
+import time
+
+from collections import deque
+
+
+LOGGER = logging.getLogger(__name__)
+HIGH_WATER = 1024 * 1024
+LOW_WATER = 256 * 1024
+MAX_BUFFER = 16 * 1024 * 1024
+IOV_MAX = 64
+BATCH_SIZE = 16 * 1024
+
+
+class OutboundBuffer:
+    '''
+    Frames that should be sent to a connection
+
+    Fields:
+        high_water (int) Size after which the connection is paused
+        low_water (int) Size below which the connection is resumed
+        max_size (int) Hard limit of size of buffer
+        paused (bool) True if senders should slow down
+        batch_window (float) Max delay of a frame in seconds. Frames are
+                             sent as soon as possible if it is 0
+        batch_size (int) Size of batch that is sent without delay
+        deadline (float) Time when the current batch must be sent
+        _frames (deque) Frames to send, the first one can be sent partly
+        _size (int) Size of frames in bytes
+    '''
+
+    def __init__(self, high_water=HIGH_WATER, low_water=LOW_WATER,
+                 max_size=MAX_BUFFER, batch_window=0, batch_size=BATCH_SIZE):
+        self.high_water = high_water
+        self.low_water = low_water
+        self.max_size = max_size
+        self.paused = False
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.deadline = None
+        self._frames = deque()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __bool__(self):
+        return bool(self._frames)
+
+    def append(self, frame):
+        '''
+        Add frame to the buffer
+
+        Return:
+            (bool) False if the connection is paused, None if frame is
+                   dropped
+        '''
+
+        if self._size + len(frame) > self.max_size:
+            LOGGER.warning('Outbound buffer is full, dropping %d bytes',
+                           len(frame))
+            return None
+        self._frames.append(frame)
+        self._size += len(frame)
+        if self.batch_window and self.deadline is None:
+            self.deadline = time.monotonic() + self.batch_window
+        if self._size > self.high_water:
+            self.paused = True
+        return not self.paused
+
+    def is_due(self, now=None):
+        ''' Check if buffered frames should be sent now '''
+
+        if not self._frames:
+            return False
+        if not self.batch_window or self._size >= self.batch_size:
+            return True
+        return (now or time.monotonic()) >= self.deadline
+
+    def send_to(self, sock):
+        '''
+        Send as many frames as the socket accepts. Several frames are
+        coalesced to one sendmsg call.
+
+        Return:
+            (bool) True if the buffer is empty
+        '''
+
+        while self._frames:
+            try:
+                sent = self._send(sock)
+            except (BlockingIOError, InterruptedError):
+                return False
+            self._consume(sent)
+            if self._frames and not sent:
+                return False
+        return True
+
+    def _send(self, sock):
+        if len(self._frames) == 1 or not hasattr(sock, 'sendmsg'):
+            return sock.send(self._frames[0])
+        frames = [self._frames[idx]
+                  for idx in range(min(len(self._frames), IOV_MAX))]
+        return sock.sendmsg(frames)
+
+    def _consume(self, nbytes):
+        ''' Drop nbytes that were sent from the head of the buffer '''
+
+        self._size -= nbytes
+        frames = self._frames
+        while nbytes:
+            frame = frames[0]
+            if nbytes < len(frame):
+                frames[0] = memoryview(frame)[nbytes:]
+                break
+            nbytes -= len(frame)
+            frames.popleft()
+        if not frames:
+            self.deadline = None
+        if self.paused and self._size <= self.low_water:
+            self.paused = False
+
+
+def set_nodelay(sock):
+    ''' Disable Nagle's algorithm, small frames are batched by peer '''
+
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        # Not a TCP socket
+        pass
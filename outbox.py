@@ -0,0 +1,253 @@
+'''
+Module contains Outbox class. Outbox is a store-and-forward queue of
+packets that can't be delivered now, e.g. a receiver is not in the
+chat or a link towards it is broken. Packets are kept in DBHelper log
+on disk, one conversation per receiver, so they survive restart of
+a peer.
+
+When a route comes back, queue of a receiver is drained by batches
+from a background thread. A packet is delivered when outbound buffer
+of the connection takes it, a packet that is dropped by a full buffer
+is sent again on the next drain. Delivered batch is acknowledged by
+a record in the log, and segments that contain only delivered packets
+are deleted. A queue that stays undeliverable longer than TTL is
+dropped, so one receiver that never comes back doesn't keep the log
+forever. A packet whose id is already waiting in a queue is not queued
+again, so retries of senders don't multiply traffic after recovery.
+
+Vars:
+    BATCH (int) Default number of packets that are read from disk at once
+    RETRY_INTERVAL (float) Default delay in seconds between attempts to
+                           drain queues if routes don't come back
+    QUEUE_TTL (float) Default time in seconds after which a queue without
+                      deliveries is dropped
+    ACKS (str) Conversation of the log with acknowledgements of queues
+'''
+
+import logging
+import socket
+import threading
+import time
+
+from db_helper import DBHelper
+
+
+LOGGER = logging.getLogger(__name__)
+BATCH = 256
+RETRY_INTERVAL = 5
+QUEUE_TTL = 3600
+ACKS = 'acks'
+
+
+class Outbox:
+    '''
+    Disk-backed queues of undelivered packets
+
+    Fields:
+        batch (int) Number of packets that are read from disk at once
+        retry_interval (float) Delay between attempts to drain queues
+        ttl (float) Time after which a queue without deliveries is dropped
+        _db (DBHelper) Log of queued packets and acknowledgements
+        _send (callable) Sends packet to a host. It returns False if
+                         connection is paused, None if packet is dropped,
+                         and raises KeyError or socket.error if there is
+                         no route to the host
+        _acked (dict) Matching between a queue and id of its last
+                      delivered record
+        _pending (dict) Matching between a queue that has undelivered
+                        packets and its _Queue
+        _wakeup (Event) Set when a route may have come back
+    '''
+
+    def __init__(self, path, send, batch=BATCH,
+                 retry_interval=RETRY_INTERVAL, ttl=QUEUE_TTL):
+        self.batch = batch
+        self.retry_interval = retry_interval
+        self.ttl = ttl
+        self._db = DBHelper(path)
+        self._send = send
+        self._acked = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+        self._load()
+        thread = threading.Thread(target=self._drain_loop, daemon=True)
+        thread.start()
+
+    def __len__(self):
+        return sum(pending.size for pending in list(self._pending.values()))
+
+    def __contains__(self, host):
+        ''' Check if there are queued packets to a host '''
+
+        return bool(self._pending) and _queue_name(host) in self._pending
+
+    def put(self, host, packet):
+        '''
+        Queue packet to a host
+
+        Return:
+            (bool) False if a packet with the same id is queued already
+        '''
+
+        queue = _queue_name(host)
+        # Received packet is stored as a dict of its fields
+        packet = dict(packet)
+        msg_id = packet.get('msg_id')
+        with self._lock:
+            pending = self._pending.get(queue)
+            if pending is not None and msg_id is not None and \
+                    msg_id in pending.ids:
+                return False
+            record_id = self._db.append(queue, packet)
+            if pending is None:
+                pending = self._pending[queue] = _Queue(record_id)
+            pending.add(record_id, msg_id)
+        LOGGER.debug('Queued packet to %s', host)
+        return True
+
+    def wake(self):
+        ''' Try to drain queues, since a route may have come back '''
+
+        if self._pending:
+            self._wakeup.set()
+
+    def _load(self):
+        ''' Restore acknowledgements and queued packets from disk '''
+
+        for _, _, ack in self._db.history(ACKS):
+            self._acked[ack['queue']] = ack['id']
+        for queue in self._db.conversations():
+            if queue == ACKS:
+                continue
+            records = self._db.history(queue, self._acked.get(queue))
+            if records:
+                pending = self._pending[queue] = _Queue(records[0][0])
+                for record_id, _, packet in records:
+                    pending.add(record_id, packet.get('msg_id'))
+
+    def _drain_loop(self):
+        while True:
+            self._wakeup.wait(self.retry_interval)
+            self._wakeup.clear()
+            self._expire()
+            for queue in list(self._pending):
+                try:
+                    self._drain(queue)
+                except Exception:
+                    LOGGER.exception('Failed to drain queue %s', queue)
+            self._drop_delivered()
+
+    def _drain(self, queue):
+        ''' Send packets of queue while there is a route to its host '''
+
+        host = _queue_host(queue)
+        while True:
+            records = self._db.history(queue, self._acked.get(queue),
+                                       limit=self.batch)
+            if not records:
+                return
+            delivered = None
+            try:
+                for record_id, _, packet in records:
+                    accepted = self._send(host, packet)
+                    # Buffer is full, packet is sent on the next drain
+                    if accepted is None:
+                        break
+                    delivered = record_id
+                    # Connection is over its high watermark
+                    if not accepted:
+                        break
+            except (KeyError, socket.error) as e:
+                LOGGER.debug('No route to %s yet: %s', host, e)
+            if delivered is None:
+                return
+            self._ack(queue, records, delivered)
+            if delivered != records[-1][0]:
+                return
+
+    def _ack(self, queue, records, last_id):
+        ''' Mark records of queue up to last_id as delivered '''
+
+        with self._lock:
+            self._db.append(ACKS, {'queue': queue, 'id': last_id})
+            self._acked[queue] = last_id
+            pending = self._pending[queue]
+            pending.since = time.monotonic()
+            first = None
+            for record_id, _, packet in records:
+                if record_id > last_id:
+                    first = record_id
+                    break
+                pending.size -= 1
+                pending.ids.discard(packet.get('msg_id'))
+            if not pending.size:
+                del self._pending[queue]
+            elif first is not None:
+                pending.first = first
+            else:
+                pending.first = self._db.history(queue, last_id,
+                                                 limit=1)[0][0]
+        LOGGER.debug('Delivered queued packets to %s up to %d', queue,
+                     last_id)
+
+    def _expire(self):
+        ''' Drop queues that had no deliveries for longer than TTL '''
+
+        expired = time.monotonic() - self.ttl
+        for queue in [queue for queue, pending in list(self._pending.items())
+                      if pending.since < expired]:
+            with self._lock:
+                pending = self._pending.pop(queue)
+                self._db.append(ACKS, {'queue': queue, 'id': pending.last})
+                self._acked[queue] = pending.last
+            LOGGER.warning('Dropping %d packets to %s: it is unreachable '
+                           'for %d s', pending.size, queue, self.ttl)
+
+    def _drop_delivered(self):
+        ''' Delete segments of the log that have no undelivered packets '''
+
+        with self._lock:
+            first = [pending.first for pending in self._pending.values()]
+        # Acknowledgements of queues in deleted segments are not needed,
+        # since their packets are deleted too
+        self._db.drop_before(min(first, default=self._db.next_id))
+
+
+class _Queue:
+    '''
+    Undelivered packets of a receiver
+
+    Fields:
+        first (int) Id of the first undelivered record
+        last (int) Id of the last record
+        size (int) Number of undelivered records
+        ids (set) Ids of queued packets, they are used for deduplication
+        since (float) Time of the last delivery to the receiver, or of
+                      queueing if there was no delivery
+    '''
+
+    __slots__ = ('first', 'last', 'size', 'ids', 'since')
+
+    def __init__(self, first):
+        self.first = first
+        self.last = first
+        self.size = 0
+        self.ids = set()
+        self.since = time.monotonic()
+
+    def add(self, record_id, msg_id):
+        self.last = record_id
+        self.size += 1
+        if msg_id is not None:
+            self.ids.add(msg_id)
+
+
+def _queue_name(host):
+    return '%s:%d' % tuple(host)
+
+
+def _queue_host(queue):
+    ip, port = queue.rsplit(':', 1)
+    return (ip, int(port))
@@ -0,0 +1,138 @@
+'''
+Module contains Packet class. Packet is a received packet of the chat
+whose header is decoded at once and whose body is decoded only when
+a handler reads a field of it. Header contains fields that are needed
+to route a packet, its id and its trace (see tracing module), so a relayed
+packet is forwarded with its body as it was received, if both
+connections use the same wire format.
+
+Vars:
+    HEADER_FIELDS (tuple) Fields of packet that are placed to its header
+    REQUIRED_FIELDS (int) Number of first fields of header that every
+                          packet has. Other fields of header are missing
+                          if they are None
+'''
+
+from collections.abc import MutableMapping
+
+
+HEADER_FIELDS = ('type', 'from_id', 'to_id', 'from_host', 'to_host',
+                 'downtype', 'client_id', 'client_host', 'msg_id', 'trace')
+REQUIRED_FIELDS = 5
+
+_HEADER = frozenset(HEADER_FIELDS)
+
+
+class Packet(MutableMapping):
+    '''
+    Packet of the chat. It behaves like a dict of fields, so handlers
+    work with received packets and with packets that they form
+    the same way.
+
+    Fields of header are attributes of packet, an attribute is not set
+    if a field is missing.
+
+    Fields:
+        _body (dict) Fields of body or None if body is not decoded yet
+        _raw (memoryview) Encoded body or None if it is decoded
+        _codec (object) Codec that body is encoded with
+    '''
+
+    __slots__ = HEADER_FIELDS + ('_body', '_raw', '_codec')
+
+    def __init__(self, header=(), raw=None, codec=None):
+        for idx, value in enumerate(header):
+            if value is not None or idx < REQUIRED_FIELDS:
+                setattr(self, HEADER_FIELDS[idx], value)
+        self._body = None if raw is not None else {}
+        self._raw = raw
+        self._codec = codec
+
+    @classmethod
+    def from_dict(cls, fields):
+        packet = cls()
+        body = packet._body
+        for key, value in fields.items():
+            if key in _HEADER:
+                setattr(packet, key, value)
+            else:
+                body[key] = value
+        return packet
+
+    @property
+    def body(self):
+        ''' Fields of body, it is decoded on the first access '''
+
+        if self._body is None:
+            self._body = self._codec.decode_body(self._raw)
+            self._raw = None
+        return self._body
+
+    def to_dict(self):
+        fields = {field: getattr(self, field) for field in HEADER_FIELDS
+                  if hasattr(self, field)}
+        fields.update(self.body)
+        return fields
+
+    def raw_body(self, codec):
+        '''
+        Get body as it was received
+
+        Return:
+            (memoryview) Encoded body or None if body is decoded or is
+                         encoded with another codec
+        '''
+
+        return self._raw if codec is self._codec else None
+
+    def __getitem__(self, key):
+        if key in _HEADER:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        return self.body[key]
+
+    def __setitem__(self, key, value):
+        if key in _HEADER:
+            setattr(self, key, value)
+        else:
+            self.body[key] = value
+
+    def __delitem__(self, key):
+        if key in _HEADER:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        else:
+            del self.body[key]
+
+    def get(self, key, default=None):
+        # Missing fields of header are the common case, e.g. trace
+        if key in _HEADER:
+            return getattr(self, key, default)
+        return self.body.get(key, default)
+
+    def __contains__(self, key):
+        if key in _HEADER:
+            return hasattr(self, key)
+        return key in self.body
+
+    def __iter__(self):
+        for field in HEADER_FIELDS:
+            if hasattr(self, field):
+                yield field
+        yield from self.body
+
+    def __len__(self):
+        return sum(1 for field in HEADER_FIELDS if hasattr(self, field)) + \
+            len(self.body)
+
+    def __repr__(self):
+        # Body is not decoded for logging of relayed packets
+        header = {field: getattr(self, field) for field in HEADER_FIELDS
+                  if hasattr(self, field)}
+        if self._raw is not None:
+            return 'Packet(%r, <%d bytes>)' % (header, len(self._raw))
+        return 'Packet(%r, %r)' % (header, self._body)
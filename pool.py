@@ -0,0 +1,179 @@
+'''
+Module contains ConnectionPool class. Pool keeps idle connections
+that were opened for greeting and temporary messages, so next requests
+to the same host don't pay a TCP handshake.
+
+Vars:
+    MAX_IDLE (int) Default max number of idle connections
+    IDLE_TIMEOUT (float) Default time in seconds after which an idle
+                         connection is closed
+    CONNECT_TIMEOUT (float) Default timeout of opening of a connection
+'''
+
+import logging
+import socket
+import threading
+import time
+
+from collections import OrderedDict
+
+from outbound import set_nodelay
+
+
+LOGGER = logging.getLogger(__name__)
+MAX_IDLE = 64
+IDLE_TIMEOUT = 60
+CONNECT_TIMEOUT = 2
+
+
+class ConnectionPool:
+    '''
+    Pool of idle connections of a peer. Every connection is checked
+    before reuse: connections that are closed by remote host or
+    have unexpected data are dropped. When there are more than max_idle
+    connections, the least recently used one is closed.
+
+    Fields:
+        max_idle (int) Max number of idle connections
+        idle_timeout (float) Time after which idle connection is closed
+        _idle (OrderedDict) Matching between an idle socket and tuple of
+                            its host and time of release, the least
+                            recently used first
+        _hosts (dict) Matching between a host and list of its idle sockets
+        _on_close (callable) Called with a socket that is closed by pool
+    '''
+
+    def __init__(self, max_idle=MAX_IDLE, idle_timeout=IDLE_TIMEOUT,
+                 on_close=None):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._idle = OrderedDict()
+        self._hosts = {}
+        self._on_close = on_close
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._idle)
+
+    def get(self, host):
+        '''
+        Take idle connection with a host
+
+        Return:
+            (socket) Healthy connection or None if there is no one
+        '''
+
+        while True:
+            with self._lock:
+                socks = self._hosts.get(host)
+                if not socks:
+                    return None
+                # The most recently used connection is the most likely alive
+                sock = socks.pop()
+                if not socks:
+                    del self._hosts[host]
+                _, released = self._idle.pop(sock)
+            if time.monotonic() - released < self.idle_timeout and \
+                    self._is_alive(sock):
+                return sock
+            self._close(sock)
+
+    def connect(self, host, timeout=CONNECT_TIMEOUT):
+        '''
+        Take idle connection with a host or open a new one
+
+        Return:
+            (socket) Connection with a host
+        '''
+
+        sock = self.get(host)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            set_nodelay(sock)
+            try:
+                sock.connect(host)
+            except OSError:
+                sock.close()
+                raise
+        else:
+            sock.settimeout(timeout)
+        return sock
+
+    def put(self, host, sock):
+        ''' Return connection with a host to the pool '''
+
+        with self._lock:
+            self._idle[sock] = (host, time.monotonic())
+            self._hosts.setdefault(host, []).append(sock)
+        self.close_idle()
+
+    def discard(self, sock):
+        ''' Close connection that is broken or is not needed anymore '''
+
+        with self._lock:
+            if sock in self._idle:
+                self._remove(sock)
+        self._close(sock)
+
+    def close_idle(self):
+        ''' Close expired connections and LRU ones above max_idle '''
+
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            while self._idle:
+                sock, (_, released) = next(iter(self._idle.items()))
+                if now - released < self.idle_timeout and \
+                        len(self._idle) <= self.max_idle:
+                    break
+                expired.append(self._pop_lru())
+        for sock in expired:
+            self._close(sock)
+
+    def close(self):
+        ''' Close every idle connection '''
+
+        with self._lock:
+            socks = list(self._idle)
+            self._idle.clear()
+            self._hosts.clear()
+        for sock in socks:
+            self._close(sock)
+
+    def _pop_lru(self):
+        sock = next(iter(self._idle))
+        self._remove(sock)
+        return sock
+
+    def _remove(self, sock):
+        host, _ = self._idle.pop(sock)
+        socks = self._hosts[host]
+        socks.remove(sock)
+        if not socks:
+            del self._hosts[host]
+
+    def _close(self, sock):
+        LOGGER.debug('Closing pooled connection %s', sock)
+        if self._on_close is not None:
+            self._on_close(sock)
+        sock.close()
+
+    def _is_alive(self, sock):
+        '''
+        Health check of idle connection: it must be neither closed by
+        remote host nor have data that nobody waits for
+        '''
+
+        timeout = sock.gettimeout()
+        sock.setblocking(0)
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.settimeout(timeout)
+        # Connection is closed or has data
+        return False
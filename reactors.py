@@ -0,0 +1,683 @@
+'''
+Module contains reactors. Reactor is an event loop that serves
+sockets of a BasePeer: it accepts connections, reads incoming data
+and writes queued messages. Reactor is chosen on construction of
+a peer via "backend" argument.
+
+Accepting errors don't stop a reactor: a connection that is aborted
+before accept is skipped, and when the process is out of file
+descriptors the listening socket is not watched for ACCEPT_BACKOFF, so
+the loop doesn't spin while connections are closed.
+
+Vars:
+    REACTORS (dict) Matching between a backend name and a reactor class
+    ACCEPT_BACKOFF (float) Time in seconds that the listening socket is
+                           not watched when file descriptors run out
+'''
+
+import asyncio
+import errno
+import logging
+import select
+import selectors
+import socket
+import threading
+import time
+
+from collections import deque
+
+
+LOGGER = logging.getLogger(__name__)
+SELECT_TIMEOUT = 2
+ACCEPT_BACKOFF = 0.1
+# Errors after which accepting is paused
+_OUT_OF_FDS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+
+
+def _split_batches(batching, buffers):
+    '''
+    Find batches that should be sent now
+
+    Args:
+        batching (set) Sockets whose buffers wait for the end of batch
+        buffers (dict) Matching between a socket and its outbound buffer
+    Return:
+        (tuple) List of sockets that are due and timeout in seconds until
+                the next batch is due or None if there are no batches
+    '''
+
+    now = time.monotonic()
+    due = []
+    timeout = None
+    for sock in list(batching):
+        buf = buffers.get(sock)
+        if buf is None or not buf:
+            batching.discard(sock)
+        elif buf.is_due(now):
+            batching.discard(sock)
+            due.append(sock)
+        else:
+            left = buf.deadline - now
+            timeout = left if timeout is None else min(timeout, left)
+    return due, timeout
+
+
+def _accept(recv_sock):
+    '''
+    Accept connection from listening socket
+
+    Return:
+        (tuple) Socket and address, or None if accepting failed. False
+                if file descriptors run out, so accepting should be paused
+    '''
+
+    try:
+        return recv_sock.accept()
+    except BlockingIOError:
+        # Connection was taken by another process or aborted
+        return None
+    except OSError as e:
+        return _accept_failed(e)
+
+
+def _accept_failed(error):
+    if error.errno in _OUT_OF_FDS:
+        LOGGER.error('Failed to accept connection: %s, pausing for %.1f s',
+                     error, ACCEPT_BACKOFF)
+        return False
+    LOGGER.warning('Failed to accept connection: %s', error)
+    return None
+
+
+def _drain(wakeup_sock):
+    ''' Read every wakeup byte from socket pair of a reactor '''
+
+    try:
+        while wakeup_sock.recv(1024):
+            pass
+    except BlockingIOError:
+        pass
+
+
+class SelectReactor:
+    '''
+    Reactor on top of select.select call
+
+    Fields:
+        _inputs (list) Sockets that are watched for reading
+        _outputs (list) Sockets that have messages to send
+        _message_queues (dict) Matching between a socket and outbound
+                               buffer of messages that should be sent to it
+        _closing (set) Sockets that are closed after sending all messages
+        _batching (set) Sockets that have messages which wait for the end
+                        of batch window
+        _calls (deque) Calls that are made on the next pass of the loop.
+                       Loop is woken up via socket pair when a call is
+                       added or a message is sent from another thread
+    '''
+
+    def __init__(self, peer):
+        self._peer = peer
+        self._thread_id = None
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(0)
+        self._wakeup_send.setblocking(0)
+        self._inputs = [peer._recv_sock, self._wakeup_recv]
+        self._outputs = []
+        self._message_queues = {}
+        self._closing = set()
+        self._batching = set()
+        self._calls = deque()
+        # Buffers are filled by other threads too
+        self._lock = threading.Lock()
+
+    def run(self):
+        ''' Non-blocking handling of received data '''
+
+        self._thread_id = threading.get_ident()
+        timeout = SELECT_TIMEOUT
+        while self._peer._is_handle_recv:
+            readable, writable, exceptional = select.select(self._inputs,
+                                                            self._outputs,
+                                                            self._inputs,
+                                                            timeout)
+            self._process_readable_sock(readable)
+            self._process_writable_sock(writable)
+            for sock in exceptional:
+                # Connection is broken, links of it are repaired by peer
+                self._peer._close_sock(sock)
+            while self._calls:
+                func, args = self._calls.popleft()
+                func(*args)
+            timeout = self._flush_batches()
+
+    def call_soon(self, func, *args):
+        self._calls.append((func, args))
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_send.send(b'\0')
+        except BlockingIOError:
+            # Loop is already woken up
+            pass
+
+    def register(self, sock):
+        self._inputs.append(sock)
+        self._message_queues[sock] = self._peer._create_outbound_buffer()
+
+    def unregister(self, sock):
+        with self._lock:
+            if sock in self._outputs:
+                self._outputs.remove(sock)
+            self._inputs.remove(sock)
+            self._closing.discard(sock)
+            self._batching.discard(sock)
+            del self._message_queues[sock]
+        sock.close()
+
+    def _flush_batches(self):
+        '''
+        Start sending of batches that are due
+
+        Return:
+            (float) Timeout of the next select call
+        '''
+
+        with self._lock:
+            due, timeout = _split_batches(self._batching,
+                                          self._message_queues)
+            for sock in due:
+                if sock not in self._outputs:
+                    self._outputs.append(sock)
+        if timeout is None:
+            return SELECT_TIMEOUT
+        return min(timeout, SELECT_TIMEOUT)
+
+    def send(self, sock, msg, close=False):
+        '''
+        Put message to a buffer of socket
+
+        Return:
+            (bool) False if socket is paused, None if message is dropped
+        '''
+
+        with self._lock:
+            if close:
+                self._closing.add(sock)
+            buf = self._message_queues[sock]
+            accepted = buf.append(msg)
+            if sock not in self._outputs:
+                if buf.is_due() or close:
+                    self._outputs.append(sock)
+                else:
+                    self._batching.add(sock)
+        # Loop waits in select with sockets and timeout that it had
+        if threading.get_ident() != self._thread_id:
+            self._wakeup()
+        return accepted
+
+    def is_paused(self, sock):
+        buf = self._message_queues.get(sock)
+        return buf is not None and buf.paused
+
+    def outbound_sizes(self):
+        ''' Get list of sockets and sizes of their outbound buffers '''
+
+        with self._lock:
+            return [(sock, len(buf))
+                    for sock, buf in self._message_queues.items()]
+
+    def _process_readable_sock(self, readable):
+        ''' Process sockets that ready for reading '''
+
+        for sock in readable:
+            if sock is self._peer._recv_sock:
+                self._accept(sock)
+            elif sock is self._wakeup_recv:
+                _drain(sock)
+            elif sock in self._message_queues:
+                self._peer._read_sock(sock)
+
+    def _accept(self, recv_sock):
+        accepted = _accept(recv_sock)
+        if accepted is False:
+            self._inputs.remove(recv_sock)
+            timer = threading.Timer(ACCEPT_BACKOFF, self.call_soon,
+                                    (self._inputs.append, recv_sock))
+            timer.daemon = True
+            timer.start()
+        elif accepted is not None:
+            conn, addr = accepted
+            LOGGER.debug('New connection from %s', addr)
+            self._peer._accept_conn(conn)
+
+    def _process_writable_sock(self, writable):
+        ''' Process sockets that ready for writing '''
+
+        for sock in writable:
+            buf = self._message_queues.get(sock)
+            if buf is None:
+                continue
+            size = len(buf)
+            LOGGER.debug('Sending %d bytes to %s', size, sock)
+            try:
+                with self._lock:
+                    is_empty = buf.send_to(sock)
+                    if is_empty:
+                        self._outputs.remove(sock)
+            except OSError:
+                self._peer._close_sock(sock)
+                continue
+            finally:
+                self._peer._bytes_out.inc(size - len(buf))
+            if is_empty:
+                LOGGER.debug('Output queue for %s is empty', sock)
+                if sock in self._closing:
+                    self._peer._close_sock(sock)
+
+
+class SelectorsReactor:
+    '''
+    Reactor on top of selectors.DefaultSelector (epoll on Linux). Every
+    socket is registered once, and WRITE interest is armed only while
+    socket has queued messages, so registration and interest changes
+    cost O(1) and a pass of the loop touches only active sockets.
+
+    Calls from other threads are put to a queue of commands and
+    the loop is woken up via socket pair, so the loop never sleeps
+    while there are messages to send.
+
+    Fields:
+        _selector (BaseSelector) Selector that watches for sockets
+        _message_queues (dict) Matching between a socket and outbound
+                               buffer of messages that should be sent to it
+        _closing (set) Sockets that are closed after sending all messages
+        _writing (set) Sockets with armed WRITE interest
+        _batching (set) Sockets that have messages which wait for the end
+                        of batch window
+        _commands (deque) Calls that were made from other threads
+    '''
+
+    def __init__(self, peer):
+        self._peer = peer
+        self._selector = selectors.DefaultSelector()
+        self._message_queues = {}
+        self._closing = set()
+        self._writing = set()
+        self._batching = set()
+        self._commands = deque()
+        self._thread_id = None
+
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(0)
+        self._wakeup_send.setblocking(0)
+        self._selector.register(peer._recv_sock, selectors.EVENT_READ,
+                                self._accept)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ,
+                                self._drain_wakeup)
+
+    def run(self):
+        self._thread_id = threading.get_ident()
+        self._run_commands()
+        timeout = None
+        while self._peer._is_handle_recv:
+            for key, events in self._selector.select(timeout):
+                if key.data is not None:
+                    key.data()
+                    continue
+                sock = key.fileobj
+                if sock not in self._message_queues:
+                    continue
+                if events & selectors.EVENT_READ:
+                    self._peer._read_sock(sock)
+                if events & selectors.EVENT_WRITE:
+                    self._write(sock)
+            self._run_commands()
+            timeout = self._flush_batches()
+
+    def _flush_batches(self):
+        '''
+        Arm WRITE interest of sockets whose batches are due
+
+        Return:
+            (float) Timeout of the next select call
+        '''
+
+        due, timeout = _split_batches(self._batching, self._message_queues)
+        for sock in due:
+            self._arm(sock)
+        return timeout
+
+    def _arm(self, sock):
+        if sock not in self._writing:
+            self._writing.add(sock)
+            self._selector.modify(sock, selectors.EVENT_READ |
+                                  selectors.EVENT_WRITE)
+
+    def _accept(self):
+        recv_sock = self._peer._recv_sock
+        accepted = _accept(recv_sock)
+        if accepted is False:
+            self._selector.unregister(recv_sock)
+            timer = threading.Timer(ACCEPT_BACKOFF, self.call_soon,
+                                    (self._selector.register, recv_sock,
+                                     selectors.EVENT_READ, self._accept))
+            timer.daemon = True
+            timer.start()
+        elif accepted is not None:
+            conn, addr = accepted
+            LOGGER.debug('New connection from %s', addr)
+            self._peer._accept_conn(conn)
+
+    def _drain_wakeup(self):
+        _drain(self._wakeup_recv)
+
+    def _run_commands(self):
+        while self._commands:
+            func, args = self._commands.popleft()
+            func(*args)
+
+    def _call(self, func, *args):
+        ''' Call function on the loop thread '''
+
+        if threading.get_ident() == self._thread_id:
+            func(*args)
+        else:
+            self.call_soon(func, *args)
+
+    def _wakeup(self):
+        try:
+            self._wakeup_send.send(b'\0')
+        except BlockingIOError:
+            # Loop is already woken up
+            pass
+
+    def call_soon(self, func, *args):
+        ''' Call function on the next pass of the loop '''
+
+        self._commands.append((func, args))
+        self._wakeup()
+
+    def register(self, sock):
+        self._call(self._register, sock)
+
+    def _register(self, sock):
+        self._message_queues[sock] = self._peer._create_outbound_buffer()
+        self._selector.register(sock, selectors.EVENT_READ)
+
+    def unregister(self, sock):
+        self._call(self._unregister, sock)
+
+    def _unregister(self, sock):
+        if self._message_queues.pop(sock, None) is None:
+            return
+        self._closing.discard(sock)
+        self._writing.discard(sock)
+        self._batching.discard(sock)
+        self._selector.unregister(sock)
+        sock.close()
+
+    def send(self, sock, msg, close=False):
+        '''
+        Put message to a buffer of socket
+
+        Return:
+            (bool) False if socket is paused, None if message is dropped.
+                   When called from another thread message is put later,
+                   so only the current state of socket is returned
+        '''
+
+        if threading.get_ident() == self._thread_id:
+            return self._send(sock, msg, close)
+        self.call_soon(self._send, sock, msg, close)
+        return not self.is_paused(sock)
+
+    def is_paused(self, sock):
+        buf = self._message_queues.get(sock)
+        return buf is not None and buf.paused
+
+    def outbound_sizes(self):
+        ''' Get list of sockets and sizes of their outbound buffers '''
+
+        return [(sock, len(buf))
+                for sock, buf in list(self._message_queues.items())]
+
+    def _send(self, sock, msg, close):
+        buf = self._message_queues.get(sock)
+        if buf is None:
+            return None
+        if close:
+            self._closing.add(sock)
+        accepted = buf.append(msg)
+        if sock not in self._writing:
+            if buf.is_due() or close:
+                self._arm(sock)
+            else:
+                self._batching.add(sock)
+        return accepted
+
+    def _write(self, sock):
+        ''' Send buffered messages while socket accepts them '''
+
+        buf = self._message_queues.get(sock)
+        if buf is None:
+            return
+        size = len(buf)
+        try:
+            if not buf.send_to(sock):
+                return
+        except OSError:
+            self._peer._close_sock(sock)
+            return
+        finally:
+            self._peer._bytes_out.inc(size - len(buf))
+        self._writing.discard(sock)
+        self._selector.modify(sock, selectors.EVENT_READ)
+        if sock in self._closing:
+            self._peer._close_sock(sock)
+
+
+class _PeerProtocol(asyncio.BufferedProtocol):
+    '''
+    Protocol of one connection of a peer that is served by asyncio.
+    Data is received straight to the frame decoder of the connection.
+    '''
+
+    def __init__(self, reactor, sock):
+        self._reactor = reactor
+        self._sock = sock
+        self._decoder = None
+
+    def connection_made(self, transport):
+        transport.set_write_buffer_limits(self._reactor._peer._high_water,
+                                          self._reactor._peer._low_water)
+        self._reactor._on_connection_made(self._sock, transport)
+
+    def pause_writing(self):
+        self._reactor._paused.add(self._sock)
+
+    def resume_writing(self):
+        self._reactor._paused.discard(self._sock)
+
+    def get_buffer(self, sizehint):
+        # Decoder can be replaced when wire format of connection is changed
+        self._decoder = self._reactor._peer._message_data[self._sock]
+        return self._decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self._decoder.buffer_updated(nbytes)
+        self._reactor._peer._bytes_in.inc(nbytes)
+        self._reactor._peer._process_frames(self._sock)
+
+    def connection_lost(self, exc):
+        self._reactor._peer._close_sock(self._sock)
+
+
+class AsyncioReactor:
+    '''
+    Reactor on top of asyncio event loop. Every connection is served
+    by asyncio transport, so greeting of BinaryTreePeer can be run
+    as coroutines on the same loop.
+
+    Fields:
+        loop (AbstractEventLoop) Event loop of the reactor
+        _transports (dict) Matching between a socket and its transport
+        _pending (dict) Messages that were sent before a transport
+                        of a socket was made
+        _paused (set) Sockets whose transports have exceeded high
+                      watermark of write buffer
+        _batches (dict) Matching between a socket and list of messages
+                        that wait for the end of batch window and
+                        their size
+        _ready (Event) Set when the loop is started
+    '''
+
+    def __init__(self, peer):
+        self._peer = peer
+        self.loop = asyncio.new_event_loop()
+        self._transports = {}
+        self._pending = {}
+        self._paused = set()
+        self._batches = {}
+        self._ready = threading.Event()
+        self._thread_id = None
+
+    def run(self):
+        self._thread_id = threading.get_ident()
+        asyncio.set_event_loop(self.loop)
+        self.loop.create_task(self._serve())
+        self.loop.call_soon(self._ready.set)
+        self.loop.run_forever()
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def call_soon(self, func, *args):
+        self.loop.call_soon_threadsafe(func, *args)
+
+    def run_coroutine(self, coro):
+        ''' Run coroutine on the loop from another thread and wait result '''
+
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _serve(self):
+        recv_sock = self._peer._recv_sock
+        while self._peer._is_handle_recv:
+            try:
+                conn, addr = await self.loop.sock_accept(recv_sock)
+            except OSError as e:
+                if _accept_failed(e) is False:
+                    await asyncio.sleep(ACCEPT_BACKOFF)
+                continue
+            LOGGER.debug('New connection from %s', addr)
+            self._peer._accept_conn(conn)
+
+    def _in_loop(self):
+        return threading.get_ident() == self._thread_id
+
+    def _call(self, func, *args):
+        ''' Call function on the loop thread '''
+
+        if self._in_loop():
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def register(self, sock):
+        self._pending[sock] = []
+        self._call(self._register, sock)
+
+    def _register(self, sock):
+        self.loop.create_task(self.loop.connect_accepted_socket(
+            lambda: _PeerProtocol(self, sock), sock))
+
+    def _on_connection_made(self, sock, transport):
+        self._transports[sock] = transport
+        for msg, close in self._pending.pop(sock, []):
+            self._write(sock, msg, close)
+
+    def unregister(self, sock):
+        self._pending.pop(sock, None)
+        self._paused.discard(sock)
+        self._batches.pop(sock, None)
+        transport = self._transports.pop(sock, None)
+        if transport is None:
+            sock.close()
+        else:
+            self._call(transport.close)
+
+    def send(self, sock, msg, close=False):
+        '''
+        Write message to transport of socket
+
+        Return:
+            (bool) False if socket is paused, None if message is dropped
+        '''
+
+        transport = self._transports.get(sock)
+        if transport is not None and \
+                transport.get_write_buffer_size() + len(msg) > \
+                self._peer._max_buffer:
+            LOGGER.warning('Write buffer is full, dropping %d bytes', len(msg))
+            return None
+        self._call(self._write, sock, msg, close)
+        return not self.is_paused(sock)
+
+    def is_paused(self, sock):
+        return sock in self._paused
+
+    def outbound_sizes(self):
+        '''
+        Get list of sockets and sizes of their write buffers together
+        with batches that are not written yet
+        '''
+
+        sizes = []
+        for sock, transport in list(self._transports.items()):
+            batch = self._batches.get(sock)
+            sizes.append((sock, transport.get_write_buffer_size() +
+                          (batch[1] if batch is not None else 0)))
+        return sizes
+
+    def _write(self, sock, msg, close):
+        transport = self._transports.get(sock)
+        if transport is None:
+            if sock in self._pending:
+                self._pending[sock].append((msg, close))
+            return
+        LOGGER.debug('Sending %r', msg)
+        if self._peer._batch_window and not close:
+            self._add_to_batch(sock, msg)
+            return
+        self._flush(sock)
+        transport.write(msg)
+        self._peer._bytes_out.inc(len(msg))
+        if close:
+            self._peer._close_sock(sock)
+
+    def _add_to_batch(self, sock, msg):
+        batch = self._batches.get(sock)
+        if batch is None:
+            batch = self._batches[sock] = [[], 0]
+            self.loop.call_later(self._peer._batch_window, self._flush, sock)
+        batch[0].append(msg)
+        batch[1] += len(msg)
+        if batch[1] >= self._peer._batch_size:
+            self._flush(sock)
+
+    def _flush(self, sock):
+        ''' Write messages of batch by one call '''
+
+        batch = self._batches.pop(sock, None)
+        transport = self._transports.get(sock)
+        if batch is not None and transport is not None:
+            transport.writelines(batch[0])
+            self._peer._bytes_out.inc(batch[1])
+
+
+REACTORS = {
+    'select': SelectReactor,
+    'selectors': SelectorsReactor,
+    'asyncio': AsyncioReactor
+}
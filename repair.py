@@ -0,0 +1,159 @@
+'''
+Module contains Repair class. Repair reattaches a subtree of the tree
+whose parent node is failed, so the subtree is not partitioned from
+the chat.
+
+Root of the subtree keeps its id and children. Ids of the subtree are
+between bounds of the failed node, and the failed node is not in the
+tree anymore, so the subtree fits the place of it. Request for the
+place is sent to an ancestor: one bound of the subtree is id of the
+failed parent, and another one is id of an ancestor. The request goes
+down from it to a node that has free child on the side of the id of
+the subtree, the same way as a search in a binary tree. If the failed
+node was the root of the chat, roots of both orphaned subtrees have no
+ancestors, and the one with less id becomes the root.
+'''
+
+import logging
+import threading
+import time
+
+from concurrent.futures import Future
+
+from handlers import TYPES
+from handshake import TIMEOUT, BACKOFF, MAX_BACKOFF
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Repair:
+    '''
+    Reattaching of a subtree whose parent is failed
+
+    Fields:
+        lost_id (int) Id of the failed parent
+        repaired (Future) Future that is resolved when subtree is attached
+                          to the tree or its root becomes the root
+        _place (dict) Place that was found for the subtree
+        _place_found (Event) Set when a place is found
+
+    Repair waits for the place and the connection on its own thread,
+    and the node takes the place on the reactor thread, since handlers
+    use links and bounds of it meanwhile.
+    '''
+
+    def __init__(self, peer, lost_id, timeout=TIMEOUT, backoff=BACKOFF):
+        self._peer = peer
+        self._timeout = timeout
+        self._backoff = backoff
+        self.lost_id = lost_id
+        self.repaired = Future()
+        self._place = None
+        self._place_found = threading.Event()
+
+    def start(self):
+        '''
+        Run repair in background
+
+        Return:
+            (Future) Future that is resolved when subtree is attached
+        '''
+
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return self.repaired
+
+    def run(self):
+        peer = self._peer
+        attempt = 0
+        try:
+            while peer._parent is None and not peer._is_root:
+                entry = self.choose_entry()
+                if entry is None:
+                    LOGGER.warning('No nodes outside of subtree, '
+                                   'becoming the root')
+                    peer._call_on_reactor(peer._become_root)
+                    break
+                try:
+                    if self._reattach(entry):
+                        break
+                except OSError as e:
+                    LOGGER.warning('Failed to reattach subtree via %s: %s',
+                                   entry, e)
+                attempt += 1
+                time.sleep(min(self._backoff * 2 ** (attempt - 1),
+                               MAX_BACKOFF))
+        finally:
+            self.repaired.set_result(peer._parent is not None or
+                                     peer._is_root)
+
+    def set_place(self, place_info):
+        self._place = place_info
+        self._place_found.set()
+
+    def ancestor(self):
+        '''
+        Get host of the ancestor whose id is a bound of the subtree
+
+        Return:
+            (tuple) Host or None if the bound is not a node
+        '''
+
+        peer = self._peer
+        bound = peer.up_bound if peer.low_bound == self.lost_id \
+            else peer.low_bound
+        host = peer.id2host.get(bound)
+        if host is None or host not in peer.connected:
+            return None
+        return host
+
+    def choose_entry(self):
+        '''
+        Choose a node that request for place is sent to: the ancestor,
+        else the neighbor node, else any node outside of the subtree
+
+        Return:
+            (tuple) Host of a node or None if there are no nodes outside
+        '''
+
+        peer = self._peer
+        host = self.ancestor()
+        if host is not None:
+            return host
+        host = peer.id2host.get(peer._neighbor)
+        if host is not None and host in peer.connected:
+            return host
+        for member in list(peer.connected.values()):
+            if not peer.low_bound <= member.id <= peer.up_bound:
+                return member.host
+        return None
+
+    def _reattach(self, entry):
+        '''
+        Return:
+            (bool) True if subtree is attached, False if found place
+                   was taken by another node
+        '''
+
+        peer = self._peer
+        self._place_found.clear()
+        packet = peer._create_packet(TYPES['reattach'], peer._id,
+                                     peer.connected[entry].id,
+                                     peer._host, entry)
+        packet['client_id'] = peer._id
+        packet['client_host'] = peer._host
+        packet['lost_id'] = self.lost_id
+        LOGGER.debug('Searching place for subtree via %s', entry)
+        peer._send_reply(entry, packet)
+        if not self._place_found.wait(self._timeout):
+            raise TimeoutError('Place for subtree is not found')
+
+        place_info = self._place
+        peer._place_info = place_info
+        if not peer._try_connect(tuple(place_info['conn_host']),
+                                 self._timeout, on_reactor=True):
+            return False
+        peer._call_on_reactor(peer._adopt_place, place_info)
+        LOGGER.info('Subtree is attached to %s', place_info['conn_id'])
+        return True
@@ -0,0 +1,398 @@
+'''
+Module contains Roster class. Roster is a versioned list of members
+of the chat: every change of it increments epoch of the roster, so
+a peer that knows members up to some epoch can fetch only changes
+since it.
+
+A member is a Member record with slots instead of a dict. Records are
+never changed, a member that is added again gets a new record, so
+snapshots and indexes share records instead of copying them.
+
+Epochs of rosters of different peers can't be compared, so a peer that
+fetched roster of one host syncs with another host by digest: members
+are split to buckets by id, and a digest has a hash of every bucket.
+Only members of buckets whose hashes differ are sent then.
+
+Vars:
+    LOG_SIZE (int) Default number of changes that are kept for delta sync
+    SNAPSHOTS (int) Number of snapshots that are kept for paginated reading
+    BUCKETS (int) Number of buckets of a digest
+'''
+
+import bisect
+import hashlib
+import random
+import sys
+import uuid
+
+from collections import deque, OrderedDict
+from collections.abc import MutableMapping
+
+
+LOG_SIZE = 10000
+SNAPSHOTS = 4
+BUCKETS = 64
+
+
+def _member_hash(member):
+    ''' Hash of a member that is equal on every peer '''
+
+    key = '%d %s %d' % (member.id, member.host[0], member.host[1])
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8)
+                          .digest(), 'big')
+
+
+class Member:
+    '''
+    Record of a member of the chat
+
+    Fields:
+        id (int) Id of node of the member
+        host (tuple) IP and port of the member
+        username (str) Name of the member
+    '''
+
+    __slots__ = ('id', 'host', 'username')
+
+    def __init__(self, _id, host, username=''):
+        self.id = _id
+        self.host = host
+        self.username = username
+
+    def __repr__(self):
+        return 'Member(%r, %r, %r)' % (self.id, self.host, self.username)
+
+    def __getstate__(self):
+        return self.id, self.host, self.username
+
+    def __setstate__(self, state):
+        self.id, self.host, self.username = state
+
+    def to_dict(self):
+        return {'id': self.id, 'host': self.host, 'username': self.username}
+
+
+class Roster:
+    '''
+    Versioned list of members of the chat
+
+    Fields:
+        uid (str) Random id of roster. Epochs of different rosters
+                  can't be compared, even of one peer after restart
+        epoch (int) Number of the last change of roster
+        by_id (dict) Matching between an id and a member, it is
+                     the primary index
+        members (dict) Matching between a host and a member
+        _ids (list) Sorted ids of members
+        _log (deque) Last changes of roster: tuples of epoch, operation
+                     and host
+        _snapshots (OrderedDict) Matching between an epoch and list of
+                                 members at this epoch
+        _buckets (list) Hash of every bucket of members, it is XOR of
+                        hashes of members, so it is updated on change
+    '''
+
+    def __init__(self, log_size=LOG_SIZE):
+        self.uid = uuid.uuid4().hex
+        self.epoch = 0
+        self.by_id = {}
+        self.members = {}
+        self._ids = []
+        self._log = deque(maxlen=log_size)
+        self._snapshots = OrderedDict()
+        self._buckets = [0] * BUCKETS
+
+    def __len__(self):
+        return len(self.members)
+
+    def add(self, member):
+        self._add(member)
+        self._change('add', member.host)
+
+    def remove(self, host):
+        if self._remove(host):
+            self._change('remove', host)
+
+    def _add(self, member):
+        old = self.members.get(member.host)
+        if old is not None:
+            # Host may come back with another id, old id is free then
+            if self.by_id.get(old.id) is old:
+                del self.by_id[old.id]
+            self._remove_id(old.id)
+            self._toggle(old)
+        old = self.by_id.get(member.id)
+        if old is not None and old.host != member.host:
+            # Id was taken by another host, that host left the chat
+            del self.members[old.host]
+            self._remove_id(old.id)
+            self._toggle(old)
+        self.members[member.host] = member
+        self.by_id[member.id] = member
+        bisect.insort(self._ids, member.id)
+        self._toggle(member)
+
+    def _remove(self, host):
+        member = self.members.pop(host, None)
+        if member is None:
+            return False
+        if self.by_id.get(member.id) is member:
+            del self.by_id[member.id]
+        self._remove_id(member.id)
+        self._toggle(member)
+        return True
+
+    def _toggle(self, member):
+        ''' Add a member to hash of its bucket or remove it from one '''
+
+        self._buckets[self.bucket(member.id)] ^= _member_hash(member)
+
+    @staticmethod
+    def bucket(_id):
+        return _id % BUCKETS
+
+    def _remove_id(self, _id):
+        idx = bisect.bisect_left(self._ids, _id)
+        if idx < len(self._ids) and self._ids[idx] == _id:
+            del self._ids[idx]
+
+    def apply(self, changes, epoch):
+        '''
+        Apply changes of another roster, e.g. of a roster that is
+        replicated to workers of a peer. Epoch of the roster becomes equal
+        to epoch of the source, and all changes are logged at it.
+        '''
+
+        for change in changes:
+            host = tuple(change['host'])
+            if change['op'] == 'remove':
+                self._remove(host)
+            else:
+                self._add(Member(change['id'], host,
+                                 change.get('username', '')))
+            self._log.append((epoch, change['op'], host))
+        self.epoch = epoch
+
+    def load(self, uid, epoch, members):
+        ''' Replace roster with a snapshot of another one '''
+
+        self.uid = uid
+        self.by_id.clear()
+        self.members.clear()
+        self._ids = []
+        self._log.clear()
+        self._snapshots.clear()
+        self._buckets = [0] * BUCKETS
+        for member in members:
+            self._add(member)
+        self.epoch = epoch
+
+    def count_ids(self, low_bound, up_bound):
+        ''' Count members with id between bounds, bounds are excluded '''
+
+        return bisect.bisect_left(self._ids, up_bound) - \
+            bisect.bisect_right(self._ids, low_bound)
+
+    def sample(self, count, exclude=()):
+        '''
+        Choose random members, e.g. targets of gossip. Members are
+        picked at random positions of sorted ids, so the roster is not
+        copied for a choice.
+
+        Args:
+            count (int) Number of members
+            exclude (set) Ids of members that must not be chosen
+        Return:
+            (list) Up to count distinct members
+        '''
+
+        ids = self._ids
+        if len(ids) <= count + len(exclude):
+            chosen = [_id for _id in ids if _id not in exclude]
+            random.shuffle(chosen)
+            chosen = chosen[:count]
+        else:
+            chosen = set()
+            while len(chosen) < count:
+                _id = ids[random.randrange(len(ids))]
+                if _id not in exclude:
+                    chosen.add(_id)
+        members = [self.by_id.get(_id) for _id in chosen]
+        return [member for member in members if member is not None]
+
+    def _change(self, operation, host):
+        self.epoch += 1
+        self._log.append((self.epoch, operation, host))
+
+    def changes_since(self, epoch):
+        '''
+        Get changes of roster that were made after epoch. If there are
+        several changes of one member then only the last one is returned.
+
+        Return:
+            (list) Changes or None if they are not kept anymore
+        '''
+
+        if epoch > self.epoch:
+            return None
+        if epoch == self.epoch:
+            return []
+        if not self._log or self._log[0][0] > epoch + 1:
+            return None
+
+        changes = OrderedDict()
+        for change_epoch, operation, host in reversed(self._log):
+            if change_epoch <= epoch:
+                break
+            if host not in changes:
+                changes[host] = operation
+
+        result = []
+        for host, operation in reversed(changes.items()):
+            if operation == 'add' and host in self.members:
+                change = self.members[host].to_dict()
+                change['op'] = 'add'
+            else:
+                change = {'op': 'remove', 'host': host}
+            result.append(change)
+        return result
+
+    def digest(self):
+        ''' Get hashes of buckets of members, see diff '''
+
+        return list(self._buckets)
+
+    def diff(self, digest):
+        '''
+        Compare roster with digest of another one
+
+        Args:
+            digest (list) Hashes of buckets of another roster
+        Return:
+            (list) Pairs of index of a bucket that differs and list of
+                   members of it, or None if digest has another number
+                   of buckets
+        '''
+
+        if len(digest) != BUCKETS:
+            return None
+        buckets = {idx: [] for idx, value in enumerate(self._buckets)
+                   if value != digest[idx]}
+        if buckets:
+            for member in self.members.values():
+                idx = self.bucket(member.id)
+                if idx in buckets:
+                    buckets[idx].append(member)
+        return sorted(buckets.items())
+
+    def snapshot(self, epoch=None):
+        '''
+        Get list of all members. List is built once per epoch, and
+        several last lists are kept, so pages of one snapshot are
+        consistent while roster is changing. List contains records of
+        roster, they are encoded to packets without copying.
+
+        Args:
+            epoch (int) Epoch of snapshot that was read before
+        Return:
+            (tuple) Epoch of snapshot and list of members
+        '''
+
+        if epoch in self._snapshots:
+            return epoch, self._snapshots[epoch]
+        members = self._snapshots.get(self.epoch)
+        if members is None:
+            members = list(self.members.values())
+            self._snapshots[self.epoch] = members
+            while len(self._snapshots) > SNAPSHOTS:
+                self._snapshots.popitem(last=False)
+        return self.epoch, members
+
+    def memory(self):
+        '''
+        Estimate memory that is taken by members: records, indexes, log
+        and kept snapshots. Objects that are shared are counted once.
+
+        Return:
+            (dict) Number of members, total size and size per member
+                   in bytes
+        '''
+
+        seen = set()
+        total = 0
+
+        def count(obj):
+            nonlocal total
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                total += sys.getsizeof(obj)
+
+        for container in (self.members, self.by_id, self._ids, self._log,
+                          self._snapshots, self._buckets):
+            count(container)
+        for members in self._snapshots.values():
+            count(members)
+        for change in self._log:
+            count(change)
+        for member in self.members.values():
+            for obj in (member, member.id, member.host, member.username):
+                count(obj)
+            for obj in member.host:
+                count(obj)
+        return {'members': len(self.members), 'bytes': total,
+                'bytes_per_member': total / max(len(self.members), 1)}
+
+
+class HostIndex(MutableMapping):
+    '''
+    Matching between an id and a host. Hosts of members are taken from
+    the roster, so they are not stored twice. Hosts of nodes that are not
+    members, e.g. of a parent that joined after roster was fetched, are
+    kept aside until they become members.
+
+    Fields:
+        _roster (Roster) Roster that hosts of members are taken from
+        _others (dict) Matching between an id and a host of a node that
+                       is not a member
+    '''
+
+    def __init__(self, roster):
+        self._roster = roster
+        self._others = {}
+
+    def __getitem__(self, _id):
+        host = self._others.get(_id)
+        if host is not None:
+            return host
+        return self._roster.by_id[_id].host
+
+    def __setitem__(self, _id, host):
+        member = self._roster.by_id.get(_id)
+        if member is not None and member.host == host:
+            self._others.pop(_id, None)
+        else:
+            self._others[_id] = host
+
+    def __delitem__(self, _id):
+        ''' Host of a member is forgotten when it is removed from roster '''
+
+        if self._others.pop(_id, None) is None and \
+                _id not in self._roster.by_id:
+            raise KeyError(_id)
+
+    def __contains__(self, _id):
+        return _id in self._roster.by_id or _id in self._others
+
+    def __iter__(self):
+        by_id = self._roster.by_id
+        yield from by_id
+        for _id in self._others:
+            if _id not in by_id:
+                yield _id
+
+    def __len__(self):
+        by_id = self._roster.by_id
+        return len(by_id) + sum(1 for _id in self._others if _id not in by_id)
+
+    def clear(self):
+        self._others.clear()
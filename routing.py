@@ -0,0 +1,121 @@
+'''
+Module contains RoutingTable class. It chooses a socket that a packet
+for some node of the tree is sent to.
+
+Every node of the tree is connected with its parent and children, so
+without shortcuts a packet between distant leaves goes up and down the
+whole tree. Nodes that packets are often sent to are learned from traffic,
+and direct connections (shortcuts) with them are opened. Shortcuts are
+kept in LRU order, the least recently used one is closed when there
+are too many of them.
+
+Vars:
+    MAX_SHORTCUTS (int) Default max number of shortcut connections
+    SHORTCUT_THRESHOLD (int) Number of packets to a distant node after
+                             which shortcut with it is opened
+    TRAFFIC_SIZE (int) Max number of distant nodes that packets are
+                       counted for. Counters are reset when it is exceeded
+'''
+
+from collections import OrderedDict
+
+
+MAX_SHORTCUTS = 8
+SHORTCUT_THRESHOLD = 3
+TRAFFIC_SIZE = 1024
+
+
+class RoutingTable:
+    '''
+    Routing table of a node of the tree
+
+    Fields:
+        shortcuts (OrderedDict) Matching between an id of a distant node
+                                and socket with direct connection to it,
+                                the least recently used first
+        _routes (tuple) Bounds and id of the node and sockets of its
+                        left child, right child and parent. None if links
+                        were changed and routes must be built again
+        _traffic (dict) Matching between an id of a distant node and
+                        number of packets that were sent to it
+    '''
+
+    def __init__(self, max_shortcuts=MAX_SHORTCUTS,
+                 threshold=SHORTCUT_THRESHOLD):
+        self.max_shortcuts = max_shortcuts
+        self.threshold = threshold
+        self.shortcuts = OrderedDict()
+        self._routes = None
+        self._traffic = {}
+
+    @property
+    def is_valid(self):
+        return self._routes is not None
+
+    def invalidate(self):
+        ''' Drop routes, they are built again on the next packet '''
+
+        self._routes = None
+
+    def update(self, low_bound, _id, up_bound, left, right, parent):
+        ''' Set sockets of links of the node '''
+
+        self._routes = (low_bound, _id, up_bound, left, right, parent)
+
+    def next_hop(self, host_id):
+        '''
+        Choose socket for a packet to a node
+
+        Return:
+            (socket) Shortcut with the node or a link towards it
+        '''
+
+        sock = self.shortcuts.get(host_id)
+        if sock is not None:
+            self.shortcuts.move_to_end(host_id)
+            return sock
+        low_bound, _id, up_bound, left, right, parent = self._routes
+        # Receiver in our subtree
+        if low_bound < host_id < up_bound:
+            return left if host_id < _id else right
+        return parent
+
+    def learn(self, host_id):
+        '''
+        Count packet to a distant node
+
+        Return:
+            (bool) True if shortcut with the node should be opened
+        '''
+
+        if not self.max_shortcuts or host_id in self.shortcuts:
+            return False
+        count = self._traffic.get(host_id, 0) + 1
+        if count < self.threshold:
+            if len(self._traffic) >= TRAFFIC_SIZE:
+                self._traffic.clear()
+            self._traffic[host_id] = count
+            return False
+        self._traffic.pop(host_id, None)
+        return True
+
+    def add_shortcut(self, host_id, sock):
+        '''
+        Add shortcut with a node
+
+        Return:
+            (list) Sockets of shortcuts that were evicted
+        '''
+
+        self.shortcuts[host_id] = sock
+        evicted = []
+        while len(self.shortcuts) > self.max_shortcuts:
+            evicted.append(self.shortcuts.popitem(last=False)[1])
+        return evicted
+
+    def remove_sock(self, sock):
+        ''' Forget shortcut over socket that was closed '''
+
+        for host_id, shortcut in list(self.shortcuts.items()):
+            if shortcut is sock:
+                del self.shortcuts[host_id]
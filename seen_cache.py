@@ -0,0 +1,72 @@
+'''
+Module contains SeenCache class. It keeps ids of broadcast and relayed
+packets that a node has seen, so a packet that comes again, e.g. via
+a shortcut or after repair of the tree, is dropped before it is handled
+and sent further.
+
+Ids are kept in two generations of sets. New ids are added to the
+current generation, and when it is full or old the previous generation
+is dropped and the current one becomes previous. So an id is remembered
+for at least one generation, lookup is O(1) and memory is bounded by
+two generations under any traffic.
+
+Vars:
+    SEEN_SIZE (int) Default max number of remembered ids
+    SEEN_TTL (float) Default max time in seconds that an id is remembered
+'''
+
+import threading
+import time
+
+
+SEEN_SIZE = 100000
+SEEN_TTL = 60
+
+
+class SeenCache:
+    '''
+    Ids of seen packets
+
+    Fields:
+        _generation_size (int) Max number of ids in a generation
+        _generation_ttl (float) Max age of a generation in seconds
+        _current (set) Ids of the current generation
+        _previous (set) Ids of the previous generation
+        _rotated (float) Time when the current generation was started
+    '''
+
+    def __init__(self, size=SEEN_SIZE, ttl=SEEN_TTL):
+        self._generation_size = max(size // 2, 1)
+        self._generation_ttl = ttl / 2
+        self._current = set()
+        self._previous = set()
+        self._rotated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def __contains__(self, msg_id):
+        return msg_id in self._current or msg_id in self._previous
+
+    def check(self, msg_id):
+        '''
+        Remember id of a packet
+
+        Return:
+            (bool) True if the id was seen before
+        '''
+
+        with self._lock:
+            if msg_id in self._current or msg_id in self._previous:
+                return True
+            if len(self._current) >= self._generation_size or \
+                    time.monotonic() - self._rotated > self._generation_ttl:
+                self._rotate()
+            self._current.add(msg_id)
+            return False
+
+    def _rotate(self):
+        self._previous = self._current
+        self._current = set()
+        self._rotated = time.monotonic()
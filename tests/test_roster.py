@@ -0,0 +1,33 @@
+import unittest
+
+from roster import Member, Roster
+
+
+class RosterTest(unittest.TestCase):
+
+    def assert_consistent(self, roster):
+        expected = Roster()
+        expected.load(roster.uid, roster.epoch, roster.members.values())
+        self.assertEqual(roster.by_id,
+                         {member.id: member
+                          for member in roster.members.values()})
+        self.assertEqual(roster._ids, sorted(roster.by_id))
+        self.assertEqual(roster.digest(), expected.digest())
+
+    def test_readd_host_and_reuse_id(self):
+        roster = Roster()
+        roster.add(Member(10, ('a', 1)))
+        roster.add(Member(20, ('a', 1)))
+        self.assertNotIn(10, roster.by_id)
+        self.assert_consistent(roster)
+
+        # Another host takes the old id of the host
+        roster.add(Member(10, ('b', 1)))
+        self.assertEqual(roster.members[('a', 1)].id, 20)
+        self.assertEqual(roster.by_id[10].host, ('b', 1))
+        self.assertEqual(len(roster), 2)
+        self.assert_consistent(roster)
+
+
+if __name__ == '__main__':
+    unittest.main()
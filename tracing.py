@@ -0,0 +1,117 @@
+'''
+Module contains Tracer class. Tracer of a node samples packets that
+the node sends, and every node that a sampled packet passes appends
+itself to the trace of the packet. Trace is kept in "trace" field of
+header of the packet, so it is read and extended without decoding of
+body of a relayed packet.
+
+Trace is a flat list [trace_id, start, node_id, offset, node_id,
+offset, ...]: start is time of the first hop in microseconds since
+epoch and offsets of hops are counted from it, so numbers stay small.
+Times are taken from clocks of nodes, so delays between machines are
+as precise as their clocks are synchronized.
+
+A node that a trace ends at (receiver of a relayed packet or every
+receiver of a broadcast) keeps it in a ring buffer that is exported
+as JSON. Number of hops of finished traces is the only metric of hops
+of whole paths, other packets are counted per relay by handlers.
+
+Vars:
+    TRACE_BUFFER (int) Default number of traces that a node keeps
+    HOP_BUCKETS (tuple) Bounds of histogram of hops of traces
+'''
+
+import json
+import random
+import threading
+import time
+
+from collections import deque
+
+
+TRACE_BUFFER = 1000
+HOP_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16, 24, 32)
+
+
+class Tracer:
+    '''
+    Tracing of packets of a node
+
+    Fields:
+        sample_rate (float) Share of packets that the node sends which
+                            are traced. Traces of other nodes are
+                            extended anyway
+        _peer (BinaryTreePeer) Peer of the node
+        _traces (deque) Ring buffer of finished traces
+        _hops (Histogram) Number of hops of finished traces
+    '''
+
+    def __init__(self, peer, sample_rate=0, size=TRACE_BUFFER):
+        self._peer = peer
+        self.sample_rate = sample_rate
+        self._traces = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._hops = peer.metrics.histogram('trace_hops', buckets=HOP_BUCKETS)
+
+    def start(self, packet):
+        ''' Start trace of a packet that is sent by the node if sampled '''
+
+        if not self.sample_rate or 'trace' in packet or \
+                random.random() >= self.sample_rate:
+            return
+        packet['trace'] = [random.getrandbits(63), _now(), self._peer._id, 0]
+
+    def hop(self, packet):
+        ''' Append the node to trace of a packet that it passes '''
+
+        trace = packet.get('trace')
+        if trace is not None:
+            trace += [self._peer._id, _now() - trace[1]]
+
+    def finish(self, packet):
+        ''' Append the node to trace of a packet and keep the trace '''
+
+        trace = packet.get('trace')
+        if trace is None:
+            return
+        self.hop(packet)
+        _type = packet.get('downtype') or packet['type']
+        # Trace of a broadcast is extended further, so it is copied
+        record = (_type, list(trace))
+        with self._lock:
+            self._traces.append(record)
+        self._hops.observe(len(trace) // 2 - 2)
+
+    def traces(self):
+        '''
+        Get finished traces, the oldest first
+
+        Return:
+            (list) Dicts with id and type of packet, number of hops and
+                   list of hops with id of node, time and delay since
+                   the previous hop in microseconds
+        '''
+
+        with self._lock:
+            records = list(self._traces)
+        return [_expand(_type, trace) for _type, trace in records]
+
+    def to_json(self):
+        return json.dumps(self.traces())
+
+
+def _now():
+    return int(time.time() * 1e6)
+
+
+def _expand(_type, trace):
+    trace_id, start = trace[0], trace[1]
+    hops = []
+    previous = 0
+    for idx in range(2, len(trace), 2):
+        offset = trace[idx + 1]
+        hops.append({'node': trace[idx], 'time': start + offset,
+                     'delay': offset - previous})
+        previous = offset
+    return {'trace_id': trace_id, 'type': _type, 'hops': len(hops) - 1,
+            'path': hops}
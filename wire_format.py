@@ -0,0 +1,389 @@
+'''
+Module contains codecs of packets and wire formats. Wire format is
+a codec together with framing of encoded packets.
+
+Peers agree on a wire format during get_chat_info and connect requests:
+a client offers names of formats that it supports in "formats" field,
+and a host answers with chosen format in "format" field. After the
+answer both sides use chosen format on this connection. Every
+connection starts with JSON format, so peers that don't know about
+wire formats keep working with JSON.
+
+Compact codecs put the header of a packet (type, ids and hosts of
+a sender and a receiver, see HEADER_FIELDS) to an array instead of
+a dict, type of packet is replaced by its number in PACKET_TYPES and
+members of a chat in "connected" field are sent as arrays too. Other
+fields are encoded as a dict that follows the array, so a packet is
+decoded to Packet without decoding of the dict, and a relayed packet
+is encoded again with the same bytes of the dict.
+
+Broadcast packets differ between neighbors only in a receiver and
+a side of a sender, so such packet is encoded once with placeholders
+and only these fields are encoded for every neighbor (see
+BroadcastTemplate). Responses that are equal for many clients except
+a receiver, e.g. pages of roster, are encoded the same way (see
+PacketTemplate).
+
+Vars:
+    PACKET_TYPES (tuple) Types of packets that are encoded by number in
+                         compact codecs. New types must be appended
+    MEMBER_FIELDS (tuple) Fields of a member of chat in compact codecs
+    WIRE_FORMATS (dict) Matching between a name and available wire format
+    PREFERRED_FORMATS (list) Names of available formats, the best first
+    DEFAULT_FORMAT (str) Name of format that every connection starts with
+'''
+
+import json
+
+from json.encoder import encode_basestring
+
+from framing import (FrameDecoder, LengthPrefixedDecoder,
+                     frame_delimited, frame_length_prefixed)
+from packet import Packet, HEADER_FIELDS, REQUIRED_FIELDS
+from roster import Member
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+PACKET_TYPES = (
+    'connect', 'disconnect', 'ping', 'get_chat_info', 'chat_info', 'relay',
+    'find_insert_place', 'insert_place', 'connect_resp', 'new_user',
+    'message', 'get_history', 'history', 'reattach', 'reattach_place',
+    'bounds', 'gossip_digest'
+)
+MEMBER_FIELDS = ('id', 'host', 'username')
+DEFAULT_FORMAT = 'json'
+
+_TYPE_NUMBERS = {_type: num for num, _type in enumerate(PACKET_TYPES)}
+_HEADER = frozenset(HEADER_FIELDS)
+# Header of JSON packet is decoded from this prefix if it fits
+_HEADER_PREFIX = 256
+
+
+def _encode_object(obj):
+    ''' Encode records of roster that are put to packets as they are '''
+
+    if isinstance(obj, Member):
+        return obj.to_dict()
+    raise TypeError('Object of type %s is not JSON serializable'
+                    % type(obj).__name__)
+
+
+_JSON_ENCODER = json.JSONEncoder(separators=(',', ':'), default=_encode_object)
+_JSON_DECODER = json.JSONDecoder()
+
+
+class _JsonPrimitives:
+    ''' Encoding of single JSON values '''
+
+    def _value(self, value):
+        if type(value) is int:
+            return b'%d' % value
+        return _JSON_ENCODER.encode(value).encode()
+
+    def _host(self, host):
+        ''' Encode tuple of IP and port '''
+
+        try:
+            ip, port = host
+            return b'[%s,%d]' % (encode_basestring(ip).encode(), port)
+        except (TypeError, ValueError):
+            return self._value(host)
+
+    def _loads(self, data):
+        return json.loads(data)
+
+    def _split(self, data):
+        '''
+        Decode the first value of data
+
+        Return:
+            (tuple) Value and offset of the rest of data
+        '''
+
+        # Encoder escapes non-ASCII characters, so offsets of characters
+        # and bytes are equal
+        try:
+            return _JSON_DECODER.raw_decode(
+                bytes(data[:_HEADER_PREFIX]).decode('latin-1'))
+        except ValueError:
+            return _JSON_DECODER.raw_decode(bytes(data).decode('latin-1'))
+
+
+class _MsgpackPrimitives:
+    ''' Encoding of single msgpack values '''
+
+    def _value(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def _host(self, host):
+        return self._value(host)
+
+    def _loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    def _split(self, data):
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(data)
+        return unpacker.unpack(), unpacker.tell()
+
+
+class JsonCodec(_JsonPrimitives):
+    ''' Codec of JSON packets. It is understood by every peer '''
+
+    def encode(self, packet):
+        if type(packet) is Packet:
+            packet = packet.to_dict()
+        return _JSON_ENCODER.encode(packet).encode()
+
+    def decode(self, data):
+        return Packet.from_dict(json.loads(data))
+
+
+class CompactCodec:
+    '''
+    Base class of compact codecs. Packet is encoded as array
+    [type, from_id, to_id, from_host, to_host, downtype, client_id,
+    client_host, msg_id, trace] that is followed by dict of other fields.
+    Missing fields at the end of array and empty dict are omitted.
+    '''
+
+    def encode(self, packet):
+        is_packet = type(packet) is Packet
+        if is_packet:
+            header = [getattr(packet, field, None) for field in HEADER_FIELDS]
+        else:
+            header = [packet.get(field) for field in HEADER_FIELDS]
+        for idx in (0, 5):
+            header[idx] = _TYPE_NUMBERS.get(header[idx], header[idx])
+        while len(header) > REQUIRED_FIELDS and header[-1] is None:
+            header.pop()
+        data = self._value(header)
+
+        if is_packet:
+            raw = packet.raw_body(self)
+            if raw is not None:
+                return data + raw
+            rest = packet.body
+        else:
+            rest = {key: value for key, value in packet.items()
+                    if key not in _HEADER}
+        if rest:
+            data += self._value(self._compact_rest(rest))
+        return data
+
+    def _compact_rest(self, rest):
+        if 'connected' in rest:
+            rest = dict(rest)
+            rest['connected'] = [[member.id, member.host, member.username]
+                                 for member in rest['connected']]
+        return rest
+
+    def decode(self, data):
+        header, offset = self._split(data)
+        body = None
+        if len(header) > REQUIRED_FIELDS and isinstance(header[-1], dict):
+            # Fields were placed to the end of array by older peers
+            body = header.pop()
+        for idx in (0, 5):
+            if idx < len(header) and isinstance(header[idx], int):
+                header[idx] = PACKET_TYPES[header[idx]]
+
+        if offset < len(data):
+            return Packet(header, memoryview(data)[offset:], self)
+        packet = Packet(header)
+        if body is not None:
+            for key, value in self._expand_rest(body).items():
+                packet[key] = value
+        return packet
+
+    def decode_body(self, raw):
+        return self._expand_rest(self._loads(bytes(raw)))
+
+    def _expand_rest(self, rest):
+        if 'connected' in rest:
+            rest['connected'] = [dict(zip(MEMBER_FIELDS, member))
+                                 for member in rest['connected']]
+        return rest
+
+
+class CompactJsonCodec(_JsonPrimitives, CompactCodec):
+    ''' Compact codec on top of json module '''
+
+
+class MsgpackCodec(_MsgpackPrimitives, CompactCodec):
+    ''' Compact codec on top of msgpack. Available if msgpack is installed '''
+
+
+class WireFormat:
+    '''
+    Codec together with framing
+
+    Fields:
+        name (str) Name of format that is used in negotiation
+        codec (object) Codec of packets
+        decoder_cls (type) Class of frame decoder
+    '''
+
+    def __init__(self, name, codec, decoder_cls, frame):
+        self.name = name
+        self.codec = codec
+        self.decoder_cls = decoder_cls
+        self._frame = frame
+
+    def pack(self, packet):
+        ''' Encode packet to bytes that are ready to be sent '''
+
+        return self._frame(self.codec.encode(packet))
+
+    def unpack(self, frame):
+        ''' Decode packet from received frame '''
+
+        return self.codec.decode(frame)
+
+    def frame(self, payload):
+        ''' Frame payload that is encoded already '''
+
+        return self._frame(payload)
+
+    def create_decoder(self, max_frame_size, recv_size):
+        return self.decoder_cls(max_frame_size, recv_size)
+
+    def packet_template(self, packet):
+        return PacketTemplate(self, packet)
+
+    def broadcast_template(self, packet):
+        return BroadcastTemplate(self, packet)
+
+
+class PacketTemplate:
+    '''
+    Packet that is encoded once for many receivers. Packet is encoded
+    with placeholders instead of a receiver, then encoded placeholders
+    are replaced by values for every receiver. It is correct for
+    supported codecs, since their arrays and maps contain number of
+    items, not their size in bytes.
+
+    Fields:
+        _parts (list) Encoded packet split by placeholders
+        _fields (list) Names of fields that are placed between parts
+    '''
+
+    _PLACEHOLDERS = {
+        'to_id': '\x00to_id\x00',
+        'to_host': '\x00to_host\x00'
+    }
+    # Matching between a class of template and a type of codec and
+    # encoded placeholders
+    _encoded = {}
+
+    def __init__(self, wire_format, packet):
+        self._frame = wire_format._frame
+        self._codec = codec = wire_format.codec
+
+        encoded = codec.encode(self._with_placeholders(dict(packet)))
+
+        positions = sorted((encoded.index(placeholder), len(placeholder), field)
+                           for field, placeholder
+                           in self._encoded_placeholders(codec))
+        self._parts = []
+        self._fields = []
+        offset = 0
+        for position, size, field in positions:
+            self._parts.append(encoded[offset:position])
+            self._fields.append(field)
+            offset = position + size
+        self._parts.append(encoded[offset:])
+
+    def _with_placeholders(self, packet):
+        packet['to_id'] = self._PLACEHOLDERS['to_id']
+        packet['to_host'] = self._PLACEHOLDERS['to_host']
+        return packet
+
+    @classmethod
+    def _encoded_placeholders(cls, codec):
+        key = (cls, type(codec))
+        encoded = cls._encoded.get(key)
+        if encoded is None:
+            encoded = cls._encoded[key] = [
+                (field, codec._value(placeholder))
+                for field, placeholder in cls._PLACEHOLDERS.items()]
+        return encoded
+
+    def pack(self, to_id, to_host):
+        ''' Get bytes of packet for a receiver that are ready to be sent '''
+
+        return self._join({'to_id': self._codec._value(to_id),
+                           'to_host': self._codec._host(to_host)})
+
+    def _join(self, values):
+        parts = [self._parts[0]]
+        for field, part in zip(self._fields, self._parts[1:]):
+            parts.append(values[field])
+            parts.append(part)
+        return self._frame(b''.join(parts))
+
+
+class BroadcastTemplate(PacketTemplate):
+    '''
+    Broadcast packet that is encoded once for all neighbors. A side of
+    a sender is a placeholder too, since it differs between neighbors.
+    '''
+
+    _PLACEHOLDERS = dict(PacketTemplate._PLACEHOLDERS,
+                         side='\x00from_node_side\x00')
+
+    def __init__(self, wire_format, packet):
+        super().__init__(wire_format, packet)
+        self._sides = {}
+
+    def _with_placeholders(self, packet):
+        packet = super()._with_placeholders(packet)
+        packet['broadcast'] = dict(packet['broadcast'],
+                                   from_node_side=self._PLACEHOLDERS['side'])
+        return packet
+
+    def pack(self, to_id, to_host, side):
+        ''' Get bytes of packet for a neighbor that are ready to be sent '''
+
+        side_value = self._sides.get(side)
+        if side_value is None:
+            side_value = self._sides[side] = self._codec._value(side)
+        return self._join({'to_id': self._codec._value(to_id),
+                           'to_host': self._codec._host(to_host),
+                           'side': side_value})
+
+
+def negotiate(offered, supported):
+    '''
+    Choose wire format for a connection
+
+    Args:
+        offered (list) Names of formats that a client supports
+        supported (list) Names of formats that a host supports
+    Return:
+        (str) Name of chosen format or None if client didn't offer formats
+    '''
+
+    if not offered:
+        return None
+    for name in offered:
+        if name in supported:
+            return name
+    return DEFAULT_FORMAT
+
+
+WIRE_FORMATS = {
+    'json': WireFormat('json', JsonCodec(), FrameDecoder, frame_delimited),
+    'cjson': WireFormat('cjson', CompactJsonCodec(), LengthPrefixedDecoder,
+                        frame_length_prefixed)
+}
+if msgpack is not None:
+    WIRE_FORMATS['msgpack'] = WireFormat('msgpack', MsgpackCodec(),
+                                         LengthPrefixedDecoder,
+                                         frame_length_prefixed)
+PREFERRED_FORMATS = [name for name in ('msgpack', 'cjson', 'json')
+                     if name in WIRE_FORMATS]
@@ -0,0 +1,246 @@
+'''
+Module contains WorkerGroup and ReplicaPeer classes. They offload
+handshakes of joining clients from the process of a peer: worker
+processes listen on the port of the peer via SO_REUSEPORT, so the kernel
+spreads incoming connections among the peer and its workers.
+
+The peer process owns state of the node. Its id, links, bounds and
+roster are replicated to workers over pipes: the whole roster when
+a worker is started and only changes since the last replicated epoch
+afterwards. Workers accept connections, decode frames and answer
+requests of a handshake that only read the state, i.e. pages of
+the roster and pings, by themselves. When a connection sends any other
+request, the worker hands the socket over to the peer process together
+with data that is not processed yet, so the tree is changed only by
+the owner of the node.
+
+Only handshakes are offloaded. Connections of links, shortcuts and
+gossip start with other requests, so they are handed over at once, and
+relays, broadcasts and messages are handled by the peer process on one
+core. Workers help a node that many clients join via, e.g. the seed
+of a join storm, and not a node that relays a lot.
+
+Vars:
+    LOCAL_TYPES (tuple) Types of requests that workers answer by themselves
+'''
+
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import threading
+
+from multiprocessing import reduction
+
+from bst_peer import BinaryTreePeer
+from framing import FrameTooLarge
+from handlers import TYPES
+
+
+LOGGER = logging.getLogger(__name__)
+LOCAL_TYPES = (TYPES['get_chat_info'], TYPES['ping'])
+
+
+class WorkerGroup:
+    '''
+    Worker processes of a peer
+
+    Fields:
+        _peer (BinaryTreePeer) Peer that owns state of the node
+        _count (int) Number of worker processes
+        _kwargs (dict) Arguments of ReplicaPeer of every worker
+        _processes (list) Worker processes
+        _pipes (list) Connections with workers
+        _roster_uid (str) Uid of roster that was replicated
+        _epoch (int) Epoch of roster that was replicated
+        _state (dict) Id, links and bounds of the node that were replicated
+        _updates (Queue) Updates that are sent to workers by a thread of
+                         the group, since writes to pipes can block
+    '''
+
+    def __init__(self, peer, count, **kwargs):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError('SO_REUSEPORT is not supported by platform')
+        self._peer = peer
+        self._count = count
+        self._kwargs = kwargs
+        self._processes = []
+        self._pipes = []
+        self._roster_uid = None
+        self._epoch = None
+        self._state = None
+        self._updates = queue.Queue()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._processes)
+
+    def start(self):
+        # Peer has running threads, so workers are not forked
+        context = multiprocessing.get_context('spawn')
+        for _ in range(self._count):
+            conn, worker_conn = context.Pipe()
+            process = context.Process(
+                target=_run_worker,
+                args=(self._peer._port, worker_conn, self._kwargs),
+                daemon=True)
+            process.start()
+            worker_conn.close()
+            self._processes.append(process)
+            thread = threading.Thread(target=self._receive_conns,
+                                      args=(conn,), daemon=True)
+            thread.start()
+            with self._lock:
+                self._pipes.append(conn)
+        thread = threading.Thread(target=self._send_updates, daemon=True)
+        thread.start()
+        self.publish(full=True)
+
+    def publish(self, full=False):
+        '''
+        Replicate state of the node to workers
+
+        Args:
+            full (bool) Send the whole roster, not only its changes
+        '''
+
+        peer = self._peer
+        roster = peer._roster
+        state = {'id': peer._id, 'left': peer._left, 'right': peer._right,
+                 'parent': peer._parent, 'up_bound': peer.up_bound,
+                 'low_bound': peer.low_bound}
+        with self._lock:
+            changes = None
+            if not full and roster.uid == self._roster_uid:
+                changes = roster.changes_since(self._epoch)
+            if changes is None:
+                epoch, members = roster.snapshot()
+                update = ('snapshot', roster.uid, epoch, members)
+            elif changes or state != self._state:
+                epoch = roster.epoch
+                update = ('changes', changes, epoch)
+            else:
+                return
+            self._roster_uid = roster.uid
+            self._epoch = epoch
+            self._state = state
+            self._updates.put((state, update))
+
+    def _send_updates(self):
+        ''' Send updates to workers in order they were published '''
+
+        while True:
+            update = self._updates.get()
+            with self._lock:
+                pipes = list(self._pipes)
+            for conn in pipes:
+                try:
+                    conn.send(update)
+                except OSError as e:
+                    LOGGER.warning('Worker is stopped: %s', e)
+                    with self._lock:
+                        self._pipes.remove(conn)
+
+    def _receive_conns(self, conn):
+        ''' Serve connections that are handed over by a worker '''
+
+        while True:
+            try:
+                wire_format, data = conn.recv()
+                fd = reduction.recv_handle(conn)
+            except (EOFError, OSError):
+                LOGGER.warning('Connection with worker is closed')
+                return
+            # Connection is served by reactor, so it is adopted there
+            self._peer._reactor.call_soon(self._peer._adopt_conn,
+                                          socket.socket(fileno=fd),
+                                          wire_format, data)
+
+
+class ReplicaPeer(BinaryTreePeer):
+    '''
+    Peer of a worker process. It serves handshakes of clients that
+    join via a node whose state is owned by another process.
+
+    Fields:
+        _conn (Connection) Connection with the owner of the node
+    '''
+
+    def __init__(self, port, conn, **kwargs):
+        self._conn = conn
+        super().__init__(port, reuse_port=True, **kwargs)
+
+    def run(self):
+        ''' Serve connections until the owner of the node is stopped '''
+
+        # Requests are answered only when state is known
+        self._apply_state(*self._conn.recv())
+        self._add_work(self._handle_recv)
+        while True:
+            try:
+                update = self._conn.recv()
+            except (EOFError, OSError):
+                return
+            self._reactor.call_soon(self._apply_state, *update)
+
+    def _apply_state(self, state, update):
+        if update[0] == 'snapshot':
+            _, uid, epoch, members = update
+            self._roster.load(uid, epoch, members)
+            # Hosts of members are taken from the loaded roster
+            self.id2host.clear()
+        else:
+            _, changes, epoch = update
+            self._roster.apply(changes, epoch)
+
+        if state['id'] is not None and state['id'] != self._id:
+            self._assign_id(state['id'])
+        self._left = state['left']
+        self._right = state['right']
+        self._parent = state['parent']
+        self.up_bound = state['up_bound']
+        self.low_bound = state['low_bound']
+
+    def _process_frames(self, sock):
+        try:
+            while sock in self._message_data:
+                req = self._message_data[sock].next_frame()
+                if req is None:
+                    break
+                packet = self._unpack(sock, req)
+                if packet['type'] not in LOCAL_TYPES:
+                    self._hand_over(sock, req)
+                    break
+                self._add_message2send(sock, self._process_request(packet,
+                                                                   True, sock))
+        except FrameTooLarge as e:
+            LOGGER.warning('Closing connection: %s', e)
+            self._close_sock(sock)
+
+    def _hand_over(self, sock, frame):
+        '''
+        Pass connection to the owner of the node. Clients wait for
+        a response before the next request, so nothing is left in
+        outbound buffer of the connection.
+        '''
+
+        wire_format = self._get_wire_format(sock)
+        data = wire_format.frame(bytes(frame)) + \
+            self._message_data[sock].pending()
+        LOGGER.debug('Handing over %s', sock)
+        self._conn.send((wire_format.name, data))
+        reduction.send_handle(self._conn, sock.fileno(), os.getppid())
+        # Connection stays open in the owner process
+        self._close_sock(sock)
+
+
+def _run_worker(port, conn, kwargs):
+    ''' Entry point of worker process '''
+
+    peer = ReplicaPeer(port, conn, **kwargs)
+    try:
+        peer.run()
+    finally:
+        # Reactor thread is not a daemon, so it is stopped with process
+        os._exit(0)